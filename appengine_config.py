@@ -27,6 +27,10 @@ from google.appengine import dist
 dist.use_library('django', '1.1')
 
 
+# Acknowledge snippets once they are buffered and store them from a task.
+# See models.BufferSnippets.
+snipper_WRITE_BEHIND = False
+
 MIDDLEWARE_CLASSES = (
     'google.appengine.ext.appstats.recording.AppStatsDjangoMiddleware',
 )
@@ -34,4 +38,5 @@ MIDDLEWARE_CLASSES = (
 
 def webapp_add_wsgi_middleware(app): # pylint: disable-msg=C6409
   from google.appengine.ext.appstats import recording
-  return recording.appstats_wsgi_middleware(app)
+  import metrics
+  return metrics.MetricsMiddleware(recording.appstats_wsgi_middleware(app))
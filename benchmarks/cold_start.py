@@ -0,0 +1,135 @@
+#!/usr/bin/python2.5
+#
+# Copyright 2012 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""Measure cold-start cost of the Snipper WSGI application, per route.
+
+Every sample runs in a fresh interpreter, as a new App Engine instance
+would. It reports the time to import snipper.py, the time to serve the
+first request on the route, and how many modules each step loaded.
+
+  python benchmarks/cold_start.py --runs 5 --output cold_start.json
+"""
+
+__author__ = 'erichiggins@gmail.com (Eric Higgins)'
+
+import json
+import optparse
+import os
+import subprocess
+import sys
+import time
+import urllib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmarks import sdk  # pylint: disable-msg=C6204
+
+
+ROUTES = [
+    ('GET', '/', None),
+    ('GET', '/json', None),
+    ('GET', '/view', None),
+    ('POST', '/add', {'s': 'Cold start snippet', 'v': 'bench'}),
+    ('GET', '/settings', None),
+    ('GET', '/preferences.html', None),
+    ('POST', '/_ah/xmpp/message/chat/', {'from': 'bench@example.com/res',
+                                         'to': 'snipper@appspot.com',
+                                         'body': 'help'}),
+    ('GET', '/report/weekly', None),
+    ('POST', '/report/mail', None),
+]
+
+
+def _Median(values):
+  values = sorted(values)
+  middle = len(values) // 2
+  if len(values) % 2:
+    return values[middle]
+  return (values[middle - 1] + values[middle]) / 2.0
+
+
+def RunChild(method, path, params):
+  """Import the app and serve one request, returning the timings."""
+  sdk.SetupPath()
+  sdk.ActivateStubs()
+  from google.appengine.ext import webapp  # pylint: disable-msg=C6204
+  modules_before = len(sys.modules)
+  started = time.time()
+  import snipper  # pylint: disable-msg=C6204
+  imported = time.time()
+  modules_imported = len(sys.modules)
+
+  request = webapp.Request.blank(path)
+  if method == 'POST':
+    request.method = 'POST'
+    request.environ['CONTENT_TYPE'] = 'application/x-www-form-urlencoded'
+    request.body = urllib.urlencode(params or {})
+  status = []
+
+  def _StartResponse(response_status, unused_headers, unused_exc_info=None):
+    status.append(response_status)
+  ''.join(snipper.application(request.environ, _StartResponse))
+  served = time.time()
+  return {
+      'import_ms': (imported - started) * 1000,
+      'first_request_ms': (served - imported) * 1000,
+      'total_ms': (served - started) * 1000,
+      'modules_at_import': modules_imported - modules_before,
+      'modules_after_request': len(sys.modules) - modules_before,
+      'status': status and status[0] or None,
+  }
+
+
+def main():
+  parser = optparse.OptionParser()
+  parser.add_option('--runs', type='int', default=3,
+                    help='Cold starts to sample for each route.')
+  parser.add_option('--route', action='append',
+                    help='Only measure these paths.')
+  parser.add_option('--output', help='Write the results as JSON to a file.')
+  parser.add_option('--child', help=optparse.SUPPRESS_HELP)
+  options, _ = parser.parse_args()
+
+  if options.child:
+    method, path, params = json.loads(options.child)
+    print json.dumps(RunChild(method, path, params))
+    return
+
+  results = {}
+  for method, path, params in ROUTES:
+    if options.route and path not in options.route:
+      continue
+    samples = []
+    for _ in xrange(options.runs):
+      output = subprocess.check_output(
+          [sys.executable, os.path.abspath(__file__),
+           '--child', json.dumps([method, path, params])])
+      samples.append(json.loads(output.strip().splitlines()[-1]))
+    summary = {'runs': options.runs, 'status': samples[-1]['status']}
+    for field in ('import_ms', 'first_request_ms', 'total_ms',
+                  'modules_at_import', 'modules_after_request'):
+      summary[field] = _Median([sample[field] for sample in samples])
+    results['%s %s' % (method, path)] = summary
+    print '%-35s import %7.1fms  first request %7.1fms  modules %d' % (
+        '%s %s' % (method, path), summary['import_ms'],
+        summary['first_request_ms'], summary['modules_after_request'])
+
+  if options.output:
+    open(options.output, 'w').write(
+        json.dumps(results, indent=2, sort_keys=True) + '\n')
+
+
+if __name__ == '__main__':
+  main()
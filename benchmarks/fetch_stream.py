@@ -0,0 +1,138 @@
+#!/usr/bin/python2.5
+#
+# Copyright 2012 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""Measure memory and latency of reading a heavy user's whole history.
+
+Every mode runs in a fresh interpreter against the datastore stub, seeded
+with --snippets snippets for one user. It reports the time to the first
+snippet, the total time, and how much the peak resident memory grew while
+reading, comparing one big fetch with models.IterSnippets.
+
+  python benchmarks/fetch_stream.py --snippets 10000 --output fetch.json
+"""
+
+__author__ = 'erichiggins@gmail.com (Eric Higgins)'
+
+import datetime
+import gc
+import json
+import optparse
+import os
+import resource
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmarks import sdk  # pylint: disable-msg=C6204
+
+
+# Mode name -> keyword arguments for models.IterSnippets, or None for one
+# fetch of every snippet into a list.
+MODES = [
+    ('fetch_all', None),
+    ('iter_100', {'batch_size': 100}),
+    ('iter_500', {'batch_size': 500}),
+    ('iter_1000', {'batch_size': 1000}),
+    ('iter_keys_only', {'batch_size': 500, 'keys_only': True}),
+    ('iter_projection', {'batch_size': 500,
+                         'projection': ('DateStamp', 'Snippet')}),
+]
+
+
+def Seed(models, user, count):
+  """Store count snippets for user, one every 20 minutes back from now."""
+  from google.appengine.ext import db  # pylint: disable-msg=C6204
+  models.MigrationState(key_name=models.SNIPPET_MIGRATION, Done=True).put()
+  parent = models.SnippetUserKey(user)
+  now = datetime.datetime.utcnow()
+  for start in xrange(0, count, 500):
+    db.put([models.Snippet(
+        parent=parent, User=user, ExtensionVersion='bench',
+        Snippet=u'Benchmark snippet number %d about launch reviews' % i,
+        DateStamp=now - datetime.timedelta(minutes=20 * i))
+            for i in xrange(start, min(start + 500, count))])
+
+
+def RunChild(mode, count):
+  """Seed the stub, then read every snippet the way the mode says."""
+  sdk.SetupPath()
+  sdk.ActivateStubs()
+  from google.appengine.api import users  # pylint: disable-msg=C6204
+  import models  # pylint: disable-msg=C6204
+  user = users.User('bench@example.com')
+  Seed(models, user, count)
+  iter_args = dict(MODES)[mode]
+  gc.collect()
+  rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  started = time.time()
+  first = None
+  read = 0
+  if iter_args is None:
+    snippets = models.Snippet.all().ancestor(
+        models.SnippetUserKey(user)).order('DateStamp').fetch(count)
+    first = time.time()
+    read = len(snippets)
+  else:
+    for _ in models.IterSnippets(user, **iter_args):
+      if first is None:
+        first = time.time()
+      read += 1
+  finished = time.time()
+  rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  return {
+      'read': read,
+      'first_ms': ((first or finished) - started) * 1000,
+      'total_ms': (finished - started) * 1000,
+      # ru_maxrss is in kilobytes on Linux.
+      'peak_rss_growth_kb': rss_after - rss_before,
+  }
+
+
+def main():
+  parser = optparse.OptionParser()
+  parser.add_option('--snippets', type='int', default=10000,
+                    help='Snippets stored for the user.')
+  parser.add_option('--mode', action='append',
+                    help='Only measure these modes.')
+  parser.add_option('--output', help='Write the results as JSON to a file.')
+  parser.add_option('--child', help=optparse.SUPPRESS_HELP)
+  options, _ = parser.parse_args()
+
+  if options.child:
+    print json.dumps(RunChild(options.child, options.snippets))
+    return
+
+  results = {}
+  for mode, _ in MODES:
+    if options.mode and mode not in options.mode:
+      continue
+    output = subprocess.check_output(
+        [sys.executable, os.path.abspath(__file__), '--child', mode,
+         '--snippets', str(options.snippets)])
+    results[mode] = json.loads(output.strip().splitlines()[-1])
+    print '%-16s read %6d  first %8.1fms  total %8.1fms  peak rss +%dKB' % (
+        mode, results[mode]['read'], results[mode]['first_ms'],
+        results[mode]['total_ms'], results[mode]['peak_rss_growth_kb'])
+
+  if options.output:
+    open(options.output, 'w').write(json.dumps(
+        {'snippets': options.snippets, 'modes': results},
+        indent=2, sort_keys=True) + '\n')
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,376 @@
+#!/usr/bin/python2.5
+#
+# Copyright 2012 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""Generate web and chat load on Snipper, from a route mix or a request log.
+
+In mix mode --workers clients each send --requests requests, picking
+/add, /json?offset=N, the main page and chat messages by the weights in
+--mix. In replay mode the requests of an Apache combined format log, e.g.
+from appcfg.py request_logs, are sent at their recorded times divided by
+--speedup. Replayed POSTs have no body in the log, so /add and chat posts
+get a generated snippet. Their latency is measured from the time they were
+due to be sent, so requests delayed by a slow server count as slow.
+
+By default requests go to snipper.application in this process, on the
+testbed stubs, seeded with --users users. That runtime serves one request
+at a time, so the clients queue for it like they would for one instance.
+--target sends them over HTTP to a dev_appserver instead, signed in
+through its login cookie.
+
+  python benchmarks/loadgen.py --workers 8 --requests 200 --mix add=5,json=2
+  python benchmarks/loadgen.py --replay requests.log --speedup 20 \\
+      --target http://localhost:8080
+
+It reports throughput, the error rate and latency percentiles, in total
+and for each route.
+"""
+
+__author__ = 'erichiggins@gmail.com (Eric Higgins)'
+
+import calendar
+import json
+import optparse
+import os
+import Queue
+import random
+import re
+import sys
+import threading
+import time
+import urllib
+import urllib2
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmarks import sdk  # pylint: disable-msg=C6204
+
+
+# Route name -> (method, path, params). Paths and params are formatted with
+# the user's email, a request number and a week offset.
+ROUTES = {
+    'add': ('POST', '/add', {'s': 'Load test snippet %(n)d', 'v': 'loadgen'}),
+    'json': ('GET', '/json?offset=%(offset)d', None),
+    'main': ('GET', '/', None),
+    'xmpp': ('POST', '/_ah/xmpp/message/chat/',
+             {'from': '%(email)s/loadgen', 'to': 'snipper@appspot.com',
+              'body': 'Load test snippet %(n)d'}),
+}
+DEFAULT_MIX = 'add=4,json=3,main=2,xmpp=1'
+PERCENTILES = (50, 90, 99, 99.9)
+# Host, identity, user, [time], "request line", status of a combined log.
+_LOG_LINE_RE = re.compile(
+    r'^\S+ \S+ (\S+) \[([^\]]+)\] "(\S+) (\S+)[^"]*" (\d{3})')
+
+
+def RouteOf(method, path):
+  """Return the route name of a request, for grouping the results."""
+  path = path.split('?', 1)[0]
+  if path.startswith('/_ah/xmpp/message/'):
+    return 'xmpp'
+  for name, (route_method, route_path, _) in ROUTES.items():
+    if method == route_method and path == route_path.split('?', 1)[0]:
+      return name
+  return 'other'
+
+
+class Request(object):
+  """One request to send.
+
+  Attributes:
+    route: Route name the results are grouped under.
+    method: 'GET' or 'POST'.
+    path: Path and query string.
+    params: Dict of form fields of a POST, or None.
+    email: Email of the signed-in user, or None.
+    due: Seconds after the start the request is due, or None to send it
+      as soon as a client is free.
+  """
+
+  def __init__(self, route, method, path, params=None, email=None, due=None):
+    self.route = route
+    self.method = method
+    self.path = path
+    self.params = params
+    self.email = email
+    self.due = due
+
+
+def MakeRequest(route, email, n, max_offset):
+  """Return a Request of a route from ROUTES for a user."""
+  method, path, params = ROUTES[route]
+  values = {'email': email, 'n': n,
+            'offset': random.randint(0, max_offset)}
+  return Request(route, method, path % values, params and dict(
+      (name, value % values) for name, value in params.items()), email)
+
+
+def ParseMix(mix):
+  """Parse 'add=4,json=3' into a list of (route, weight)."""
+  weights = []
+  for part in mix.split(','):
+    route, weight = part.split('=')
+    if route not in ROUTES:
+      raise ValueError('Unknown route %r, expected one of %s.' %
+                       (route, ', '.join(sorted(ROUTES))))
+    weights.append((route, float(weight)))
+  return weights
+
+
+def PickRoute(weights):
+  point = random.uniform(0, sum(weight for _, weight in weights))
+  for route, weight in weights:
+    point -= weight
+    if point <= 0:
+      return route
+  return weights[-1][0]
+
+
+def _ParseLogTime(stamp):
+  """Return seconds since the epoch of a '10/Oct/2012:13:55:36 -0700'."""
+  when, zone = stamp.split(' ')
+  seconds = calendar.timegm(time.strptime(when, '%d/%b/%Y:%H:%M:%S'))
+  offset = (int(zone[1:3]) * 60 + int(zone[3:5])) * 60
+  if zone[0] == '-':
+    offset = -offset
+  return seconds - offset
+
+
+def ReadLog(fp, users_count, max_offset):
+  """Return the Requests of a combined format log, due in recorded order.
+
+  Requests without a signed-in user are made by a random synthetic user.
+  """
+  requests = []
+  first = None
+  for n, line in enumerate(fp):
+    match = _LOG_LINE_RE.match(line)
+    if not match:
+      continue
+    user, stamp, method, path, _ = match.groups()
+    when = _ParseLogTime(stamp)
+    if first is None:
+      first = when
+    email = '@' in user and user or 'user%d@example.com' % (
+        random.randrange(users_count))
+    route = RouteOf(method, path)
+    if method == 'POST' and route in ('add', 'xmpp'):
+      request = MakeRequest(route, email, n, max_offset)
+    else:
+      request = Request(route, method, path, None, email)
+    request.due = when - first
+    requests.append(request)
+  requests.sort(key=lambda request: request.due)
+  return requests
+
+
+class WsgiClient(object):
+  """Send requests to snipper.application on the testbed stubs.
+
+  The signed-in user is set in os.environ, and the runtime serves one
+  request at a time, so requests take turns.
+  """
+
+  def __init__(self, application):
+    self.application = application
+    self._lock = threading.Lock()
+
+  def Send(self, request):
+    from benchmarks import suite  # pylint: disable-msg=C6204
+    self._lock.acquire()
+    try:
+      status = suite.Call(self.application, request.method, request.path,
+                          request.params, email=request.email)
+    finally:
+      self._lock.release()
+    return status and int(status.split(' ', 1)[0]) or 0
+
+
+class HttpClient(object):
+  """Send requests over HTTP, signed in with the dev_appserver cookie."""
+
+  def __init__(self, target):
+    self.target = target.rstrip('/')
+
+  def Send(self, request):
+    data = None
+    if request.method == 'POST':
+      data = urllib.urlencode(request.params or {})
+    http_request = urllib2.Request(self.target + request.path, data)
+    if request.email:
+      http_request.add_header('Cookie', 'dev_appserver_login="%s:False:%d"' %
+                              (request.email, abs(hash(request.email))))
+    try:
+      response = urllib2.urlopen(http_request)
+      response.read()
+      return response.getcode()
+    except urllib2.HTTPError, err:
+      return err.code
+    except urllib2.URLError:
+      return 0
+
+
+class Results(object):
+  """Latencies and statuses of the sent requests, by route."""
+
+  def __init__(self):
+    self.latencies = {}
+    self.errors = {}
+    self.started = time.time()
+    self.finished = None
+    self._lock = threading.Lock()
+
+  def Add(self, route, latency_ms, status):
+    self._lock.acquire()
+    try:
+      self.latencies.setdefault(route, []).append(latency_ms)
+      if not 200 <= status < 400:
+        self.errors[route] = self.errors.get(route, 0) + 1
+    finally:
+      self._lock.release()
+
+  def AsDict(self):
+    elapsed = (self.finished or time.time()) - self.started
+    routes = {}
+    for route, latencies in self.latencies.items():
+      routes[route] = {
+          'requests': len(latencies),
+          'errors': self.errors.get(route, 0),
+          'error_rate': float(self.errors.get(route, 0)) / len(latencies),
+          'latency_ms': sdk.Percentiles(latencies, PERCENTILES),
+      }
+    every = sum(self.latencies.values(), [])
+    return {
+        'requests': len(every),
+        'seconds': round(elapsed, 3),
+        'requests_per_second': elapsed and len(every) / elapsed,
+        'error_rate': len(every) and (float(sum(self.errors.values())) /
+                                      len(every)),
+        'latency_ms': sdk.Percentiles(every, PERCENTILES),
+        'routes': routes,
+    }
+
+
+def _Worker(client, requests, results, start):
+  """Send requests from a queue until it yields None."""
+  while True:
+    request = requests.get()
+    if request is None:
+      return
+    sent = time.time()
+    status = client.Send(request)
+    if request.due is not None:
+      # Open loop: count the time the request waited for a free client.
+      sent = start + request.due
+    results.Add(request.route, (time.time() - sent) * 1000, status)
+
+
+def Run(client, requests, workers, speedup=1.0):
+  """Send requests with a pool of worker threads.
+
+  Requests with a due time are queued at that time divided by speedup,
+  the others as fast as the workers take them.
+
+  Returns:
+    Results of the run.
+  """
+  results = Results()
+  pending = Queue.Queue(maxsize=workers * 2)
+  start = time.time()
+  threads = [threading.Thread(target=_Worker,
+                              args=(client, pending, results, start))
+             for _ in xrange(workers)]
+  for thread in threads:
+    thread.setDaemon(True)
+    thread.start()
+  for request in requests:
+    if request.due is not None:
+      request.due /= speedup
+      wait = start + request.due - time.time()
+      if wait > 0:
+        time.sleep(wait)
+    pending.put(request)
+  for _ in threads:
+    pending.put(None)
+  for thread in threads:
+    thread.join()
+  results.finished = time.time()
+  return results
+
+
+def main():
+  parser = optparse.OptionParser()
+  parser.add_option('--mix', default=DEFAULT_MIX,
+                    help='Route weights, from: %s.' % ', '.join(sorted(ROUTES)))
+  parser.add_option('--workers', type='int', default=4,
+                    help='Concurrent clients.')
+  parser.add_option('--requests', type='int', default=100,
+                    help='Requests per client in mix mode.')
+  parser.add_option('--replay', help='Replay a combined format request log.')
+  parser.add_option('--speedup', type='float', default=1.0,
+                    help='How many times faster than recorded to replay.')
+  parser.add_option('--users', type='int', default=20,
+                    help='Synthetic users making the requests.')
+  parser.add_option('--snippets', type='int', default=50,
+                    help='Snippets seeded per user in this process.')
+  parser.add_option('--max-offset', type='int', default=4,
+                    help='Largest week offset of /json requests.')
+  parser.add_option('--target',
+                    help='Base URL of a dev_appserver to send requests to.')
+  parser.add_option('--seed', type='int', default=0)
+  parser.add_option('--output', help='Write the results as JSON to a file.')
+  options, _ = parser.parse_args()
+
+  random.seed(options.seed)
+  if options.replay:
+    requests = ReadLog(open(options.replay), options.users, options.max_offset)
+  else:
+    weights = ParseMix(options.mix)
+    requests = [MakeRequest(PickRoute(weights),
+                            'user%d@example.com' % random.randrange(
+                                options.users), n, options.max_offset)
+                for n in xrange(options.workers * options.requests)]
+
+  if options.target:
+    client = HttpClient(options.target)
+  else:
+    sdk.SetupPath()
+    bed = sdk.ActivateStubs(user_email=None)
+    from benchmarks import suite  # pylint: disable-msg=C6204
+    import snipper  # pylint: disable-msg=C6204
+    suite.Seed(options.users, options.snippets)
+    client = WsgiClient(snipper.application)
+
+  results = Run(client, requests, options.workers, options.speedup).AsDict()
+  results.update({'workers': options.workers, 'replay': options.replay,
+                  'speedup': options.speedup, 'target': options.target,
+                  'mix': not options.replay and options.mix or None})
+  print '%d requests in %.1fs, %.1f/s, %.2f%% errors' % (
+      results['requests'], results['seconds'],
+      results['requests_per_second'], results['error_rate'] * 100)
+  for route, summary in sorted(results['routes'].items()):
+    print '%-8s %6d  p50 %7.1fms  p99 %7.1fms  p99.9 %7.1fms  errors %d' % (
+        route, summary['requests'], summary['latency_ms']['p50'],
+        summary['latency_ms']['p99'], summary['latency_ms']['p99.9'],
+        summary['errors'])
+  if not options.target:
+    bed.deactivate()
+
+  if options.output:
+    open(options.output, 'w').write(
+        json.dumps(results, indent=2, sort_keys=True) + '\n')
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,121 @@
+#!/usr/bin/python2.5
+#
+# Copyright 2012 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""Load test the digest mail dispatcher against a local SMTP stand-in.
+
+Simulates the reset hour by sending synthetic digests through
+mailer.Dispatcher and mailer.SmtpTransport to an in-process SMTP server,
+which can be told to reject a share of messages with a temporary error to
+exercise the retry backoff.
+
+  python benchmarks/mail_load.py --digests 5000 --concurrency 8
+"""
+
+__author__ = 'erichiggins@gmail.com (Eric Higgins)'
+
+import asyncore
+import json
+import optparse
+import os
+import random
+import smtpd
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmarks import sdk  # pylint: disable-msg=C6204
+sdk.SetupPath()
+import mailer  # pylint: disable-msg=C6204
+
+
+class SinkServer(smtpd.SMTPServer):
+  """SMTP server that counts messages and optionally defers some of them."""
+
+  def __init__(self, address, fail_rate=0.0):
+    smtpd.SMTPServer.__init__(self, address, None)
+    self.fail_rate = fail_rate
+    self.received = 0
+    self.deferred = 0
+
+  def process_message(self, peer, mailfrom, rcpttos, data):
+    if random.random() < self.fail_rate:
+      self.deferred += 1
+      return '451 Try again later'
+    self.received += 1
+
+
+def MakeDigests(count):
+  """Return count synthetic digests of a few snippets each."""
+  return [{'user': 'user%d' % i,
+           'email': 'user%d@example.com' % i,
+           'datestamp': '2012-01-02',
+           'snippets': '\n'.join('- Snippet %d for user %d' % (n, i)
+                                 for n in xrange(random.randint(1, 20)))}
+          for i in xrange(count)]
+
+
+def main():
+  parser = optparse.OptionParser()
+  parser.add_option('--digests', type='int', default=1000)
+  parser.add_option('--concurrency', type='int', default=4)
+  parser.add_option('--batch-size', type='int', default=mailer.BATCH_SIZE)
+  parser.add_option('--fail-rate', type='float', default=0.0,
+                    help='Share of messages the server defers with a 451.')
+  parser.add_option('--backoff', type='float', default=0.05,
+                    help='Base retry backoff in seconds.')
+  parser.add_option('--port', type='int', default=8025)
+  parser.add_option('--output', help='Write the results as JSON to a file.')
+  options, _ = parser.parse_args()
+
+  server = SinkServer(('localhost', options.port), options.fail_rate)
+  loop = threading.Thread(target=asyncore.loop, kwargs={'timeout': 0.1})
+  loop.setDaemon(True)
+  loop.start()
+
+  dead = []
+  source = mailer.ListSource(MakeDigests(options.digests))
+  dispatcher = mailer.Dispatcher(
+      source, mailer.SmtpTransport('localhost', options.port),
+      batch_size=options.batch_size, concurrency=options.concurrency,
+      base_backoff=options.backoff,
+      dead_letter=lambda digest, error, attempts: dead.append(digest))
+  # Retried digests only become leasable after their backoff. Like the
+  # retry dispatchers SnippetMailWorker starts, run again when they are.
+  dispatcher.Run()
+  retries = dispatcher.PendingRetries()
+  while retries:
+    time.sleep(max(0, retries[0] - time.time()))
+    dispatcher.Run()
+    retries = dispatcher.PendingRetries()
+
+  results = dispatcher.stats.AsDict()
+  results.update({'digests': options.digests,
+                  'concurrency': options.concurrency,
+                  'batch_size': options.batch_size,
+                  'fail_rate': options.fail_rate,
+                  'server_received': server.received,
+                  'server_deferred': server.deferred,
+                  'dead_letters': len(dead)})
+  output = json.dumps(results, indent=2, sort_keys=True)
+  print output
+  if options.output:
+    open(options.output, 'w').write(output + '\n')
+  server.close()
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,108 @@
+#!/usr/bin/python2.5
+#
+# Copyright 2012 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""Make the App Engine SDK and Snipper importable from benchmark scripts.
+
+The SDK is found through the APPENGINE_SDK environment variable, which
+defaults to the install location used by the SDK's Linux/Mac installer.
+"""
+
+__author__ = 'erichiggins@gmail.com (Eric Higgins)'
+
+import os
+import sys
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_SDK = '/usr/local/google_appengine'
+
+
+def SetupPath():
+  """Put the SDK, its bundled libraries and Snipper on sys.path."""
+  sdk = os.environ.get('APPENGINE_SDK', DEFAULT_SDK)
+  if sdk not in sys.path:
+    sys.path.insert(0, sdk)
+  import dev_appserver  # pylint: disable-msg=C6204
+  dev_appserver.fix_sys_path()
+  if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+
+def ActivateStubs(user_email='bench@example.com', is_admin=True):
+  """Activate in-memory stand-ins for the App Engine services Snipper uses.
+
+  Args:
+    user_email: Email of the signed-in user, or None for no user.
+    is_admin: Whether the signed-in user is an admin.
+
+  Returns:
+    The active testbed.Testbed, call deactivate() on it when done.
+  """
+  from google.appengine.ext import testbed  # pylint: disable-msg=C6204
+  bed = testbed.Testbed()
+  bed.activate()
+  bed.setup_env(USER_EMAIL=user_email or '',
+                USER_ID=user_email and str(abs(hash(user_email))) or '',
+                USER_IS_ADMIN=is_admin and '1' or '0',
+                AUTH_DOMAIN='example.com',
+                overwrite=True)
+  bed.init_datastore_v3_stub()
+  bed.init_memcache_stub()
+  bed.init_taskqueue_stub(root_path=ROOT)
+  bed.init_mail_stub()
+  bed.init_xmpp_stub()
+  bed.init_user_stub()
+  return bed
+
+
+class RpcCounter(object):
+  """Count the API calls made through the apiproxy, by service and method.
+
+  Attributes:
+    calls: Dict of 'service.Method' -> number of calls since the last Reset.
+  """
+
+  def __init__(self):
+    self.calls = {}
+
+  def Install(self):
+    """Start counting. Call after ActivateStubs."""
+    # pylint: disable-msg=C6204
+    from google.appengine.api import apiproxy_stub_map
+    apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+        'benchmark_rpc_counter', self._Hook)
+
+  def _Hook(self, service, call, unused_request, unused_response):
+    name = '%s.%s' % (service, call)
+    self.calls[name] = self.calls.get(name, 0) + 1
+
+  def Reset(self):
+    """Return the counts so far and start again from zero."""
+    calls, self.calls = self.calls, {}
+    return calls
+
+
+def Percentiles(values, points=(50, 90, 99)):
+  """Return a dict of the nearest-rank percentiles of values, plus the max."""
+  values = sorted(values)
+  if not values:
+    return {}
+  result = dict(('p%s' % point,
+                 values[min(len(values) - 1, int(len(values) * point / 100.0))])
+                for point in points)
+  result['max'] = values[-1]
+  return result
+
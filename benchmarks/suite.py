@@ -0,0 +1,265 @@
+#!/usr/bin/python2.5
+#
+# Copyright 2012 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""Benchmark the Snipper handlers against in-memory App Engine services.
+
+Seeds the testbed stubs with --users users of --snippets snippets each,
+spread over the last few weeks, then serves --requests requests of every
+scenario through snipper.application as random users. For each scenario it
+reports latency percentiles and the API calls made per request, counted
+with an apiproxy hook. Finally it runs a whole weekly report, from the cron
+request through every fetch and mail task it queues, and reports how long
+that took and how many digests were mailed.
+
+  python benchmarks/suite.py --users 100 --snippets 50 --output suite.json
+
+Compare two runs with the same flags to see the effect of a change.
+"""
+
+__author__ = 'erichiggins@gmail.com (Eric Higgins)'
+
+import base64
+import datetime
+import json
+import optparse
+import os
+import random
+import sys
+import time
+import urllib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmarks import sdk  # pylint: disable-msg=C6204
+
+
+# Scenario name -> (method, path, params). Paths and params are formatted
+# with the index of the user making the request.
+SCENARIOS = [
+    ('main', ('GET', '/', None)),
+    ('json', ('GET', '/json', None)),
+    ('json_last_week', ('GET', '/json?offset=1', None)),
+    ('add', ('POST', '/add', {'s': 'Benchmark snippet from user %(user)d',
+                              'v': 'bench'})),
+    ('xmpp', ('POST', '/_ah/xmpp/message/chat/',
+              {'from': 'user%(user)d@example.com/bench',
+               'to': 'snipper@appspot.com',
+               'body': 'Chatted a snippet from user %(user)d'})),
+]
+# Weeks the seeded snippets are spread over, ending now.
+SEED_WEEKS = 4
+
+
+def Email(index):
+  return 'user%d@example.com' % index
+
+
+def Seed(users_count, snippets_count):
+  """Store the synthetic users and their snippets.
+
+  Every user is due a weekly report, so the report run mails all of them.
+  """
+  from google.appengine.api import users  # pylint: disable-msg=C6204
+  from google.appengine.ext import db  # pylint: disable-msg=C6204
+  import models  # pylint: disable-msg=C6204
+  for name in (models.SNIPPET_USER_MIGRATION, models.SNIPPET_MIGRATION):
+    models.MigrationState(key_name=name, Done=True).put()
+  now = datetime.datetime.utcnow()
+  span = SEED_WEEKS * 7 * 24 * 60
+  words = ('launch', 'review', 'fixed', 'meeting', 'design', 'migration',
+           'latency', 'oncall', 'interview', 'prototype')
+  for index in xrange(users_count):
+    user = users.User(Email(index))
+    snipper_user = models.SnippetUser(
+        key_name=models.SnippetUserKeyName(user), User=user,
+        next_report_at=now - datetime.timedelta(hours=1))
+    entities = [snipper_user]
+    for n in xrange(snippets_count):
+      entities.append(models.Snippet(
+          parent=snipper_user.key(), User=user, ExtensionVersion='bench',
+          Snippet=u'%s %s number %d' % (random.choice(words),
+                                        random.choice(words), n),
+          DateStamp=now - datetime.timedelta(minutes=random.randint(0, span))))
+    for start in xrange(0, len(entities), 500):
+      db.put(entities[start:start + 500])
+    models.IndexSnippets(user, entities[1:])
+
+
+def Call(application, method, path, params=None, email=None, headers=None):
+  """Serve one request through the WSGI application.
+
+  Returns:
+    The response status line.
+  """
+  from google.appengine.ext import webapp  # pylint: disable-msg=C6204
+  os.environ['USER_EMAIL'] = email or ''
+  os.environ['USER_ID'] = email and str(abs(hash(email))) or ''
+  request = webapp.Request.blank(path)
+  request.method = method
+  for name, value in (headers or {}).items():
+    request.headers[name] = value
+  if method == 'POST':
+    request.environ['CONTENT_TYPE'] = 'application/x-www-form-urlencoded'
+    if isinstance(params, basestring):
+      request.body = params
+    else:
+      request.body = urllib.urlencode(params or {})
+  status = []
+
+  def _StartResponse(response_status, unused_headers, unused_exc_info=None):
+    status.append(response_status)
+  ''.join(application(request.environ, _StartResponse))
+  return status and status[0] or None
+
+
+def RunScenario(application, counter, scenario, requests, users_count):
+  """Serve requests requests of a scenario and summarize them."""
+  method, path, params = scenario
+  latencies = []
+  rpcs = []
+  calls = {}
+  errors = 0
+  for _ in xrange(requests):
+    index = random.randrange(users_count)
+    values = {'user': index}
+    request_params = params and dict(
+        (name, value % values) for name, value in params.items())
+    counter.Reset()
+    started = time.time()
+    status = Call(application, method, path % values, request_params,
+                  email=Email(index))
+    latencies.append((time.time() - started) * 1000)
+    request_calls = counter.Reset()
+    rpcs.append(sum(request_calls.values()))
+    for name, count in request_calls.items():
+      calls[name] = calls.get(name, 0) + count
+    if not status or status[0] not in '23':
+      errors += 1
+  return {
+      'requests': requests,
+      'errors': errors,
+      'latency_ms': sdk.Percentiles(latencies),
+      'rpcs_per_request': sdk.Percentiles(rpcs),
+      'calls_per_request': dict((name, float(count) / requests)
+                                for name, count in calls.items()),
+  }
+
+
+def RunTasks(application, taskqueue_stub):
+  """Run every queued push task, and the tasks they add, until none are left.
+
+  Returns:
+    Dict of task URL -> number of times it was run.
+  """
+  ran = {}
+  while True:
+    pending = False
+    for queue in taskqueue_stub.GetQueues():
+      if queue.get('mode') == 'pull':
+        continue
+      for task in taskqueue_stub.GetTasks(queue['name']):
+        pending = True
+        taskqueue_stub.DeleteTask(queue['name'], task['name'])
+        headers = dict(task.get('headers') or ())
+        headers['X-AppEngine-QueueName'] = queue['name']
+        headers['X-AppEngine-TaskName'] = task['name']
+        path = task['url']
+        Call(application, task.get('method', 'POST'), path,
+             base64.b64decode(task.get('body') or ''), headers=headers)
+        url = path.split('?', 1)[0]
+        ran[url] = ran.get(url, 0) + 1
+    if not pending:
+      return ran
+
+
+def RunWeeklyReport(application, bed, counter):
+  """Run the cron request of the weekly report and every task it causes."""
+  from google.appengine.ext import testbed  # pylint: disable-msg=C6204
+  taskqueue_stub = bed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+  mail_stub = bed.get_stub(testbed.MAIL_SERVICE_NAME)
+  mailed_before = len(mail_stub.get_sent_messages())
+  counter.Reset()
+  started = time.time()
+  Call(application, 'GET', '/report/weekly',
+       headers={'X-AppEngine-Cron': 'true'})
+  tasks = RunTasks(application, taskqueue_stub)
+  return {
+      'total_ms': (time.time() - started) * 1000,
+      'tasks': tasks,
+      'mailed': len(mail_stub.get_sent_messages()) - mailed_before,
+      'rpcs': sum(counter.Reset().values()),
+  }
+
+
+def main():
+  parser = optparse.OptionParser()
+  parser.add_option('--users', type='int', default=50,
+                    help='Synthetic users to seed.')
+  parser.add_option('--snippets', type='int', default=50,
+                    help='Snippets seeded for each user.')
+  parser.add_option('--requests', type='int', default=100,
+                    help='Requests served for each scenario.')
+  parser.add_option('--scenario', action='append',
+                    help='Only run these scenarios.')
+  parser.add_option('--no-report', action='store_true',
+                    help='Skip the weekly report run.')
+  parser.add_option('--seed', type='int', default=0,
+                    help='Random seed for the data set and request mix.')
+  parser.add_option('--output', help='Write the results as JSON to a file.')
+  options, _ = parser.parse_args()
+
+  random.seed(options.seed)
+  sdk.SetupPath()
+  bed = sdk.ActivateStubs(user_email=None)
+  counter = sdk.RpcCounter()
+  counter.Install()
+  import snipper  # pylint: disable-msg=C6204
+
+  started = time.time()
+  Seed(options.users, options.snippets)
+  results = {
+      'users': options.users,
+      'snippets_per_user': options.snippets,
+      'seed_ms': (time.time() - started) * 1000,
+      'scenarios': {},
+  }
+  for name, scenario in SCENARIOS:
+    if options.scenario and name not in options.scenario:
+      continue
+    summary = RunScenario(snipper.application, counter, scenario,
+                          options.requests, options.users)
+    results['scenarios'][name] = summary
+    print '%-16s p50 %7.1fms  p99 %7.1fms  rpcs p50 %3d  errors %d' % (
+        name, summary['latency_ms']['p50'], summary['latency_ms']['p99'],
+        summary['rpcs_per_request']['p50'], summary['errors'])
+  # Send the replies queued by the scenarios before the report is timed.
+  from google.appengine.ext import testbed  # pylint: disable-msg=C6204
+  results['background_tasks'] = RunTasks(
+      snipper.application, bed.get_stub(testbed.TASKQUEUE_SERVICE_NAME))
+  if not options.no_report:
+    results['weekly_report'] = RunWeeklyReport(snipper.application, bed,
+                                               counter)
+    print 'weekly report     %7.1fms  %d mailed  %d rpcs' % (
+        results['weekly_report']['total_ms'],
+        results['weekly_report']['mailed'], results['weekly_report']['rpcs'])
+  bed.deactivate()
+
+  if options.output:
+    open(options.output, 'w').write(
+        json.dumps(results, indent=2, sort_keys=True) + '\n')
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,101 @@
+#!/usr/bin/python2.5
+#
+# Copyright 2012 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""Load test the chat reply outbox against a local XMPP stand-in.
+
+Simulates the weekly deadline by queueing confirmations for many users,
+most of which share a handful of success messages, and reports how many
+sends they were grouped into under the rate limit.
+
+  python benchmarks/xmpp_load.py --replies 5000 --rate 50 --fail-rate 0.02
+"""
+
+__author__ = 'erichiggins@gmail.com (Eric Higgins)'
+
+import json
+import optparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmarks import sdk  # pylint: disable-msg=C6204
+sdk.SetupPath()
+import chat  # pylint: disable-msg=C6204
+import mailer
+import outbox
+
+
+def MakeReplies(count, invalid):
+  """Return count synthetic replies, some to invalid JIDs."""
+  replies = []
+  for i in xrange(count):
+    jid = 'user%d@example.com/chat' % i
+    if i < invalid:
+      jid = 'nobody%d@example.com' % i
+    replies.append({'jid': jid, 'body': random.choice(chat._SUCCESS_MSGS)})
+  return replies
+
+
+def main():
+  parser = optparse.OptionParser()
+  parser.add_option('--replies', type='int', default=1000)
+  parser.add_option('--rate', type='float', default=outbox.RATE,
+                    help='Sends per second allowed by the rate limiter.')
+  parser.add_option('--burst', type='int', default=outbox.BURST)
+  parser.add_option('--batch-size', type='int', default=outbox.BATCH_SIZE)
+  parser.add_option('--fail-rate', type='float', default=0.0,
+                    help='Share of JIDs the stand-in fails with a retry.')
+  parser.add_option('--invalid', type='int', default=0,
+                    help='Number of replies to invalid JIDs.')
+  parser.add_option('--backoff', type='float', default=0.05,
+                    help='Base retry backoff in seconds.')
+  parser.add_option('--output', help='Write the results as JSON to a file.')
+  options, _ = parser.parse_args()
+
+  replies = MakeReplies(options.replies, options.invalid)
+  transport = outbox.LocalTransport(
+      options.fail_rate,
+      invalid=[reply['jid'] for reply in replies[:options.invalid]])
+  source = mailer.ListSource(replies)
+  dispatcher = outbox.Dispatcher(
+      source, transport, outbox.RateLimiter(options.rate, options.burst),
+      batch_size=options.batch_size, base_backoff=options.backoff)
+  # Retried replies only become leasable after their backoff. Like the
+  # retry dispatchers OutboxWorker starts, run again when they are.
+  dispatcher.Run()
+  retries = dispatcher.PendingRetries()
+  while retries:
+    time.sleep(max(0, retries[0] - time.time()))
+    dispatcher.Run()
+    retries = dispatcher.PendingRetries()
+
+  results = dispatcher.stats.AsDict()
+  results.update({'replies': options.replies,
+                  'rate': options.rate,
+                  'batch_size': options.batch_size,
+                  'fail_rate': options.fail_rate,
+                  'invalid': options.invalid,
+                  'transport_calls': len(transport.sent)})
+  output = json.dumps(results, indent=2, sort_keys=True)
+  print output
+  if options.output:
+    open(options.output, 'w').write(output + '\n')
+
+
+if __name__ == '__main__':
+  main()
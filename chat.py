@@ -23,13 +23,11 @@ import logging
 from google.appengine.api import capabilities
 from google.appengine.api import memcache
 from google.appengine.api import users
-from google.appengine.api import xmpp
-from google.appengine.ext import deferred
 from google.appengine.ext import ereporter
 from google.appengine.ext import webapp
-from google.appengine.ext.webapp.util import run_wsgi_app
 import models
-import pytz
+import outbox
+import util
 
 
 ereporter.register_logger()
@@ -42,6 +40,7 @@ _HELP_TEMPLATE = ('Snipper Help\n'
                   '*status*: Print the status of Snipper.\n'
                   '*whoami*: See who you are..\n'
                   '*emailme*: Get the link to send snippet emails.\n'
+                  '*search:* terms: Find your snippets with these words.\n'
                   '\nView your snippets at http://go/snipper'
                  )
 _STATUS_TEMPLATE = ('Snipper status: %(status)s\n'
@@ -84,10 +83,9 @@ def GetHelp(user):
 
 def GetLastSnippet(user):
   """Return the last successfully recorded snippet for the user."""
-  last = models.Snippet.gql('WHERE User=:1 ORDER BY DateStamp DESC',
-                            user).get()
+  last = models.QuerySnippets(user, limit=1, newest_first=True)
   if last:
-    return last.Snippet
+    return last[0].Snippet
   else:
     return 'Sorry, I could not find any previous snippets for you.'
 
@@ -117,6 +115,18 @@ def SendUserSnippets(user):
   return 'To email your snippets to %s, visit: %s' % (user.email(), url)
 
 
+_SEARCH_RESULTS = 10
+
+
+def SearchUserSnippets(user, query):
+  """Return the best matching snippets for a search by chat."""
+  results, _ = models.SearchSnippets(user, query, limit=_SEARCH_RESULTS)
+  if not results:
+    return 'Sorry, none of your snippets match "%s".' % query
+  return '\n'.join('%s %s' % (s.DateStamp.strftime('%Y-%m-%d'), s.Snippet)
+                   for s in results)
+
+
 _CHAT_COMMANDS = {
     'help': GetHelp,
     'last': GetLastSnippet,
@@ -124,41 +134,58 @@ _CHAT_COMMANDS = {
     'whoami': GetUserInfo,
     'emailme': SendUserSnippets,
 }
+# Commands followed by an argument, e.g. "search: launch review". The colon
+# keeps snippets that start with the same word from running the command.
+_CHAT_ARG_COMMANDS = {
+    'search:': SearchUserSnippets,
+}
 
 
-def GetNextSuccessMsg(username=None, cheeky=False):
+def StartSuccessMsg(username=None):
+  """Start advancing the user's success message index.
+
+  The cheeky and normal messages share the index, so this can run before it
+  is known which of them the user gets.
+
+  Returns:
+    memcache RPC, pass it to GetNextSuccessMsg.
+  """
+  return memcache.Client().incr_async('next_success_msg_index',
+                                      initial_value=0, namespace=username)
+
+
+def GetNextSuccessMsg(username=None, cheeky=False, rpc=None):
   """Return the next success message."""
-  key = 'next_success_msg_index'
   if cheeky:
     messages = _CHEEKY_MSGS
   else:
     messages = _SUCCESS_MSGS
-  try:
-    index = int(memcache.get(key, namespace=username))
-  except TypeError:
-    index = 0
-  if index + 1 >= len(messages):
-    memcache.set(key, 0, namespace=username)  # Reached the end, reset to 0.
-  else:
-    memcache.incr(key, initial_value=0, namespace=username)  # Increment by 1.
-
-  return messages[index]
+  if rpc is None:
+    rpc = StartSuccessMsg(username)
+  # A single atomic increment, the index wraps around the messages.
+  index = rpc.get_result() or 1
+  return messages[(index - 1) % len(messages)]
 
 
 class XmppHandler(webapp.RequestHandler):
   """Handle XMPP (Google Talk) requests."""
 
   def Reply(self, user, message):
-    try:
-      xmpp.send_message(user, message)
-    except xmpp.Error, xmpp.NoBodyError:
-      logging.exception('Caught error when trying to send.')
-      # Create a deferred call.
-      deferred.defer(xmpp.send_message, jids=user, body=message)
+    """Queue a reply, it is sent by the outbox dispatcher."""
+    self.pending_replies.append(outbox.Reply(user, message))
 
   # pylint: disable-msg=C6409
   def post(self):
     """Get a chat, add to datastore."""
+    self.pending_replies = []
+    try:
+      self.HandleMessage()
+    finally:
+      for reply in self.pending_replies:
+        reply.Wait()
+
+  def HandleMessage(self):
+    """Save the snippets or run the command in a chat message."""
     err_msg = ':( %s'
     msg_from = self.request.get('from', '')
     msg_body = self.request.get('body', '').strip()
@@ -170,23 +197,15 @@ class XmppHandler(webapp.RequestHandler):
 
       # Try to create a snippetUser object.
       user = users.User(user_address)
+      # The success message is looked up while the user is loaded and the
+      # snippets are written.
+      success_rpc = StartSuccessMsg(user.nickname())
       snipper_user = models.GetSnippetUser(user)
       if not snipper_user:
         logging.debug('Could not create a User object.')
         self.Reply(msg_from, err_msg)
         return
 
-      # Disable the confirmation message for users that don't want it.
-      if snipper_user.send_confirm is False:
-        success_msg = ''
-      else:
-        # Check for April 1st, display cheeky messages :).
-        now = datetime.datetime.now(pytz.timezone(snipper_user.timezone))
-        cheeky = False
-        if snipper_user.cheeky_confirm or (now.month == 4 and now.day == 1):
-          cheeky = True
-        success_msg = GetNextSuccessMsg(user.nickname(), cheeky)
-
       # Handle commands sent by chat.
       cmd = msg_body.lower()
       if cmd in _CHAT_COMMANDS:
@@ -194,30 +213,37 @@ class XmppHandler(webapp.RequestHandler):
         # Send the replies back to the user then quit.
         self.Reply(msg_from, replies)
         return
+      for prefix, command in _CHAT_ARG_COMMANDS.items():
+        args = msg_body[len(prefix):].strip()
+        if cmd.startswith(prefix) and args:
+          self.Reply(msg_from, command(user, args))
+          return
 
       # Convert multi-line snippets into a list.
       snippets = msg_body.splitlines()
-      # Try to save each snippet, and store the result in the list.
-      results, errors = zip(*[models.SaveSnippet(user, 'xmpp', s)
-                              for s in snippets])
+      # Save all snippets in one batch, and store the result in the list.
+      save = models.SaveSnippetsAsync(user, 'xmpp', snippets)
+
+      # Disable the confirmation message for users that don't want it.
+      if snipper_user.send_confirm is False:
+        success_msg = ''
+      else:
+        # Check for April 1st, display cheeky messages :).
+        now = datetime.datetime.now(util.GetTimezone(snipper_user.timezone))
+        cheeky = False
+        if snipper_user.cheeky_confirm or (now.month == 4 and now.day == 1):
+          cheeky = True
+        success_msg = GetNextSuccessMsg(user.nickname(), cheeky, success_rpc)
 
+      results, errors = zip(*save.GetResult())
       if False not in results:
         message = success_msg
       else:
         message = err_msg % filter(None, errors)[0]  # Return the first error.
         logging.debug('%s said "%s"', msg_from, msg_body)
 
+      # Reply as soon as the snippets are stored, then update the week bucket,
+      # search index and caches.
       if message:
         self.Reply(msg_from, message)
-
-
-application = webapp.WSGIApplication([('/_ah/xmpp/message/', XmppHandler),
-                                      ('/_ah/xmpp/message/chat/', XmppHandler)],
-                                     debug=True)
-
-
-def main():
-  run_wsgi_app(application)
-
-if __name__ == '__main__':
-  main()
+      save.Finish()
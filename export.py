@@ -0,0 +1,236 @@
+#!/usr/bin/python2.5
+#
+# Copyright 2012 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""Export a user's whole snippet history as NDJSON or CSV.
+
+/export walks the user's snippets by cursor, BATCH_SIZE at a time, and
+formats every batch as soon as it is read, so only one batch of entities is
+held at once. The formatted response is buffered until the handler returns,
+though, so it is limited to MAX_SYNC_SNIPPETS. Users with more snippets use
+/export?async=1, which writes the export to the blobstore from a chain of
+tasks that can be resumed, then download it from /export/download.
+"""
+
+__author__ = 'erichiggins@gmail.com (Eric Higgins)'
+
+import csv
+import logging
+import os
+import StringIO
+import time
+os.environ['DJANGO_SETTINGS_MODULE'] = 'appengine_config'
+from google.appengine import dist  # pylint: disable-msg=C6204
+dist.use_library('django', '1.1')
+from django.utils import simplejson  # pylint: disable-msg=C6204
+from google.appengine.api import files
+from google.appengine.api import taskqueue
+from google.appengine.api import users
+from google.appengine.ext import blobstore
+from google.appengine.ext import db
+from google.appengine.ext import webapp
+from google.appengine.ext.webapp import blobstore_handlers
+from google.appengine.ext.webapp import util as webapp_util
+import models
+
+
+BATCH_SIZE = 500
+# Most snippets /export returns in the response, which webapp buffers whole.
+MAX_SYNC_SNIPPETS = 5000
+EXPORT_QUEUE = 'default'
+# Seconds an export task writes for before it hands over to the next task.
+TASK_DEADLINE = 5 * 60
+FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+CSV_COLUMNS = ('date', 'snippet', 'version', 'key')
+
+
+def FormatBatch(snippets, export_format, header=False):
+  """Return a batch of snippets as a UTF-8 NDJSON or CSV string."""
+  rows = [{'date': s.DateStamp.strftime('%Y-%m-%dT%H:%M:%SZ'),
+           'snippet': s.Snippet or u'', 'version': s.ExtensionVersion or u'',
+           'key': str(s.key())} for s in snippets]
+  if export_format == 'ndjson':
+    # NDJSON has no header.
+    return ''.join(simplejson.dumps(row) + '\n' for row in rows)
+  out = StringIO.StringIO()
+  writer = csv.writer(out)
+  if header:
+    writer.writerow(CSV_COLUMNS)
+  for row in rows:
+    writer.writerow([row[column].encode('utf-8') for column in CSV_COLUMNS])
+  return out.getvalue()
+
+
+def _Filename(user, export_format):
+  return 'snippets-%s.%s' % (user.nickname(), export_format)
+
+
+class ExportHandler(webapp.RequestHandler):
+  """Export the current user's snippets, e.g. /export?format=csv."""
+
+  @webapp_util.login_required
+  def get(self):  # pylint: disable-msg=C6409
+    user = users.get_current_user()
+    export_format = self.request.get('format', 'ndjson')
+    if export_format not in FORMATS:
+      return self.error(400)
+    if self.request.get('async'):
+      return self.StartExport(user, export_format)
+
+    self.response.headers['Content-Type'] = FORMATS[export_format]
+    self.response.headers['Content-Disposition'] = (
+        'attachment; filename="%s"' % _Filename(user, export_format))
+    self.response.out.write(FormatBatch([], export_format, header=True))
+    count = 0
+    for snippets, _ in models.IterSnippetBatches(user, batch_size=BATCH_SIZE):
+      count += len(snippets)
+      if count > MAX_SYNC_SNIPPETS:
+        self.response.clear()
+        self.response.set_status(413)
+        self.response.headers['Content-Type'] = 'text/plain'
+        del self.response.headers['Content-Disposition']
+        self.response.out.write(
+            'You have more than %d snippets, export them with '
+            '/export?async=1&format=%s instead.\n' %
+            (MAX_SYNC_SNIPPETS, export_format))
+        return
+      self.response.out.write(FormatBatch(snippets, export_format))
+
+  def StartExport(self, user, export_format):
+    """Start an export to the blobstore and return its status URL."""
+    mime_type = FORMATS[export_format]
+    export = models.SnippetExport(
+        parent=models.SnippetUserKey(user), User=user, Format=export_format,
+        FileName=files.blobstore.create(
+            mime_type=mime_type,
+            _blobinfo_uploaded_filename=_Filename(user, export_format)))
+    export.put()
+    taskqueue.Task(url='/export/worker',
+                   params={'key': str(export.key())}).add(
+                       queue_name=EXPORT_QUEUE)
+    self.response.headers['Content-Type'] = 'application/json'
+    self.response.out.write(simplejson.dumps(_StatusJson(export)))
+
+
+def _StatusJson(export):
+  status = {'id': str(export.key()), 'status': export.Status,
+            'count': export.Count, 'format': export.Format}
+  if export.BlobKey:
+    status['download'] = '/export/download?id=%s' % export.key()
+  return status
+
+
+def _GetUserExport(export_id, user):
+  """Return the user's SnippetExport with a key string, or None."""
+  try:
+    export = models.SnippetExport.get(export_id)
+  except (db.BadKeyError, db.KindError):
+    return None
+  if export is None or export.User != user:
+    return None
+  return export
+
+
+class ExportWorker(webapp.RequestHandler):
+  """Task that appends batches to an export file until time runs out.
+
+  The position is saved after every batch, so a failed task is retried from
+  the last saved batch. Every write has a sequence key made of the snippet
+  count after it, so the file rejects a batch that a failed task already
+  wrote, and the header is only written once.
+  """
+
+  def post(self):  # pylint: disable-msg=C6409
+    export = models.SnippetExport.get(self.request.get('key'))
+    if export is None or export.Status != 'running':
+      return
+    stop_at = time.time() + TASK_DEADLINE
+    position = None
+    if export.Reader:
+      position = (export.Reader, export.Cursor)
+    elif not export.Count:
+      self.Write(export, FormatBatch([], export.Format, header=True), 0)
+    # Reader is None once every batch was written.
+    batches = []
+    if position or not export.Count:
+      batches = models.IterSnippetBatches(export.User, batch_size=BATCH_SIZE,
+                                          position=position)
+    for snippets, position in batches:
+      export.Count += len(snippets)
+      self.Write(export, FormatBatch(snippets, export.Format), export.Count)
+      export.Reader, export.Cursor = position or (None, None)
+      export.put()
+      if position and time.time() >= stop_at:
+        self.Continue(export)
+        return
+    try:
+      files.finalize(export.FileName)
+    except files.FinalizationError:
+      # Finalized by a task that failed before saving the export.
+      pass
+    export.BlobKey = str(files.blobstore.get_blob_key(export.FileName))
+    export.Status = 'done'
+    export.put()
+    logging.info('Exported %d snippets of %s.', export.Count, export.User)
+
+  def Write(self, export, data, count):
+    """Append data ending at the count'th snippet, unless it was already."""
+    if data:
+      fp = files.open(export.FileName, 'a')
+      try:
+        fp.write(data, sequence_key='%012d' % count)
+      except files.SequenceKeyOutOfOrderError:
+        logging.info('Batch up to %d of %s was already written.', count,
+                     export.key())
+      finally:
+        fp.close()
+
+  def Continue(self, export):
+    """Add the next task, named after the position, so a retry adds none."""
+    task = taskqueue.Task(url='/export/worker',
+                          params={'key': str(export.key())},
+                          name='export-%s-%d' % (export.key(), export.Count))
+    try:
+      task.add(queue_name=EXPORT_QUEUE)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+      pass
+
+
+class ExportStatusHandler(webapp.RequestHandler):
+  """Report the progress of an export started with /export?async=1."""
+
+  @webapp_util.login_required
+  def get(self):  # pylint: disable-msg=C6409
+    export = _GetUserExport(self.request.get('id'), users.get_current_user())
+    if export is None:
+      return self.error(404)
+    self.response.headers['Content-Type'] = 'application/json'
+    self.response.out.write(simplejson.dumps(_StatusJson(export)))
+
+
+class ExportDownloadHandler(blobstore_handlers.BlobstoreDownloadHandler):
+  """Send a finished export to the user that started it."""
+
+  @webapp_util.login_required
+  def get(self):  # pylint: disable-msg=C6409
+    user = users.get_current_user()
+    export = _GetUserExport(self.request.get('id'), user)
+    if export is None or not export.BlobKey:
+      return self.error(404)
+    self.send_blob(blobstore.BlobKey(export.BlobKey),
+                   save_as=_Filename(user, export.Format))
@@ -23,6 +23,10 @@ snipper.Snippets = function() {
    * Current week offset (0=this week, 1=last week, etc.).
    */
   var offset = 0;
+  /**
+   * Number of weeks to request at once when paging back through history.
+   */
+  var prefetchWeeks = 4;
   var snippets = {};
   /**
    * Map the UI elements.
@@ -41,14 +45,27 @@ snipper.Snippets = function() {
    * Load the snippets and dates from the JSON object, then refresh the UI.
    */
   var load = function(snippetObj) {
-    dates[offset] = snippetObj.dates;
-    snippets[offset] = [];
-    for (var i = 0, len = snippetObj.snippets.length; i < len; i += 1) {
-      snippets[offset].push(snippetObj.snippets[i].text);
+    if (snippetObj.weeks) {
+      for (var i = 0, len = snippetObj.weeks.length; i < len; i += 1) {
+        loadWeek(snippetObj.weeks[i].offset, snippetObj.weeks[i]);
+      }
+    } else {
+      loadWeek(offset, snippetObj);
     }
     refresh();
   };
 
+  /**
+   * Store the snippets and dates of a single week.
+   */
+  var loadWeek = function(weekOffset, weekObj) {
+    dates[weekOffset] = weekObj.dates;
+    snippets[weekOffset] = [];
+    for (var i = 0, len = weekObj.snippets.length; i < len; i += 1) {
+      snippets[weekOffset].push(weekObj.snippets[i].text);
+    }
+  };
+
   /**
    * Refresh the UI. Show/Hide date links, change the date, display the
    * snippets.
@@ -78,7 +95,11 @@ snipper.Snippets = function() {
     }
     ui.snippets.innerHTML = 'Loading...';
     ui.snippets.disabled = true;
+    // Older weeks don't change, so fetch several of them in one request.
     var url = urls.fetch + '?offset=' + offset;
+    if (offset > 0) {
+      url += '&weeks=' + prefetchWeeks;
+    }
     ajax.open('GET', url, true);
     ajax.send(null);
     return false;
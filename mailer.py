@@ -0,0 +1,427 @@
+#!/usr/bin/python2.5
+#
+# Copyright 2012 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""Batched dispatch of the weekly snippet digest emails.
+
+Digests are added to a pull queue by the report workers. Dispatcher tasks
+lease them in batches, send them with bounded concurrency, retry transient
+failures with exponential backoff and keep a DeadLetter record of digests
+that can not be delivered.
+"""
+
+__author__ = 'erichiggins@gmail.com (Eric Higgins)'
+
+import calendar
+import hashlib
+import heapq
+import logging
+import pickle
+import Queue
+import smtplib
+import socket
+import threading
+import time
+from email.MIMEText import MIMEText
+from google.appengine.api import mail
+from google.appengine.api import taskqueue
+from google.appengine.ext import db
+from google.appengine.runtime import apiproxy_errors
+from google.appengine.runtime import DeadlineExceededError
+
+
+DIGEST_QUEUE = 'snippet-digest-queue'
+DISPATCH_QUEUE = 'snippet-mail-queue'
+SENDER = 'snipper@google.com'
+# Number of dispatcher tasks started for a batch of digests.
+DISPATCHERS = 4
+BATCH_SIZE = 50
+MAX_ATTEMPTS = 5
+# Seconds before the first retry, doubled on every attempt after that.
+BASE_BACKOFF = 30
+MAX_BACKOFF = 60 * 60
+LEASE_SECONDS = 5 * 60
+# Seconds covered by one set of dispatcher task names.
+DISPATCH_WINDOW = 60
+
+
+class Error(Exception):
+  """Base class for mail dispatch errors."""
+
+
+class TransientError(Error):
+  """The digest could not be sent right now, but may be sent later."""
+
+
+class PermanentError(Error):
+  """The digest can never be sent, e.g. the address is invalid."""
+
+
+class DeadLetter(db.Model):
+  """Datastore model for digests that could not be delivered."""
+  Email = db.StringProperty()
+  Subject = db.StringProperty(indexed=False)
+  Body = db.TextProperty()
+  Error = db.TextProperty()
+  Attempts = db.IntegerProperty(default=0)
+  DateStamp = db.DateTimeProperty(auto_now_add=True)
+
+
+def FormatDigest(digest):
+  """Return the (subject, body) of the email for a digest dict."""
+  subject = "%s's snippets since %s" % (digest['user'], digest['datestamp'])
+  body = 'Last week (%s)\n%s\n\n' % (digest['datestamp'], digest['snippets'])
+  return subject, body
+
+
+def RecordDeadLetter(digest, error, attempts):
+  """Store a digest that will not be retried again."""
+  subject, body = FormatDigest(digest)
+  logging.error('Giving up on the digest for %s after %d attempts: %s',
+                digest.get('email'), attempts, error)
+  DeadLetter(Email=digest.get('email'), Subject=subject, Body=body,
+             Error=str(error), Attempts=attempts).put()
+
+
+class AppEngineTransport(object):
+  """Send email with the App Engine mail API."""
+
+  def Send(self, sender, to, subject, body):
+    try:
+      mail.send_mail(sender=sender, to=to, subject=subject, body=body)
+    except (mail.InvalidEmailError, mail.InvalidSenderError,
+            mail.MissingRecipientsError, mail.MissingBodyError), err:
+      raise PermanentError(err)
+    except (apiproxy_errors.DeadlineExceededError, DeadlineExceededError,
+            apiproxy_errors.ApplicationError, mail.Error), err:
+      raise TransientError(err)
+
+
+class SmtpTransport(object):
+  """Send email to an SMTP server, such as a local stand-in for load tests.
+
+  Each thread keeps its own connection, so one transport may be shared by a
+  concurrent Dispatcher.
+  """
+
+  def __init__(self, host='localhost', port=25):
+    self.host = host
+    self.port = port
+    self._local = threading.local()
+
+  def _Connection(self):
+    connection = getattr(self._local, 'connection', None)
+    if connection is None:
+      connection = smtplib.SMTP(self.host, self.port)
+      self._local.connection = connection
+    return connection
+
+  def Send(self, sender, to, subject, body):
+    message = MIMEText(body.encode('utf-8'), 'plain', 'utf-8')
+    message['Subject'] = subject
+    message['From'] = sender
+    message['To'] = to
+    try:
+      self._Connection().sendmail(sender, [to], message.as_string())
+    except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused), err:
+      raise PermanentError(err)
+    except (smtplib.SMTPException, socket.error), err:
+      self._local.connection = None
+      raise TransientError(err)
+
+
+class Job(object):
+  """A leased payload, with the number of times it has been attempted."""
+
+  def __init__(self, payload, attempts, handle=None):
+    self.payload = payload
+    self.attempts = attempts
+    self.handle = handle
+
+
+class PullQueueSource(object):
+  """Lease pickled payloads, digests by default, from a pull queue."""
+
+  def __init__(self, queue_name=DIGEST_QUEUE, lease_seconds=LEASE_SECONDS):
+    self.queue = taskqueue.Queue(queue_name)
+    self.lease_seconds = lease_seconds
+
+  def Lease(self, count):
+    tasks = self.queue.lease_tasks(self.lease_seconds, count)
+    return [Job(pickle.loads(task.payload), task.retry_count + 1, task)
+            for task in tasks]
+
+  def Done(self, jobs):
+    if jobs:
+      self.queue.delete_tasks([job.handle for job in jobs])
+
+  def Retry(self, job, delay):
+    # The task becomes leasable again once the new lease runs out.
+    self.queue.modify_task_lease(job.handle, int(delay))
+
+
+class ListSource(object):
+  """Serve payloads from memory, for load tests and local runs."""
+
+  def __init__(self, payloads):
+    self._ready = [(0, i, payload, 1) for i, payload in enumerate(payloads)]
+    self._lock = threading.Lock()
+    self._count = len(payloads)
+    self.done = []
+
+  def Lease(self, count):
+    now = time.time()
+    jobs = []
+    self._lock.acquire()
+    try:
+      while self._ready and self._ready[0][0] <= now and len(jobs) < count:
+        _, _, payload, attempts = heapq.heappop(self._ready)
+        jobs.append(Job(payload, attempts))
+    finally:
+      self._lock.release()
+    return jobs
+
+  def Done(self, jobs):
+    self.done.extend(jobs)
+
+  def Retry(self, job, delay):
+    self._lock.acquire()
+    try:
+      self._count += 1
+      heapq.heappush(self._ready, (time.time() + delay, self._count,
+                                   job.payload, job.attempts + 1))
+    finally:
+      self._lock.release()
+
+  def Pending(self):
+    return len(self._ready)
+
+
+class DispatchStats(object):
+  """Counts of what a Dispatcher run did, and its throughput."""
+
+  def __init__(self):
+    self.sent = 0
+    self.retried = 0
+    self.dead = 0
+    self.batches = 0
+    self.started = time.time()
+    self.finished = None
+
+  def Elapsed(self):
+    return (self.finished or time.time()) - self.started
+
+  def Throughput(self):
+    """Return the number of digests sent per second."""
+    elapsed = self.Elapsed()
+    return elapsed and self.sent / elapsed
+
+  def AsDict(self):
+    return {'sent': self.sent, 'retried': self.retried, 'dead': self.dead,
+            'batches': self.batches, 'seconds': round(self.Elapsed(), 3),
+            'per_second': round(self.Throughput(), 3)}
+
+
+class Dispatcher(object):
+  """Lease digests in batches and send them with bounded concurrency.
+
+  Attributes:
+    source: Where digests are leased from, e.g. a PullQueueSource.
+    transport: Object with a Send(sender, to, subject, body) method.
+    batch_size: Number of digests leased at a time.
+    concurrency: Number of digests sent at once. App Engine instances can not
+      start threads, so there this is 1 and parallelism comes from running
+      several dispatcher tasks.
+    max_attempts: Attempts before a digest is moved to the dead letters.
+    base_backoff: Seconds before the first retry, doubled for each attempt.
+    dead_letter: Callable taking (digest, error, attempts).
+  """
+
+  def __init__(self, source, transport, batch_size=BATCH_SIZE, concurrency=1,
+               max_attempts=MAX_ATTEMPTS, base_backoff=BASE_BACKOFF,
+               dead_letter=RecordDeadLetter, sender=SENDER):
+    self.source = source
+    self.transport = transport
+    self.batch_size = batch_size
+    self.concurrency = concurrency
+    self.max_attempts = max_attempts
+    self.base_backoff = base_backoff
+    self.dead_letter = dead_letter
+    self.sender = sender
+    self.stats = DispatchStats()
+    # Epoch seconds at which the jobs this dispatcher retried are leasable.
+    self.retry_times = set()
+    self._lock = threading.Lock()
+
+  def Backoff(self, attempts):
+    """Return the seconds to wait before the next attempt."""
+    return min(self.base_backoff * 2 ** (attempts - 1), MAX_BACKOFF)
+
+  def PendingRetries(self):
+    """Return the times of retries that were not leasable before Run ended.
+
+    Nothing else leases those jobs, so a dispatcher has to be started for
+    each of these times.
+    """
+    return sorted(when for when in self.retry_times
+                  if when > self.stats.finished)
+
+  def Run(self, deadline=None):
+    """Send digests until the source is empty or the deadline passes.
+
+    Args:
+      deadline: Seconds to run for, or None to run until the source is empty.
+
+    Returns:
+      True if the source was drained, False if the deadline was reached.
+    """
+    stop_at = deadline and time.time() + deadline
+    while not stop_at or time.time() < stop_at:
+      jobs = self.source.Lease(self.batch_size)
+      if not jobs:
+        self.stats.finished = time.time()
+        return True
+      self.stats.batches += 1
+      self.SendBatch(jobs)
+    self.stats.finished = time.time()
+    return False
+
+  def SendBatch(self, jobs):
+    """Send a batch of jobs, then delete the ones that are finished."""
+    if self.concurrency <= 1:
+      finished = [job for job in jobs if self._Send(job)]
+    else:
+      finished = []
+      pending = Queue.Queue()
+      for job in jobs:
+        pending.put(job)
+
+      def _Worker():
+        while True:
+          try:
+            job = pending.get_nowait()
+          except Queue.Empty:
+            return
+          if self._Send(job):
+            self._lock.acquire()
+            finished.append(job)
+            self._lock.release()
+      threads = [threading.Thread(target=_Worker)
+                 for _ in xrange(min(self.concurrency, len(jobs)))]
+      for thread in threads:
+        thread.start()
+      for thread in threads:
+        thread.join()
+    self.source.Done(finished)
+
+  def _Count(self, name):
+    self._lock.acquire()
+    setattr(self.stats, name, getattr(self.stats, name) + 1)
+    self._lock.release()
+
+  def _Send(self, job):
+    """Send one job. Returns True if the job is finished with."""
+    digest = job.payload
+    subject, body = FormatDigest(digest)
+    try:
+      self.transport.Send(self.sender, digest['email'], subject, body)
+    except PermanentError, err:
+      self.dead_letter(digest, err, job.attempts)
+      self._Count('dead')
+      return True
+    except TransientError, err:
+      if job.attempts >= self.max_attempts:
+        self.dead_letter(digest, err, job.attempts)
+        self._Count('dead')
+        return True
+      delay = self.Backoff(job.attempts)
+      logging.info('Sending to %s failed (%s), retrying in %ds.',
+                   digest['email'], err, delay)
+      self.source.Retry(job, delay)
+      self._lock.acquire()
+      self.retry_times.add(time.time() + delay)
+      self._lock.release()
+      self._Count('retried')
+      return False
+    self._Count('sent')
+    return True
+
+
+def DigestTaskName(user, report_at):
+  """Return the task name of a user's weekly digest for a reset."""
+  return 'digest-%s-%d' % (hashlib.md5(user.email()).hexdigest(),
+                           calendar.timegm(report_at.utctimetuple()))
+
+
+def QueueDigests(digests, dispatchers=DISPATCHERS):
+  """Add digests to the pull queue and make sure dispatchers are running.
+
+  Args:
+    digests: List of digest dicts with user, email, datestamp and snippets,
+      and optionally the task name, which makes adding a digest twice fail.
+    dispatchers: Number of dispatcher tasks to start.
+  """
+  queue = taskqueue.Queue(DIGEST_QUEUE)
+  tasks = [taskqueue.Task(payload=pickle.dumps(digest), method='PULL',
+                          name=digest.get('name'))
+           for digest in digests]
+  # The task queue API takes at most 100 tasks per call.
+  for i in xrange(0, len(tasks), 100):
+    try:
+      queue.add(tasks[i:i + 100])
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+      # The rest of the batch is still added.
+      logging.info('Skipped digests that were already queued.')
+  StartDispatchers(dispatchers)
+
+
+def StartDispatchers(count=DISPATCHERS, at=None, url='/report/mail',
+                     queue_name=DISPATCH_QUEUE, prefix='mail-dispatch',
+                     window=DISPATCH_WINDOW):
+  """Start dispatcher tasks, at most count of them per window of time.
+
+  Tasks are named after the window containing at, so the many workers that
+  queue payloads in the same window share the same dispatchers. They run at
+  the end of the window, after every payload queued in it was added, so a
+  dispatcher that already ran never leaves a later payload behind.
+
+  Args:
+    count: Number of dispatchers for the window.
+    at: Epoch seconds the payloads become leasable, by default now.
+    url: URL of the dispatcher task.
+    queue_name: Push queue of the dispatcher tasks.
+    prefix: Prefix of the task names.
+    window: Seconds covered by one set of task names.
+  """
+  now = time.time()
+  window_number = int((at or now) // window)
+  countdown = max(0, (window_number + 1) * window - now)
+  for i in xrange(count):
+    task = taskqueue.Task(url=url, countdown=countdown,
+                          name='%s-%d-%d' % (prefix, window_number, i))
+    try:
+      task.add(queue_name=queue_name)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+      pass
+
+
+def StartRetryDispatchers(dispatcher, **kwargs):
+  """Start a dispatcher for every window with retries of a finished run."""
+  window = kwargs.get('window', DISPATCH_WINDOW)
+  started = set()
+  for when in dispatcher.PendingRetries():
+    if int(when // window) not in started:
+      started.add(int(when // window))
+      StartDispatchers(1, at=when, **kwargs)
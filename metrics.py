@@ -0,0 +1,322 @@
+#!/usr/bin/python2.5
+#
+# Copyright 2012 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""Per-handler request, API call and memcache metrics.
+
+MetricsMiddleware times every request, and apiproxy hooks count the API
+calls made while it runs, with their latency, by handler, service and
+method. Memcache gets of the cached snippet weeks and SnippetUsers are
+counted as hits and misses.
+
+Counts are kept on the instance and added to memcache at most once per
+FLUSH_INTERVAL, into counters for the current ROLLING_WINDOW. /metrics sums
+the last ROLLING_WINDOWS windows of every instance and serves them, with
+the cache stats of /cachestats, in the Prometheus text format. The sums go
+down as old windows drop out, so they are gauges with a window label rather
+than counters, and the latency buckets are gauges to read directly or pass
+to histogram_quantile, never to rate().
+"""
+
+__author__ = 'erichiggins@gmail.com (Eric Higgins)'
+
+import logging
+import re
+import time
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+from google.appengine.ext import webapp
+
+
+FLUSH_INTERVAL = 60
+ROLLING_WINDOW = 10 * 60
+ROLLING_WINDOWS = 6
+# Upper bounds in milliseconds of the latency histogram buckets.
+LATENCY_BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+# Cache name -> pattern of the memcache keys whose gets are counted as hits
+# and misses. The names are those of the snipper_cache_stats series. Week
+# keys are models.FetchSnippetWeeks' snippets_<user>_<generation>_<start>,
+# which the snippets_gen_, snippets_mtime_ and snippets_cache_ keys don't
+# end like. SnippetUser keys are models._SnippetUserKeys' first key, not
+# its SnippetUser-gen- generation key.
+TRACKED_KEYS = (
+    ('snippets', re.compile(r'^snippets_.+_\d+_\d+$')),
+    ('snippet_user', re.compile(r'^SnippetUser-(?!gen-)')),
+)
+# Memcache key of the set of series names every instance has written.
+SERIES_KEY = 'metrics_series'
+# Handler name of API calls made outside of a request, e.g. at import.
+NO_HANDLER = 'none'
+# Value of the window label of the series summed over the rolling windows.
+WINDOW = '%ds' % (ROLLING_WINDOW * ROLLING_WINDOWS)
+METRIC_TYPES = {
+    'snipper_requests': 'gauge',
+    'snipper_request_latency_ms_bucket': 'gauge',
+    'snipper_request_latency_ms_sum': 'gauge',
+    'snipper_request_latency_ms_count': 'gauge',
+    'snipper_rpcs': 'gauge',
+    'snipper_rpc_latency_ms_bucket': 'gauge',
+    'snipper_rpc_latency_ms_sum': 'gauge',
+    'snipper_rpc_latency_ms_count': 'gauge',
+    'snipper_memcache_lookups': 'gauge',
+    'snipper_memcache_hit_ratio': 'gauge',
+    'snipper_cache_stats': 'gauge',
+}
+
+
+def Series(metric, **labels):
+  """Return the Prometheus series name of a metric with labels."""
+  if not labels:
+    return metric
+  return '%s{%s}' % (metric, ','.join(
+      '%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+      for name, value in sorted(labels.items())))
+
+
+def _WindowPrefix(window):
+  return 'metrics_%d_' % window
+
+
+def _WithWindow(series):
+  """Add the window label to a series name."""
+  if series.endswith('}'):
+    return '%s,window="%s"}' % (series[:-1], WINDOW)
+  return '%s{window="%s"}' % (series, WINDOW)
+
+
+class Recorder(object):
+  """Counts of the requests and API calls of this instance.
+
+  Attributes:
+    handler: Name of the handler serving the current request, or None.
+  """
+
+  def __init__(self):
+    self.handler = None
+    self._pending = {}
+    self._registered = set()
+    self._rpc_started = {}
+    self._request_started = None
+    self._paused = False
+    self._last_flush = time.time()
+
+  def Incr(self, metric, delta=1, **labels):
+    series = Series(metric, **labels)
+    self._pending[series] = self._pending.get(series, 0) + delta
+
+  def Observe(self, metric, value, **labels):
+    """Add a value to the _bucket, _sum and _count series of a metric.
+
+    The buckets have the upper bounds of LATENCY_BUCKETS and are cumulative
+    like those of a Prometheus histogram.
+    """
+    for bound in LATENCY_BUCKETS:
+      if value <= bound:
+        self.Incr(metric + '_bucket', le=bound, **labels)
+    self.Incr(metric + '_bucket', le='+Inf', **labels)
+    self.Incr(metric + '_sum', int(round(value)), **labels)
+    self.Incr(metric + '_count', **labels)
+
+  def StartRequest(self):
+    self.handler = 'unrouted'
+    self._request_started = time.time()
+    self._rpc_started.clear()
+
+  def FinishRequest(self, status):
+    elapsed = (time.time() - self._request_started) * 1000
+    self.Incr('snipper_requests', handler=self.handler, code=status)
+    self.Observe('snipper_request_latency_ms', elapsed, handler=self.handler)
+    self.handler = None
+    if time.time() - self._last_flush >= FLUSH_INTERVAL:
+      self.Flush()
+
+  def RpcStarted(self, request):
+    if not self._paused:
+      self._rpc_started[id(request)] = time.time()
+
+  def RpcFinished(self, service, call, request, response):
+    started = self._rpc_started.pop(id(request), None)
+    if self._paused:
+      return
+    handler = self.handler or NO_HANDLER
+    self.Incr('snipper_rpcs', handler=handler, service=service, call=call)
+    if started is not None:
+      self.Observe('snipper_rpc_latency_ms', (time.time() - started) * 1000,
+                   handler=handler, service=service)
+    if service == 'memcache' and call == 'Get':
+      self._CountLookups(request, response)
+
+  def _CountLookups(self, request, response):
+    found = set(item.key() for item in response.item_list())
+    for cache, pattern in TRACKED_KEYS:
+      keys = [key for key in request.key_list() if pattern.match(key)]
+      if keys:
+        hits = len([key for key in keys if key in found])
+        self.Incr('snipper_memcache_lookups', hits, cache=cache,
+                  result='hit')
+        self.Incr('snipper_memcache_lookups', len(keys) - hits,
+                  cache=cache, result='miss')
+
+  def Flush(self):
+    """Add the pending counts to the memcache counters of this window."""
+    self._last_flush = time.time()
+    if self._pending:
+      self.Unrecorded(self._FlushPending, dict(self._pending))
+
+  def _FlushPending(self, pending):
+    window = int(time.time() // ROLLING_WINDOW)
+    if memcache.offset_multi(pending, key_prefix=_WindowPrefix(window),
+                             initial_value=0):
+      self._pending = {}
+      self._Register(set(pending) - self._registered)
+
+  def _Register(self, series):
+    """Add series names to the set shared by every instance."""
+    if not series:
+      return
+    client = memcache.Client()
+    for _ in xrange(3):
+      known = client.gets(SERIES_KEY)
+      if known is None:
+        if client.add(SERIES_KEY, series):
+          break
+      elif series <= known or client.cas(SERIES_KEY, known | series):
+        break
+    else:
+      logging.warning('Could not register %d metric series.', len(series))
+      return
+    self._registered |= series
+
+  def Unrecorded(self, function, *args):
+    """Call function without recording the API calls it makes."""
+    paused, self._paused = self._paused, True
+    try:
+      return function(*args)
+    finally:
+      self._paused = paused
+
+  def Totals(self):
+    """Return the counts of every instance summed over the rolling windows."""
+    self.Flush()
+    return self.Unrecorded(self._ReadTotals)
+
+  def _ReadTotals(self):
+    series = list(memcache.get(SERIES_KEY) or ())
+    totals = dict((name, 0) for name in series)
+    current = int(time.time() // ROLLING_WINDOW)
+    for window in xrange(current - ROLLING_WINDOWS + 1, current + 1):
+      counts = memcache.get_multi(series, key_prefix=_WindowPrefix(window))
+      for name, count in counts.iteritems():
+        totals[name] += int(count)
+    return totals
+
+
+recorder = Recorder()
+
+
+def SetHandler(name):
+  """Name the handler serving the current request."""
+  if recorder.handler is not None:
+    recorder.handler = name
+
+
+def _PreCall(service, call, request, unused_response):
+  recorder.RpcStarted(request)
+
+
+def _PostCall(service, call, request, response):
+  recorder.RpcFinished(service, call, request, response)
+
+
+def InstallHooks():
+  """Hook the apiproxy to count API calls. Adding them again does nothing."""
+  apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+      'snipper_metrics', _PreCall)
+  apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+      'snipper_metrics', _PostCall)
+
+
+class MetricsMiddleware(object):
+  """WSGI middleware that records the latency and status of each request."""
+
+  def __init__(self, app):
+    self.app = app
+    InstallHooks()
+
+  def __call__(self, environ, start_response):
+    status = []
+
+    def _StartResponse(response_status, headers, exc_info=None):
+      status.append(response_status.split(' ', 1)[0])
+      return start_response(response_status, headers, exc_info)
+    recorder.StartRequest()
+    try:
+      return self.app(environ, _StartResponse)
+    finally:
+      recorder.FinishRequest(status and status[0] or '500')
+
+
+def _HitRatios(totals):
+  """Return the memcache hit ratio series for each tracked cache."""
+  ratios = {}
+  for cache, _ in TRACKED_KEYS:
+    hits = totals.get(Series('snipper_memcache_lookups', cache=cache,
+                             result='hit'), 0)
+    misses = totals.get(Series('snipper_memcache_lookups', cache=cache,
+                               result='miss'), 0)
+    if hits + misses:
+      ratios[Series('snipper_memcache_hit_ratio', cache=cache)] = (
+          float(hits) / (hits + misses))
+  return ratios
+
+
+def _CacheStats():
+  """Return the /cachestats numbers as series."""
+  import models  # pylint: disable-msg=C6204
+  stats = {}
+  for cache, values in (('snippets', models.GetSnippetCacheStats()),
+                        ('snippet_user', models.GetSnippetUserCacheStats()),
+                        ('snippet_buffer', models.GetSnippetBufferStats())):
+    for name, value in values.items():
+      if isinstance(value, (int, long, float)):
+        stats[Series('snipper_cache_stats', cache=cache, stat=name)] = value
+  return stats
+
+
+def FormatMetrics(values):
+  """Return series values in the Prometheus text format."""
+  lines = []
+  typed = set()
+  for series in sorted(values):
+    metric = series.split('{', 1)[0]
+    if metric not in typed:
+      typed.add(metric)
+      lines.append('# TYPE %s %s' % (metric,
+                                      METRIC_TYPES.get(metric, 'untyped')))
+    lines.append('%s %s' % (series, values[series]))
+  return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(webapp.RequestHandler):
+  """Serve the metrics of the last hour to admins, for scraping."""
+
+  def get(self):  # pylint: disable-msg=C6409
+    totals = recorder.Totals()
+    totals.update(_HitRatios(totals))
+    values = dict((_WithWindow(series), value)
+                  for series, value in totals.items())
+    values.update(recorder.Unrecorded(_CacheStats))
+    self.response.headers['Content-Type'] = 'text/plain; version=0.0.4'
+    self.response.out.write(FormatMetrics(values))
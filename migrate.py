@@ -0,0 +1,167 @@
+#!/usr/bin/python2.5
+#
+# Copyright 2012 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""Resumable batch migrations and maintenance jobs of the datastore.
+
+Each job walks a query in batches. After every batch the query cursor
+is saved in a MigrationState entity and a task is added for the next batch,
+so a job that is interrupted carries on from where it stopped when it is
+started again. Recurring jobs are started by cron with restart=1.
+"""
+
+__author__ = 'erichiggins@gmail.com (Eric Higgins)'
+
+import logging
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import db
+from google.appengine.ext import webapp
+import models
+
+
+MIGRATION_QUEUE = 'default'
+
+
+class BatchMigration(webapp.RequestHandler):
+  """Base handler for a migration run as a chain of tasks.
+
+  GET starts or resumes the migration, POST migrates one batch. Subclasses
+  set NAME and URL, and define Query, returning the query to walk in a
+  stable order, and Migrate, taking a batch of the entities it returns.
+  """
+
+  NAME = None
+  URL = None
+  BATCH_SIZE = 100
+
+  def _State(self):
+    return models.MigrationState.get_or_insert(self.NAME)
+
+  def _AddTask(self, cursor):
+    taskqueue.Task(url=self.URL, params={'cursor': cursor or ''}).add(
+        queue_name=MIGRATION_QUEUE)
+
+  def get(self):  # pylint: disable-msg=C6409
+    """Start the migration, or resume it from its saved cursor."""
+    state = self._State()
+    if state.Done and not self.request.get('restart'):
+      self.response.out.write('%s is done, %d migrated.\n' %
+                              (self.NAME, state.Migrated))
+      return
+    if self.request.get('restart'):
+      state.Cursor = None
+      state.Migrated = 0
+      state.Done = False
+      state.put()
+    self._AddTask(state.Cursor)
+    self.response.out.write('%s started at %d migrated.\n' %
+                            (self.NAME, state.Migrated))
+
+  def post(self):  # pylint: disable-msg=C6409
+    """Migrate one batch and add the task for the next."""
+    cursor = self.request.get('cursor') or None
+    query = self.Query()
+    if cursor:
+      query.with_cursor(cursor)
+    entities = query.fetch(self.BATCH_SIZE)
+    self.Migrate(entities)
+    state = self._State()
+    state.Migrated += len(entities)
+    if len(entities) < self.BATCH_SIZE:
+      state.Cursor = None
+      state.Done = True
+      logging.info('%s finished, %d migrated.', self.NAME, state.Migrated)
+    else:
+      state.Cursor = query.cursor()
+    state.put()
+    if state.Done:
+      memcache.delete('migration_done_%s' % self.NAME)
+    else:
+      self._AddTask(state.Cursor)
+
+
+class SnippetUserMigration(BatchMigration):
+  """Move SnippetUsers saved with numeric ids to their key names."""
+
+  NAME = models.SNIPPET_USER_MIGRATION
+  URL = '/migrate/users'
+
+  def Query(self):
+    return models.SnippetUser.all().order('__key__')
+
+  def Migrate(self, entities):
+    models.MigrateSnippetUsers(entities)
+
+
+class SnippetMigration(BatchMigration):
+  """Move root Snippets under the key of their SnippetUser."""
+
+  NAME = models.SNIPPET_MIGRATION
+  URL = '/migrate/snippets'
+
+  def Query(self):
+    # Root Snippet keys sort before every key under a SnippetUser, so the
+    # walk stops before the snippets that were already moved.
+    query = models.Snippet.all().order('__key__')
+    return query.filter('__key__ <', db.Key.from_path('SnippetUser', 1))
+
+  def Migrate(self, entities):
+    models.MigrateSnippets(entities)
+
+
+class SearchIndexMigration(BatchMigration):
+  """Add the snippets saved before search existed to the search index."""
+
+  NAME = 'SnippetSearchIndex'
+  URL = '/migrate/search'
+
+  def Query(self):
+    # Root Snippets are indexed when they are moved under their user.
+    query = models.Snippet.all().order('__key__')
+    return query.filter('__key__ >=', db.Key.from_path('SnippetUser', 1))
+
+  def Migrate(self, entities):
+    models.IndexSnippetsOfUsers(entities)
+
+
+class NextReportMigration(BatchMigration):
+  """Give SnippetUsers saved before next_report_at existed its value."""
+
+  NAME = 'SnippetUserNextReport'
+  URL = '/migrate/next-report'
+
+  def Query(self):
+    return models.SnippetUser.all().order('__key__')
+
+  def Migrate(self, entities):
+    models.ScheduleNextReports(
+        [snipper_user for snipper_user in entities
+         if snipper_user.next_report_at is None], only_unscheduled=True)
+
+
+class SnippetCompaction(BatchMigration):
+  """Compact every user's old closed weeks into SnippetArchives."""
+
+  NAME = 'SnippetCompaction'
+  URL = '/migrate/compact'
+  BATCH_SIZE = 10
+
+  def Query(self):
+    return models.SnippetUser.all().order('__key__')
+
+  def Migrate(self, entities):
+    for snipper_user in entities:
+      models.CompactSnippets(snipper_user)
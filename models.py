@@ -18,22 +18,676 @@
 
 __author__ = 'erichiggins@gmail.com (Eric Higgins)'
 
+import base64
+import calendar
+import datetime
 import logging
+import math
+import operator
+import pickle
+import re
+import time
+import zlib
+from google.appengine.api import lib_config
 from google.appengine.api import memcache
+from google.appengine.api import taskqueue
 from google.appengine.api import users
 from google.appengine.ext import db
-import pytz
+from google.appengine.runtime import apiproxy_errors
 import util
 
 
+# Settings that can be overridden in appengine_config.py with a snipper_
+# prefix, e.g. snipper_WRITE_BEHIND = True.
+config = lib_config.register('snipper', {
+    # Acknowledge new snippets once they are in the user's SnippetBuffer and
+    # write them to the datastore from a flush task. Reads only look at the
+    # buffers while it is on; after turning it off, the flush tasks already
+    # queued store what is left within FLUSH_DELAY seconds.
+    'WRITE_BEHIND': False,
+})
+
+# Cached weeks are keyed by a per-user generation, so they only have to
+# expire to make room; writes make them unreachable by bumping the generation.
+SNIPPET_CACHE_TIME = 7 * 24 * 60 * 60
+snippet_cache_stats = util.StatCounter('snippets_cache_', ('hits', 'misses'))
+# Seconds a SnippetUser is used from the instance cache before its generation
+# is checked again.
+SNIPPET_USER_TTL = 30
+_snippet_user_cache = util.LruCache(max_size=1000)
+snippet_user_stats = util.StatCounter(
+    'SnippetUser_cache_', ('instance_hits', 'instance_revalidations',
+                           'memcache_hits', 'datastore_loads'))
+# Snippets fetched per datastore call when iterating over a user's snippets.
+SNIPPET_BATCH_SIZE = 500
+# Closed weeks older than this many weeks are compacted into SnippetArchives.
+COMPACT_AFTER_WEEKS = 4
+COMPACT_MAX_WEEKS = 52
+# Weeks with more snippets than fit in one transaction are left live.
+ARCHIVE_MAX_SNIPPETS = 400
+# Longest week, e.g. when a user moves their reset later.
+ARCHIVE_MAX_SPAN = datetime.timedelta(days=8)
+_FILTER_OPERATORS = {
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+    '=': operator.eq,
+}
+# Write-behind buffer: seconds a buffer collects snippets before it is
+# flushed, most snippets moved per flush transaction, and most snippets
+# buffered per user before writes go straight to the datastore.
+FLUSH_URL = '/buffer/flush'
+FLUSH_QUEUE = 'snippet-flush-queue'
+FLUSH_DELAY = 10
+FLUSH_BATCH = 200
+MAX_BUFFERED = 1000
+snippet_buffer_stats = util.StatCounter(
+    'snippet_buffer_', ('appended', 'flushed', 'flush_lag_ms',
+                        'write_through'))
+# Name of the migration that moves SnippetUsers to key names.
+SNIPPET_USER_MIGRATION = 'SnippetUserKeyNames'
+# Name of the migration that moves Snippets under their SnippetUser.
+SNIPPET_MIGRATION = 'SnippetAncestors'
+# Search terms are runs of word characters, lowercased, without stop words.
+_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+_STOP_WORDS = frozenset(['an', 'and', 'are', 'as', 'at', 'be', 'by', 'for',
+                         'in', 'is', 'it', 'of', 'on', 'or', 'the', 'to',
+                         'with'])
+MAX_TERM_LENGTH = 64
+MAX_QUERY_TERMS = 8
+# The first year with snippets, where search starts reading postings.
+SEARCH_FIRST_YEAR = 2010
+# Postings a SnippetTerm holds before they are moved to a sealed chunk, so
+# entities stay far below the 1MB limit and index writes stay small.
+MAX_POSTINGS = 2000
+# Seconds an unfinished migration state is cached before it is read again.
+MIGRATION_STATE_CACHE_TIME = 60
+_finished_migrations = set()
+
+
 class Snippet(db.Model):
-  """Datastore model for storing snippet strings."""
+  """Datastore model for storing snippet strings.
+
+  Snippets are children of their user's SnippetUser key, so they can be read
+  with strongly consistent ancestor queries. The SnippetUser entity does not
+  have to exist for that.
+  """
   User = db.UserProperty(auto_current_user_add=True)
   Snippet = db.StringProperty(unicode, default=None, multiline=False)
   ExtensionVersion = db.StringProperty(unicode, default=None, multiline=False)
   DateStamp = db.DateTimeProperty(auto_now_add=True)
 
 
+class SnippetWeek(db.Model):
+  """Datastore model aggregating a user's snippets for a single reset week.
+
+  Buckets are children of the user's SnippetUser key. The key name is
+  derived from the user and the start of the week, so the whole week can be
+  read with one get by key instead of a range query.
+  Buckets created by a write (rather than from a query) are not Complete
+  and get merged with the query results on the next read.
+  """
+  User = db.UserProperty()
+  WeekStart = db.DateTimeProperty()
+  SnippetKeys = db.ListProperty(db.Key, indexed=False)
+  Snippets = db.StringListProperty(indexed=False)
+  DateStamps = db.ListProperty(datetime.datetime, indexed=False)
+  Complete = db.BooleanProperty(default=False, indexed=False)
+
+  def AddSnippets(self, snippets):
+    """Append Snippet entities that are not already in the bucket."""
+    known = set(self.SnippetKeys)
+    for snippet in snippets:
+      if snippet.key() in known:
+        continue
+      known.add(snippet.key())
+      self.SnippetKeys.append(snippet.key())
+      self.Snippets.append(snippet.Snippet or u'')
+      self.DateStamps.append(snippet.DateStamp)
+
+  def GetSnippets(self, limit=None):
+    """Return the bucket contents as Snippet instances, oldest first."""
+    entries = sorted(zip(self.DateStamps, self.SnippetKeys, self.Snippets))
+    return [Snippet(key=key, User=self.User, Snippet=text, DateStamp=stamp)
+            for stamp, key, text in entries[:limit]]
+
+
+def _ToUtc(date):
+  """Return a timezone-aware datetime as a naive UTC datetime."""
+  return date.astimezone(util.GetTimezone('UTC')).replace(tzinfo=None)
+
+
+def SnippetWeekKeyName(user, start_date):
+  """Return the SnippetWeek key name for the week starting at start_date."""
+  return '%s|%d' % (user.email(), calendar.timegm(start_date.utctimetuple()))
+
+
+def GetWeekWindow(snipper_user, offset=0):
+  """Return the util.WeekWindow of a user's reset week."""
+  return util.GetWeekWindow(snipper_user.reset_day, snipper_user.reset_hour,
+                            snipper_user.timezone, offset)
+
+
+def SnippetWeekKey(user, start_date):
+  return db.Key.from_path('SnippetWeek', SnippetWeekKeyName(user, start_date),
+                          parent=SnippetUserKey(user))
+
+
+def _UpdateSnippetWeek(user, start_date, snippets, complete=False):
+  """Transactionally merge snippets into the user's bucket for a week."""
+  key = SnippetWeekKey(user, start_date)
+
+  def _Txn():
+    week = db.get(key)
+    if week is None:
+      week = SnippetWeek(key=key, User=user, WeekStart=_ToUtc(start_date))
+    week.AddSnippets(snippets)
+    week.Complete = week.Complete or complete
+    week.put()
+    return week
+  return db.run_in_transaction(_Txn)
+
+
+def _SnippetVersionKeys(user):
+  return 'snippets_gen_%s' % user, 'snippets_mtime_%s' % user
+
+
+def GetSnippetVersion(user):
+  """Return the generation and last modified time of a user's snippet data.
+
+  The generation is used in cache keys and ETags, and changes whenever the
+  user's snippets or settings do. Both are read with a single memcache RPC.
+
+  Args:
+    user: User object.
+
+  Returns:
+    Tuple of the generation, and the last modified time in epoch seconds.
+  """
+  gen_key, mtime_key = _SnippetVersionKeys(user)
+  values = memcache.get_multi([gen_key, mtime_key])
+  generation = values.get(gen_key)
+  modified = values.get(mtime_key)
+  if generation is None:
+    # Start from the current time so a counter lost to eviction can not come
+    # back with a generation that still has cached weeks.
+    generation = int(time.time() * 1000)
+    if not memcache.add(gen_key, generation):
+      generation = memcache.get(gen_key) or generation
+  if modified is None:
+    # Unknown, so assume the data just changed.
+    modified = int(time.time())
+    memcache.add(mtime_key, modified)
+  return generation, modified
+
+
+def GetSnippetGeneration(user):
+  """Return the generation of a user's snippet data, used in cache keys."""
+  return GetSnippetVersion(user)[0]
+
+
+def BumpSnippetGeneration(user):
+  """Invalidate every cached week of the user's snippets."""
+  gen_key, mtime_key = _SnippetVersionKeys(user)
+  if memcache.incr(gen_key, initial_value=int(time.time() * 1000)) is None:
+    logging.error('Could not bump the snippet generation for %s', user)
+    memcache.delete(gen_key)
+  memcache.set(mtime_key, int(time.time()))
+
+
+def GetSnippetCacheStats():
+  """Return the snippet cache hit and miss counts, and the hit rate."""
+  stats = snippet_cache_stats.Get()
+  total = stats['hits'] + stats['misses']
+  stats['hit_rate'] = total and float(stats['hits']) / total
+  return stats
+
+
+def GetWeekWindowAt(snipper_user, date):
+  """Return the util.WeekWindow of a user's reset week containing a date.
+
+  Args:
+    snipper_user: SnippetUser of the user.
+    date: Naive UTC datetime.
+
+  Returns:
+    util.WeekWindow, the current one for dates after it started.
+  """
+  current_start = _ToUtc(GetWeekWindow(snipper_user).start)
+  if date >= current_start:
+    return GetWeekWindow(snipper_user)
+  behind = current_start - date
+  offset = int(math.ceil((behind.days * 86400 + behind.seconds) /
+                         (7 * 86400.0)))
+  window = GetWeekWindow(snipper_user, offset)
+  # The estimate can be a week off around daylight saving time changes.
+  while date < _ToUtc(window.start):
+    window = window.Older()
+  while date >= _ToUtc(window.end) and window.offset > 0:
+    window = GetWeekWindow(snipper_user, window.offset - 1)
+  return window
+
+
+def _AddToSnippetWeek(user, snippets):
+  """Add freshly saved snippets to the buckets of the weeks they are in.
+
+  That is the current week, unless the snippets were saved with earlier
+  client timestamps.
+  """
+  snipper_user = GetSnippetUser(user)
+  weeks = {}
+  for snippet in snippets:
+    start_date = GetWeekWindowAt(snipper_user, snippet.DateStamp).start
+    weeks.setdefault(start_date, []).append(snippet)
+  for start_date, week_snippets in weeks.items():
+    try:
+      _UpdateSnippetWeek(user, start_date, week_snippets)
+    except (db.Timeout, db.InternalError, db.TransactionFailedError):
+      # The snippets are saved, so drop the bucket and let a read rebuild it.
+      logging.exception('Could not update the snippet week for %s', user)
+      db.delete(SnippetWeekKey(user, start_date))
+
+
+def RebuildSnippetWeeks(user, offsets=(0, 1)):
+  """Drop all of a user's week buckets and rebuild the given weeks.
+
+  This must be called when the user's reset day, hour or timezone changes,
+  since the week boundaries (and so the bucket keys) move with them.
+
+  Args:
+    user: User object.
+    offsets: Week offsets to rebuild right away, the rest are built lazily.
+  """
+  logging.info('Rebuilding snippet weeks for %s', user)
+  # An ancestor query, so buckets written just before are deleted too.
+  query = SnippetWeek.all(keys_only=True).ancestor(SnippetUserKey(user))
+  keys = query.fetch(1000)
+  while keys:
+    db.delete(keys)
+    keys = query.fetch(1000)
+  snipper_user = GetSnippetUser(user)
+  for offset in offsets:
+    window = GetWeekWindow(snipper_user, offset)
+    _BuildSnippetWeek(user, window.start, window.end)
+  BumpSnippetGeneration(user)
+
+
+class SnippetArchive(db.Model):
+  """Datastore model for a compacted, closed week of a user's snippets.
+
+  Archives are children of the user's SnippetUser key, with the epoch of
+  the start of the week as key name. Data is the zlib-compressed pickle of
+  (key, epoch, version, text) tuples of the archived snippets, oldest first.
+  Archives are found with ancestor range queries on WeekStart.
+  """
+  WeekStart = db.DateTimeProperty()
+  WeekEnd = db.DateTimeProperty(indexed=False)
+  Count = db.IntegerProperty(default=0, indexed=False)
+  Data = db.BlobProperty()
+  DateStamp = db.DateTimeProperty(auto_now=True)
+
+  def GetSnippets(self, user=None):
+    """Return the archived snippets as Snippet instances, oldest first."""
+    if not self.Data:
+      return []
+    return [Snippet(key=db.Key(key), User=user,
+                    ExtensionVersion=version, Snippet=text,
+                    DateStamp=datetime.datetime.utcfromtimestamp(epoch))
+            for key, epoch, version, text in
+            pickle.loads(zlib.decompress(self.Data))]
+
+  def SetSnippets(self, snippets):
+    """Store Snippet entities, replacing the archived ones."""
+    snippets = sorted(snippets, key=lambda snippet: snippet.DateStamp)
+    rows = [(str(snippet.key()),
+             calendar.timegm(snippet.DateStamp.utctimetuple()),
+             snippet.ExtensionVersion, snippet.Snippet)
+            for snippet in snippets]
+    self.Data = db.Blob(zlib.compress(pickle.dumps(rows, 2), 9))
+    self.Count = len(rows)
+
+
+def _NaiveUtc(date):
+  if date.tzinfo is None:
+    return date
+  return _ToUtc(date)
+
+
+def _MatchesFilters(date, filters):
+  """Return whether a naive UTC datetime passes (DateStamp op, value) pairs."""
+  for property_operator, value in filters:
+    comparison = _FILTER_OPERATORS[property_operator.split()[-1]]
+    if not comparison(date, _NaiveUtc(value)):
+      return False
+  return True
+
+
+class _QueryReader(object):
+  """Fetch batches of a datastore query by cursor.
+
+  Attributes:
+    name: Name of the snippets it reads, kept in resume positions.
+  """
+
+  def __init__(self, name, query):
+    self.name = name
+    self.query = query
+
+  def Fetch(self, cursor, batch_size):
+    """Return a batch and the cursor after it, or None at the end."""
+    if cursor:
+      self.query.with_cursor(cursor)
+    batch = self.query.fetch(batch_size)
+    if len(batch) < batch_size:
+      return batch, None
+    return batch, self.query.cursor()
+
+  def Run(self):
+    """Start the query in the background and return an iterator of it."""
+    return self.query.run(batch_size=SNIPPET_BATCH_SIZE)
+
+
+class _ArchiveReader(object):
+  """Fetch batches of the snippets in a user's SnippetArchives."""
+
+  ARCHIVES_PER_FETCH = 10
+  name = 'archive'
+
+  def __init__(self, user, filters, newest_first, keys_only, user_key):
+    self.user = user
+    self.filters = filters
+    self.newest_first = newest_first
+    self.keys_only = keys_only
+    self.query = SnippetArchive.all().ancestor(user_key)
+    for property_operator, value in filters:
+      comparison = property_operator.split()[-1]
+      if comparison.startswith('>'):
+        # An archive holds at most one week, so it can start before the
+        # lower bound, but not by more than a week.
+        self.query.filter('WeekStart >', _NaiveUtc(value) - ARCHIVE_MAX_SPAN)
+      else:
+        self.query.filter('WeekStart %s' % comparison, value)
+    self.query.order(newest_first and '-WeekStart' or 'WeekStart')
+
+  def Fetch(self, cursor, batch_size):
+    """Return at least batch_size snippets unless the archives run out."""
+    batch = []
+    while len(batch) < batch_size:
+      if cursor:
+        self.query.with_cursor(cursor)
+      archives = self.query.fetch(self.ARCHIVES_PER_FETCH)
+      cursor = self.query.cursor()
+      for archive in archives:
+        batch.extend(self._Snippets(archive))
+      if len(archives) < self.ARCHIVES_PER_FETCH:
+        return batch, None
+    return batch, cursor
+
+  def Run(self):
+    """Start the query in the background and return an iterator of it."""
+    archives = self.query.run(batch_size=self.ARCHIVES_PER_FETCH)
+    return (snippet for archive in archives
+            for snippet in self._Snippets(archive))
+
+  def _Snippets(self, archive):
+    """Return the snippets of an archive that pass the filters, in order."""
+    snippets = [snippet for snippet in archive.GetSnippets(self.user)
+                if _MatchesFilters(snippet.DateStamp, self.filters)]
+    if self.newest_first:
+      snippets.reverse()
+    if self.keys_only:
+      snippets = [snippet.key() for snippet in snippets]
+    return snippets
+
+
+def _SnippetReaderNames(newest_first=False):
+  """Return the names of the readers of _SnippetReaders, in read order."""
+  if newest_first:
+    return ('live', 'legacy', 'archive')
+  return ('archive', 'live', 'legacy')
+
+
+def _SnippetReaders(user, filters=(), newest_first=False, **query_args):
+  """Return readers that together cover a user's snippets.
+
+  Archived weeks are older than any live snippet, so they are read first, or
+  last when newest_first. Until the SNIPPET_MIGRATION is done, snippets still
+  saved as root entities need another query. The readers are in the order
+  of _SnippetReaderNames, without 'legacy' once the migration is done.
+  """
+  user_key = SnippetUserKey(user)
+  queries = [('live', Snippet.all(**query_args).ancestor(user_key))]
+  if not IsMigrationDone(SNIPPET_MIGRATION):
+    queries.append(('legacy',
+                    Snippet.all(**query_args).filter('User =', user)))
+  order = newest_first and '-DateStamp' or 'DateStamp'
+  for _, query in queries:
+    for property_operator, value in filters:
+      query.filter(property_operator, value)
+    query.order(order)
+  readers = [_QueryReader(name, query) for name, query in queries]
+  archives = _ArchiveReader(user, filters, newest_first,
+                            query_args.get('keys_only'), user_key)
+  if newest_first:
+    return readers + [archives]
+  return [archives] + readers
+
+
+def IterSnippetBatches(user, filters=(), batch_size=SNIPPET_BATCH_SIZE,
+                       keys_only=False, projection=None, newest_first=False,
+                       position=None):
+  """Read a user's snippets by cursor, one batch at a time.
+
+  There is no limit on the number of snippets, and only one batch is held
+  in memory at a time. Archived weeks are read too. Root snippets not yet
+  moved by the SNIPPET_MIGRATION come after the live ones, so the order is
+  only by DateStamp within each part.
+
+  Args:
+    user: User object.
+    filters: Sequence of (property and operator, value) pairs on DateStamp.
+    batch_size: Number of snippets fetched per datastore call.
+    keys_only: Whether to yield keys instead of entities.
+    projection: Names of the only properties to load, or None for all.
+      Archived snippets always have all of them.
+    newest_first: Whether to order by DateStamp descending.
+    position: Position yielded with an earlier batch, to resume after it.
+
+  Yields:
+    (batch, position) tuples, where batch is a non-empty list of Snippet
+    entities or keys and position is where the next batch starts, or None
+    after the last batch. A position is the name of a reader and a cursor,
+    so it still applies when a reader was dropped in between, e.g. because
+    the SNIPPET_MIGRATION finished.
+  """
+  if config.WRITE_BEHIND and not position:
+    # The readers only see stored snippets, so store the buffered ones.
+    FlushUserSnippetBuffer(user)
+  query_args = {'keys_only': keys_only}
+  if projection:
+    query_args['projection'] = tuple(projection)
+  readers = _SnippetReaders(user, filters, newest_first, **query_args)
+  phase, cursor = 0, None
+  if position:
+    name, cursor = position
+    names = _SnippetReaderNames(newest_first)
+    # Carry on with the first reader at or after the named one. A dropped
+    # reader's cursor doesn't apply to the next one.
+    later = names[names.index(name):]
+    while phase < len(readers) and readers[phase].name not in later:
+      phase += 1
+    if phase < len(readers) and readers[phase].name != name:
+      cursor = None
+  while phase < len(readers):
+    batch, cursor = readers[phase].Fetch(cursor, batch_size)
+    if cursor is None:
+      phase += 1
+    if batch:
+      yield batch, phase < len(readers) and (
+          readers[phase].name, cursor) or None
+
+
+def IterSnippets(user, filters=(), batch_size=SNIPPET_BATCH_SIZE,
+                 keys_only=False, projection=None, newest_first=False):
+  """Yield all of a user's snippets, see IterSnippetBatches."""
+  for batch, _ in IterSnippetBatches(user, filters, batch_size, keys_only,
+                                     projection, newest_first):
+    for snippet in batch:
+      yield snippet
+
+
+class PendingSnippets(object):
+  """A read of all of a user's snippets in a range that is still in flight.
+
+  The queries of every reader are started when it is created, so starting
+  one for each of several users and then getting the results reads them
+  all in about the time of one read.
+  """
+
+  def __init__(self, user, filters=(), projection=None):
+    if config.WRITE_BEHIND:
+      # The readers only see stored snippets, so store the buffered ones.
+      FlushUserSnippetBuffer(user)
+    query_args = {}
+    if projection:
+      query_args['projection'] = tuple(projection)
+    self._results = [reader.Run() for reader in
+                     _SnippetReaders(user, filters, **query_args)]
+
+  def GetResult(self):
+    """Wait for the queries and return the snippets ordered by DateStamp."""
+    snippets = []
+    for results in self._results:
+      snippets.extend(results)
+    return sorted(snippets, key=lambda snippet: snippet.DateStamp)
+
+
+def QuerySnippets(user, filters=(), limit=1000, newest_first=False):
+  """Return at most limit of a user's snippets ordered by DateStamp.
+
+  Args:
+    user: User object.
+    filters: Sequence of (property and operator, value) pairs on DateStamp.
+    limit: Maximum number of snippets to return.
+    newest_first: Whether to order by DateStamp descending.
+
+  Returns:
+    List of Snippet entities.
+  """
+  merged = {}
+  for reader in _SnippetReaders(user, filters, newest_first):
+    # Archived snippets are older than any live one, so the archives aren't
+    # read once the newer snippets fill the limit, nor the live snippets
+    # once the archives do.
+    if newest_first and reader.name == 'archive' and len(merged) >= limit:
+      break
+    batch, _ = reader.Fetch(None, limit)
+    # A snippet may briefly be in two places while it is moved.
+    for snippet in batch:
+      merged.setdefault((snippet.DateStamp, snippet.Snippet), snippet)
+    if not newest_first and reader.name == 'archive' and len(merged) >= limit:
+      break
+  snippet_buffer = config.WRITE_BEHIND and db.get(SnippetBufferKey(user))
+  if snippet_buffer:
+    for snippet in snippet_buffer.GetSnippets():
+      if _MatchesFilters(snippet.DateStamp, filters):
+        merged[(snippet.DateStamp, snippet.Snippet)] = snippet
+  return [merged[stamp] for stamp in
+          sorted(merged, reverse=newest_first)][:limit]
+
+
+def CompactSnippets(snipper_user, keep_weeks=COMPACT_AFTER_WEEKS,
+                    max_weeks=COMPACT_MAX_WEEKS):
+  """Roll a user's closed weeks older than keep_weeks into SnippetArchives.
+
+  Each week is compacted in a transaction on the user's entity group that
+  writes the archive and deletes the snippets in it. A week that already has
+  an archive, e.g. because a snippet was added to it later, is merged.
+
+  Args:
+    snipper_user: SnippetUser of the user.
+    keep_weeks: Number of recent weeks left as live snippets.
+    max_weeks: Maximum number of weeks compacted in one call.
+
+  Returns:
+    Number of snippets archived.
+  """
+  user = snipper_user.User
+  user_key = SnippetUserKey(user)
+  oldest = Snippet.all().ancestor(user_key).order('DateStamp').get()
+  if oldest is None:
+    return 0
+  # Start at the week of the oldest live snippet, plus one for DST changes,
+  # so every call carries on from where the previous one stopped.
+  current_start = _NaiveUtc(GetWeekWindow(snipper_user).start)
+  offset = (current_start - oldest.DateStamp).days // 7 + 2
+  archived = 0
+  for offset in range(offset, keep_weeks - 1, -1)[:max_weeks]:
+    window = GetWeekWindow(snipper_user, offset)
+    query = Snippet.all().ancestor(user_key).order('DateStamp')
+    query.filter('DateStamp >=', window.start)
+    snippets = query.filter('DateStamp <', window.end).fetch(
+        ARCHIVE_MAX_SNIPPETS + 1)
+    if not snippets:
+      continue
+    if len(snippets) > ARCHIVE_MAX_SNIPPETS:
+      logging.warning('Not archiving the week of %s for %s, it has more than '
+                      '%d snippets.', window.start, user, ARCHIVE_MAX_SNIPPETS)
+      continue
+    key_name = str(calendar.timegm(window.start.utctimetuple()))
+
+    def _Txn():
+      archive = SnippetArchive.get_by_key_name(key_name, parent=user_key)
+      if archive is None:
+        archive = SnippetArchive(parent=user_key, key_name=key_name,
+                                 WeekStart=_NaiveUtc(window.start),
+                                 WeekEnd=_NaiveUtc(window.end))
+      keys = set(snippet.key() for snippet in snippets)
+      kept = [snippet for snippet in archive.GetSnippets(user)
+              if snippet.key() not in keys]
+      archive.SetSnippets(kept + snippets)
+      archive.put()
+      db.delete(snippets)
+    db.run_in_transaction(_Txn)
+    archived += len(snippets)
+  if archived:
+    logging.info('Archived %d snippets of %s.', archived, user)
+  return archived
+
+
+def MigrateSnippets(snippets):
+  """Move root Snippet entities under their user's SnippetUser key.
+
+  The week buckets of the users hold the old keys, so they are dropped and
+  rebuilt from the moved snippets on the next read.
+
+  Args:
+    snippets: List of Snippet entities.
+  """
+  legacy = [snippet for snippet in snippets if snippet.parent_key() is None]
+  if not legacy:
+    return
+  copies = []
+  for snippet in legacy:
+    values = dict((name, getattr(snippet, name))
+                  for name in Snippet.properties())
+    copies.append(Snippet(parent=SnippetUserKey(snippet.User), **values))
+  db.put(copies)
+  db.delete(legacy)
+  IndexSnippetsOfUsers(copies)
+  owners = dict((snippet.User.email(), snippet.User) for snippet in legacy)
+  for user in owners.values():
+    RebuildSnippetWeeks(user, offsets=())
+
+
+def _BuildSnippetWeek(user, start_date, end_date):
+  """Query a week of snippets and store them as a Complete bucket."""
+  snippets = list(IterSnippets(user, [('DateStamp >=', start_date),
+                                      ('DateStamp <=', end_date)]))
+  return _UpdateSnippetWeek(user, start_date, snippets, complete=True)
+
+
 def SaveSnippet(user, version, snippet):
   """Save the snippet into the datastore.
 
@@ -45,59 +699,385 @@ def SaveSnippet(user, version, snippet):
   Returns:
     Bool, Return message.
   """
-  logging.debug('saving snippet for %s', user)
-  try:
-    query = Snippet(User=user, ExtensionVersion=version, Snippet=snippet)
-  except db.BadValueError, err:
-    logging.debug('Caught exception, bad value.')
-    return False, err or 'Bad value given. 500 chars max.'
+  return SaveSnippets(user, version, [snippet])[0]
+
+
+def SaveSnippets(user, version, snippets, datestamps=None):
+  """Save a list of snippets into the datastore with a single batched put.
+
+  Every snippet is validated before anything is written, so a bad line does
+  not prevent the remaining lines from being saved.
+
+  Args:
+    user: User object.
+    version: String detailing which interface version was used.
+    snippets: List of snippet strings.
+    datestamps: Optional list of naive UTC datetimes, one per snippet, e.g.
+      when they were written on a client that was offline. None entries, or
+      no list, mean now.
+
+  Returns:
+    List of (Bool, Return message) tuples, one per snippet, in order.
+  """
+  save = SaveSnippetsAsync(user, version, snippets, datestamps)
+  results = save.GetResult()
+  save.Finish()
+  return results
+
+
+def SaveSnippetsAsync(user, version, snippets, datestamps=None):
+  """Start saving a list of snippets, see SaveSnippets.
+
+  Returns:
+    PendingSave of the batched put.
+  """
+  logging.debug('saving %d snippets for %s', len(snippets), user)
+  results = []
+  entities = []
+  datestamps = datestamps or [None] * len(snippets)
+  for snippet, datestamp in zip(snippets, datestamps):
+    try:
+      entity = Snippet(parent=SnippetUserKey(user), User=user,
+                       ExtensionVersion=version, Snippet=snippet)
+      if datestamp is not None:
+        entity.DateStamp = datestamp
+      entities.append(entity)
+    except db.BadValueError, err:
+      logging.debug('Caught exception, bad value.')
+      results.append((False, err or 'Bad value given. 500 chars max.'))
+    else:
+      results.append(None)  # Placeholder until the put succeeds.
+  if config.WRITE_BEHIND:
+    return BufferedSave(user, entities, results)
+  return PendingSave(user, entities, results)
+
+
+class PendingSave(object):
+  """A batched put of snippets that is still in flight.
+
+  GetResult waits for the put only, so callers can answer the user as soon
+  as the snippets are stored. Finish then brings the week bucket, search
+  index and cache generation up to date.
+  """
+
+  def __init__(self, user, entities, results):
+    self.user = user
+    self.entities = entities
+    self._results = results
+    self._status = None
+    self._finished = False
+    self._rpc = None
+    if entities:
+      self._rpc = db.put_async(entities)
+
+  def GetResult(self):
+    """Wait for the put and return a (Bool, Return message) per snippet."""
+    if self._status is None and self._rpc is not None:
+      try:
+        self._rpc.get_result()
+      except (db.Timeout, db.InternalError, db.BadValueError), err:
+        logging.debug('Caught exception, batch put failed.')
+        self._status = (False, err or 'Snipper hit an error. 500 chars max.')
+      else:
+        logging.debug('worked')
+        self._status = (True, '')
+    return [result or self._status for result in self._results]
+
+  def Finish(self):
+    """Update everything derived from the snippets once they are stored."""
+    self.GetResult()
+    if self._finished or not self._status or not self._status[0]:
+      return
+    self._finished = True
+    _UpdateDerived(self.user, self.entities)
+
+
+def _UpdateDerived(user, snippets):
+  """Add stored snippets to their week buckets and the search index."""
+  _AddToSnippetWeek(user, snippets)
   try:
-    db.put(query)
-  except (db.Timeout, db.InternalError, db.BadValueError), err:
-    logging.debug('Caught exception, trying again')
-    return False, err or 'Snipper hit an error. 500 chars max.'
+    IndexSnippets(user, snippets)
+  except (db.Timeout, db.InternalError, db.TransactionFailedError,
+          db.BadRequestError, apiproxy_errors.RequestTooLargeError):
+    # The snippets are saved, so don't fail the save and have the client
+    # send them again. /migrate/search?restart=1 indexes them later.
+    logging.exception('Could not index the snippets of %s', user)
+  BumpSnippetGeneration(user)
+
+
+class BufferFullError(Exception):
+  """The user's SnippetBuffer can not take any more snippets."""
+
+
+class SnippetBuffer(db.Model):
+  """Datastore model for snippets waiting to be written by a flush task.
+
+  There is one buffer per user, a child of the SnippetUser key with the key
+  name 'buffer', so appending to it and moving its snippets into Snippet
+  entities are transactions on the user's entity group. Snippet ids are
+  allocated when they are buffered, so a snippet has the same key before
+  and after it is flushed.
+  """
+  User = db.UserProperty()
+  SnippetKeys = db.ListProperty(db.Key, indexed=False)
+  Snippets = db.StringListProperty(indexed=False)
+  Versions = db.StringListProperty(indexed=False)
+  DateStamps = db.ListProperty(datetime.datetime, indexed=False)
+  # Server time each snippet was buffered, to measure the flush lag.
+  Buffered = db.ListProperty(datetime.datetime, indexed=False)
+
+  def Append(self, snippets, keys, now):
+    for snippet, key in zip(snippets, keys):
+      self.SnippetKeys.append(key)
+      self.Snippets.append(snippet.Snippet or u'')
+      self.Versions.append(snippet.ExtensionVersion or u'')
+      self.DateStamps.append(snippet.DateStamp)
+      self.Buffered.append(now)
+
+  def GetSnippets(self, limit=None):
+    """Return the buffered snippets as Snippet instances, oldest first."""
+    return [Snippet(key=key, User=self.User, Snippet=text,
+                    ExtensionVersion=version, DateStamp=stamp)
+            for key, text, version, stamp in
+            zip(self.SnippetKeys, self.Snippets, self.Versions,
+                self.DateStamps)[:limit]]
+
+  def Remove(self, count):
+    """Drop the oldest count snippets, returning when they were buffered."""
+    buffered = self.Buffered[:count]
+    for name in ('SnippetKeys', 'Snippets', 'Versions', 'DateStamps',
+                 'Buffered'):
+      setattr(self, name, getattr(self, name)[count:])
+    return buffered
+
+
+def SnippetBufferKey(user):
+  return db.Key.from_path('SnippetBuffer', 'buffer',
+                          parent=SnippetUserKey(user))
+
+
+def _AddFlushTask(buffer_key, countdown):
+  """Add the task that flushes a buffer, within the current transaction."""
+  taskqueue.add(url=FLUSH_URL, params={'key': str(buffer_key)},
+                queue_name=FLUSH_QUEUE, countdown=countdown,
+                transactional=True)
+
+
+def BufferSnippets(user, snippets):
+  """Append unsaved Snippet entities to the user's SnippetBuffer.
+
+  Once this returns the snippets are durable: the buffer and the task that
+  flushes it are committed in one transaction.
+
+  Args:
+    user: User object.
+    snippets: List of validated, unsaved Snippet entities.
+
+  Raises:
+    BufferFullError: The buffer already holds MAX_BUFFERED snippets.
+  """
+  buffer_key = SnippetBufferKey(user)
+  first, last = db.allocate_ids(
+      db.Key.from_path('Snippet', 1, parent=SnippetUserKey(user)),
+      len(snippets))
+  keys = [db.Key.from_path('Snippet', snippet_id, parent=SnippetUserKey(user))
+          for snippet_id in xrange(first, last + 1)]
+  now = datetime.datetime.utcnow()
+
+  def _Txn():
+    snippet_buffer = db.get(buffer_key)
+    if snippet_buffer is None:
+      snippet_buffer = SnippetBuffer(key=buffer_key, User=user)
+    if len(snippet_buffer.SnippetKeys) + len(snippets) > MAX_BUFFERED:
+      raise BufferFullError('%s has %d buffered snippets.' %
+                            (user, len(snippet_buffer.SnippetKeys)))
+    if not snippet_buffer.SnippetKeys:
+      _AddFlushTask(buffer_key, FLUSH_DELAY)
+    snippet_buffer.Append(snippets, keys, now)
+    snippet_buffer.put()
+  db.run_in_transaction(_Txn)
+  snippet_buffer_stats.Incr('appended', len(snippets))
+
+
+def FlushSnippetBuffer(buffer_key, limit=FLUSH_BATCH):
+  """Move the oldest snippets of a SnippetBuffer into Snippet entities.
+
+  The snippets are put and removed from the buffer in one transaction, so
+  every buffered snippet is stored exactly once. A buffer with more than
+  limit snippets gets another flush task.
+
+  Args:
+    buffer_key: Key of the SnippetBuffer.
+    limit: Most snippets moved in the transaction.
+
+  Returns:
+    Number of snippets flushed.
+  """
+
+  def _Txn():
+    snippet_buffer = db.get(buffer_key)
+    if snippet_buffer is None:
+      return None, [], []
+    snippets = snippet_buffer.GetSnippets(limit)
+    buffered = snippet_buffer.Remove(len(snippets))
+    if snippet_buffer.SnippetKeys:
+      snippet_buffer.put()
+      _AddFlushTask(buffer_key, 0)
+    else:
+      snippet_buffer.delete()
+    db.put(snippets)
+    return snippet_buffer.User, snippets, buffered
+  user, snippets, buffered = db.run_in_transaction(_Txn)
+  if not snippets:
+    return 0
+  now = datetime.datetime.utcnow()
+  lag = sum([now - stamp for stamp in buffered], datetime.timedelta())
+  snippet_buffer_stats.Incr('flushed', len(snippets))
+  snippet_buffer_stats.Incr('flush_lag_ms',
+                            lag.days * 86400000 + lag.seconds * 1000 +
+                            lag.microseconds // 1000)
+  _UpdateDerived(user, snippets)
+  return len(snippets)
+
+
+def FlushUserSnippetBuffer(user):
+  """Store every snippet in a user's SnippetBuffer, e.g. before a full read.
+
+  Returns:
+    Number of snippets flushed.
+  """
+  buffer_key = SnippetBufferKey(user)
+  flushed = 0
+  while True:
+    count = FlushSnippetBuffer(buffer_key)
+    if not count:
+      return flushed
+    flushed += count
+
+
+class BufferedSave(PendingSave):
+  """Snippets appended to the user's SnippetBuffer instead of being put.
+
+  GetResult appends them, and falls back to a put when the buffer is full.
+  """
+
+  def __init__(self, user, entities, results):
+    PendingSave.__init__(self, user, [], results)
+    self.entities = entities
+    self._buffered = False
+
+  def GetResult(self):
+    if self._status is None and self.entities:
+      try:
+        BufferSnippets(self.user, self.entities)
+      except BufferFullError, err:
+        logging.warning('Writing through: %s', err)
+        snippet_buffer_stats.Incr('write_through', len(self.entities))
+        self._rpc = db.put_async(self.entities)
+        return PendingSave.GetResult(self)
+      except (db.Timeout, db.InternalError, db.TransactionFailedError), err:
+        logging.debug('Caught exception, buffering failed.')
+        self._status = (False, err or 'Snipper hit an error. 500 chars max.')
+      else:
+        self._buffered = True
+        self._status = (True, '')
+    return [result or self._status for result in self._results]
+
+  def Finish(self):
+    self.GetResult()
+    if self._buffered:
+      if not self._finished:
+        self._finished = True
+        # The snippets are not stored yet, but reads merge in the buffer.
+        BumpSnippetGeneration(self.user)
+    else:
+      PendingSave.Finish(self)
 
-  logging.debug('worked')
-  return True, ''
 
+def GetSnippetBufferStats():
+  """Return the write-behind counts, the mean flush lag and the backlog."""
+  stats = snippet_buffer_stats.Get()
+  stats['mean_flush_lag_ms'] = (stats['flushed'] and
+                                stats['flush_lag_ms'] / stats['flushed'])
+  stats['outstanding'] = stats['appended'] - stats['flushed']
+  return stats
 
-def FetchSnippets(user=None, offset=0, limit=1000):
+
+def FetchSnippets(user=None, offset=0, limit=None):
   """Fetch the user's snippets.
 
   Args:
     user: User object to specify in the datastore query.
     offset: Number of weeks to offset (0= this week, 1=last week).
-    limit: Number of snippets to return (max=1000).
+    limit: Number of snippets to return, or None for all of them.
 
   Returns:
     List of user's snippets.
   """
   if user is None:
     user = users.get_current_user()
-  snipper_user = GetSnippetUser(user)
-  day = snipper_user.reset_day
-  hour = snipper_user.reset_hour
-  tz = pytz.timezone(snipper_user.timezone)
-  start_date = util.GetLastWeekDay(day, offset, hour, tz)
-  end_date = util.GetNextWeekDay(day, offset, hour, tz)
-
-  logging.info('FetchSnippets from %s to %s for %s',
-               start_date, end_date, user)
-
-  cachekey = 'snippets_%s_%d' % (str(user), offset)
-  logging.info('Memcache key: %s', cachekey)
-  cachetime = 1
-  snippets = memcache.get(cachekey)
-  if snippets is None:
-    logging.debug('Memcache did not have snippets, fetching.')
-    query = db.Query(Snippet).filter('User =', user)
-    query.filter('DateStamp >=', start_date).filter('DateStamp <=', end_date)
-    query.order('DateStamp')
-    snippets = query.fetch(limit=limit)
-    if not memcache.set(cachekey, snippets, cachetime):
-      logging.debug('Memcache set failed for fetchSnippets')
-
-  return snippets
+  window = GetWeekWindow(GetSnippetUser(user), offset)
+  return FetchSnippetWeeks(user, [window])[0][:limit]
+
+
+def FetchSnippetWeeks(user, windows):
+  """Fetch the user's snippets for several weeks with batched RPCs.
+
+  All of the weeks are looked up in memcache with one get_multi, the misses
+  are read from their SnippetWeek buckets with one batch get, and only weeks
+  without a complete bucket fall back to a range query.
+
+  Args:
+    user: User object.
+    windows: List of util.WeekWindow instances.
+
+  Returns:
+    List of lists of Snippet instances, one list per window.
+  """
+  generation = GetSnippetGeneration(user)
+  # Key on the week itself rather than the offset, since an offset points at
+  # a different week after every reset.
+  cachekeys = ['snippets_%s_%d_%d' % (
+      str(user), generation, calendar.timegm(window.start.utctimetuple()))
+               for window in windows]
+  logging.info('Memcache keys: %s', cachekeys)
+  cached = memcache.get_multi(cachekeys)
+  misses = [i for i, cachekey in enumerate(cachekeys) if cachekey not in cached]
+  snippet_cache_stats.Incr('hits', len(windows) - len(misses))
+  if misses:
+    logging.debug('Memcache did not have %d weeks, fetching.', len(misses))
+    snippet_cache_stats.Incr('misses', len(misses))
+    keys = [SnippetWeekKey(user, windows[i].start) for i in misses]
+    buffered = []
+    if config.WRITE_BEHIND:
+      # The user's write-behind buffer is read in the same batch get.
+      weeks = db.get(keys + [SnippetBufferKey(user)])
+      snippet_buffer = weeks.pop()
+      buffered = snippet_buffer and snippet_buffer.GetSnippets() or []
+    else:
+      weeks = db.get(keys)
+    to_cache = {}
+    for i, week in zip(misses, weeks):
+      if week is None or not week.Complete:
+        logging.debug('No complete snippet week, building from a query.')
+        week = _BuildSnippetWeek(user, windows[i].start, windows[i].end)
+      snippets = week.GetSnippets()
+      if buffered:
+        snippets = _MergeBuffered(snippets, buffered, windows[i])
+      cached[cachekeys[i]] = to_cache[cachekeys[i]] = snippets
+    if memcache.set_multi(to_cache, SNIPPET_CACHE_TIME):
+      logging.debug('Memcache set failed for FetchSnippetWeeks')
+  return [cached[cachekey] for cachekey in cachekeys]
+
+
+def _MergeBuffered(snippets, buffered, window):
+  """Add the buffered snippets in a week to its stored ones, oldest first."""
+  start, end = _ToUtc(window.start), _ToUtc(window.end)
+  keys = set(snippet.key() for snippet in snippets)
+  snippets = snippets + [snippet for snippet in buffered
+                         if start <= snippet.DateStamp <= end and
+                         snippet.key() not in keys]
+  return sorted(snippets, key=lambda snippet: snippet.DateStamp)
 
 
 class SnippetUser(db.Model):
@@ -120,11 +1100,122 @@ class SnippetUser(db.Model):
   # UTC day/hour from above, used for efficient cron/datastore queries.
   utc_reset_day = db.IntegerProperty(default=1, choices=range(0, 7))
   utc_reset_hour = db.IntegerProperty(default=3, choices=range(0, 24))
+  # UTC datetime of the next weekly report, used by the report scheduler.
+  next_report_at = db.DateTimeProperty()
+
+  def ScheduleNextReport(self, after=None):
+    """Set next_report_at to the first reset after the given UTC datetime."""
+    self.next_report_at = util.GetNextResetUtc(self.reset_day, self.reset_hour,
+                                               self.timezone, after)
+
+
+class MigrationState(db.Model):
+  """Datastore model for the progress of a batch migration.
+
+  The key name is the name of the migration.
+  """
+  Cursor = db.TextProperty()
+  Migrated = db.IntegerProperty(default=0)
+  Done = db.BooleanProperty(default=False)
+  DateStamp = db.DateTimeProperty(auto_now=True)
+
+
+def IsMigrationDone(name):
+  """Return whether the named migration has finished.
+
+  Finished migrations are remembered on the instance, unfinished ones are
+  cached in memcache for MIGRATION_STATE_CACHE_TIME seconds.
+  """
+  if name in _finished_migrations:
+    return True
+  cache_key = 'migration_done_%s' % name
+  done = memcache.get(cache_key)
+  if done is None:
+    state = MigrationState.get_by_key_name(name)
+    done = bool(state and state.Done)
+    memcache.set(cache_key, done, MIGRATION_STATE_CACHE_TIME)
+  if done:
+    _finished_migrations.add(name)
+  return done
+
+
+def SnippetUserKeyName(user):
+  """Return the key name of the SnippetUser of a user."""
+  return 'user:%s' % user.email()
+
+
+def SnippetUserKey(user):
+  """Return the datastore key of the SnippetUser of a user."""
+  return db.Key.from_path('SnippetUser', SnippetUserKeyName(user))
+
+
+def MigrateSnippetUsers(snippet_users):
+  """Copy SnippetUsers saved with numeric ids to their key names.
+
+  The copies are stored before the old entities are deleted, so a user is
+  never missing. If a copy was already stored, e.g. by GetSnippetUser, it is
+  kept and only the old entity is deleted.
+
+  Args:
+    snippet_users: List of SnippetUser entities.
+
+  Returns:
+    List of the SnippetUsers stored under their key names, in the same order.
+  """
+  legacy = [snippet_user for snippet_user in snippet_users
+            if snippet_user.key().name() !=
+            SnippetUserKeyName(snippet_user.User)]
+  if not legacy:
+    return snippet_users
+  keys = [SnippetUserKey(snippet_user.User) for snippet_user in legacy]
+  existing = db.get(keys)
+  migrated = {}
+  copies = []
+  for snippet_user, key, current in zip(legacy, keys, existing):
+    if current is None:
+      values = dict((name, getattr(snippet_user, name))
+                    for name in SnippetUser.properties())
+      current = SnippetUser(key_name=key.name(), **values)
+      copies.append(current)
+    migrated[snippet_user.key()] = current
+  db.put(copies)
+  db.delete(legacy)
+  InvalidateSnippetUsers(legacy)
+  return [migrated.get(snippet_user.key(), snippet_user)
+          for snippet_user in snippet_users]
+
+
+class _CachedSnippetUser(object):
+  """A SnippetUser in the instance cache, with the generation it was at."""
+
+  def __init__(self, snippet_user, generation):
+    self.snippet_user = snippet_user
+    self.generation = generation
+    self.checked = time.time()
+
+
+def _SnippetUserKeys(user):
+  return 'SnippetUser-%s' % user, 'SnippetUser-gen-%s' % user
+
+
+def _GetSnippetUserGeneration(gen_key):
+  """Return the generation of a SnippetUser, starting it if it is missing."""
+  generation = memcache.get(gen_key)
+  if generation is None:
+    generation = int(time.time() * 1000)
+    if not memcache.add(gen_key, generation):
+      generation = memcache.get(gen_key) or generation
+  return generation
 
 
 def GetSnippetUser(user=None):
   """Try to get the Snipper user from the datastore, create if not.
 
+  Users are cached in two tiers: an LRU cache on this instance, then
+  memcache. An instance cache entry is used without any RPC for
+  SNIPPET_USER_TTL seconds, then revalidated against a generation in
+  memcache that every write bumps, so writes reach all instances.
+
   Args:
     user: User object.
 
@@ -134,22 +1225,336 @@ def GetSnippetUser(user=None):
   if user is None:
     user = users.get_current_user()
   logging.debug('GetSnippetUser call for %s', user)
+  cached = _snippet_user_cache.Get(str(user))
+  if cached and time.time() - cached.checked < SNIPPET_USER_TTL:
+    snippet_user_stats.Incr('instance_hits')
+    return cached.snippet_user
+
+  memcache_key, gen_key = _SnippetUserKeys(user)
+  generation = _GetSnippetUserGeneration(gen_key)
+  if cached and cached.generation == generation:
+    snippet_user_stats.Incr('instance_revalidations')
+    cached.checked = time.time()
+    return cached.snippet_user
+
   logging.debug('Trying memcache first...')
-  memcache_key = 'SnippetUser-' + str(user)
   snippet_user = memcache.get(memcache_key)
-  # Added a check for the timezone to ensure the SnipperUser version is updated.
-  if snippet_user and snippet_user.timezone:
+  # Added a check for the timezone to ensure the SnipperUser version is updated,
+  # and for the key name so users cached before their migration are reloaded.
+  if (snippet_user and snippet_user.timezone and
+      snippet_user.key().name() == SnippetUserKeyName(user)):
     logging.debug('Memcache worked, returning.')
-    return snippet_user
+    snippet_user_stats.Incr('memcache_hits')
   else:
-    snippet_user = db.Query(SnippetUser).filter('User = ', user).get()
+    snippet_user_stats.Incr('datastore_loads')
+    snippet_user = SnippetUser.get_by_key_name(SnippetUserKeyName(user))
+    if snippet_user is None and not IsMigrationDone(SNIPPET_USER_MIGRATION):
+      # Fall back to the old lookup, and move the user over while here.
+      snippet_user = db.Query(SnippetUser).filter('User = ', user).get()
+      if snippet_user is not None:
+        snippet_user = MigrateSnippetUsers([snippet_user])[0]
     if snippet_user is None:
       logging.info('Adding new Snipper user: %s', user)
       timezone = util.GetUserTimezone(user.nickname())
-      snippet_user = SnippetUser()
+      snippet_user = SnippetUser(key_name=SnippetUserKeyName(user))
       snippet_user.User = user  # pylint: disable-msg=C6409
       if timezone:
         snippet_user.timezone = timezone
+      snippet_user.ScheduleNextReport()
       db.put(snippet_user)
     memcache.set(memcache_key, snippet_user)
-    return snippet_user
+  _snippet_user_cache.Set(str(user), _CachedSnippetUser(snippet_user,
+                                                         generation))
+  return snippet_user
+
+
+def CacheSnippetUser(snippet_user):
+  """Store a SnippetUser that was just saved in both cache tiers.
+
+  Bumping the generation makes other instances reload it once their
+  instance cache entries are due to be revalidated.
+  """
+  user = snippet_user.User
+  memcache_key, gen_key = _SnippetUserKeys(user)
+  memcache.set(memcache_key, snippet_user)
+  generation = memcache.incr(gen_key, initial_value=int(time.time() * 1000))
+  _snippet_user_cache.Set(str(user), _CachedSnippetUser(snippet_user,
+                                                         generation))
+
+
+def InvalidateSnippetUsers(snippet_users):
+  """Drop SnippetUsers from both cache tiers after they were changed."""
+  keys = [_SnippetUserKeys(snippet_user.User) for snippet_user in snippet_users]
+  memcache.delete_multi([memcache_key for memcache_key, _ in keys])
+  memcache.offset_multi(dict((gen_key, 1) for _, gen_key in keys),
+                        initial_value=int(time.time() * 1000))
+  for snippet_user in snippet_users:
+    _snippet_user_cache.Delete(str(snippet_user.User))
+
+
+def ScheduleNextReports(snippet_users, after=None, only_unscheduled=False):
+  """Move SnippetUsers on to their next report without overwriting them.
+
+  Each user is read again in its own transaction and only next_report_at is
+  set, so settings saved since snippet_users were read are kept, and the
+  next report follows them.
+
+  Args:
+    snippet_users: List of SnippetUser entities.
+    after: UTC datetime the next report comes after, by default now.
+    only_unscheduled: Whether to leave users that have a next_report_at.
+  """
+
+  def _Txn(key):
+    snippet_user = db.get(key)
+    if snippet_user is None:
+      return
+    if only_unscheduled and snippet_user.next_report_at is not None:
+      return
+    snippet_user.ScheduleNextReport(after=after)
+    snippet_user.put()
+  for snippet_user in snippet_users:
+    db.run_in_transaction(_Txn, snippet_user.key())
+  InvalidateSnippetUsers(snippet_users)
+
+
+def GetSnippetUserCacheStats():
+  """Return the counts of each GetSnippetUser cache tier and their shares."""
+  stats = snippet_user_stats.Get()
+  total = sum(stats.values())
+  stats['rates'] = dict((tier, total and float(count) / total)
+                        for tier, count in stats.items())
+  return stats
+
+
+class SnippetTerm(db.Model):
+  """Datastore model for the postings of one search term in one year.
+
+  Terms are children of the user's SnippetUser key, with a key name made of
+  the term and the year, so a search starts with a single batch get by key.
+  New postings are added to this head entity. Once it has MAX_POSTINGS of
+  them they are moved to a sealed chunk, a SnippetTerm with the chunk
+  number appended to the key name, and Chunks counts the sealed chunks.
+  """
+  SnippetKeys = db.ListProperty(db.Key, indexed=False)
+  Counts = db.ListProperty(int, indexed=False)
+  DateStamps = db.ListProperty(datetime.datetime, indexed=False)
+  Chunks = db.IntegerProperty(default=0, indexed=False)
+
+  def Seal(self):
+    """Move the postings to a new chunk, and return the chunk to put."""
+    chunk = SnippetTerm(key=self.ChunkKey(self.Chunks),
+                        SnippetKeys=self.SnippetKeys, Counts=self.Counts,
+                        DateStamps=self.DateStamps)
+    self.SnippetKeys, self.Counts, self.DateStamps = [], [], []
+    self.Chunks += 1
+    return chunk
+
+  def ChunkKey(self, number):
+    return db.Key.from_path('SnippetTerm',
+                            '%s|%d' % (self.key().name(), number),
+                            parent=self.parent_key())
+
+  def ChunkKeys(self):
+    return [self.ChunkKey(number) for number in xrange(self.Chunks)]
+
+  def AddPostings(self, postings):
+    """Append (snippet, count) pairs for snippets not already posted."""
+    known = set(self.SnippetKeys)
+    for snippet, count in postings:
+      if snippet.key() not in known:
+        known.add(snippet.key())
+        self.SnippetKeys.append(snippet.key())
+        self.Counts.append(count)
+        self.DateStamps.append(snippet.DateStamp)
+
+
+def Tokenize(text):
+  """Return the normalized search terms of a string, in order."""
+  return [term[:MAX_TERM_LENGTH]
+          for term in _TOKEN_RE.findall((text or u'').lower())
+          if len(term) > 1 and term not in _STOP_WORDS]
+
+
+def SnippetTermKeyName(term, year):
+  return '%s|%d' % (term, year)
+
+
+def IndexSnippets(user, snippets):
+  """Add saved snippets of one user to their search index.
+
+  Args:
+    user: User object.
+    snippets: List of saved Snippet entities of the user.
+  """
+  postings = {}
+  for snippet in snippets:
+    counts = {}
+    for term in Tokenize(snippet.Snippet):
+      counts[term] = counts.get(term, 0) + 1
+    for term, count in counts.items():
+      key_name = SnippetTermKeyName(term, snippet.DateStamp.year)
+      postings.setdefault(key_name, []).append((snippet, count))
+  if not postings:
+    return
+  parent = SnippetUserKey(user)
+  key_names = postings.keys()
+
+  def _Txn():
+    terms = SnippetTerm.get_by_key_name(key_names, parent=parent)
+    chunks = []
+    for i, key_name in enumerate(key_names):
+      if terms[i] is None:
+        terms[i] = SnippetTerm(parent=parent, key_name=key_name)
+      terms[i].AddPostings(postings[key_name])
+      if len(terms[i].SnippetKeys) >= MAX_POSTINGS:
+        chunks.append(terms[i].Seal())
+    db.put(terms + chunks)
+  # All of the terms are in the user's entity group, so this is one
+  # transaction however many terms there are.
+  db.run_in_transaction(_Txn)
+
+
+def IndexSnippetsOfUsers(snippets):
+  """Add saved snippets of any number of users to their search indexes."""
+  by_user = {}
+  for snippet in snippets:
+    by_user.setdefault(snippet.User.email(), (snippet.User, []))[1].append(
+        snippet)
+  for user, user_snippets in by_user.values():
+    IndexSnippets(user, user_snippets)
+
+
+def _EncodeSearchCursor(rank):
+  return base64.urlsafe_b64encode(('%.6f|%d|%s' % rank).encode('utf-8'))
+
+
+def _DecodeSearchCursor(cursor):
+  """Return the rank tuple of a cursor from _EncodeSearchCursor.
+
+  Raises:
+    ValueError: The cursor is not valid.
+  """
+  try:
+    score, stamp, key = base64.urlsafe_b64decode(str(cursor)).split('|', 2)
+    return float(score), int(stamp), key
+  except (TypeError, ValueError):
+    raise ValueError('Invalid cursor %r' % cursor)
+
+
+def SearchSnippets(user, query, limit=20, cursor=None):
+  """Return a user's snippets that match the terms of a query.
+
+  Snippets are ranked by the sum of term frequency times inverse document
+  frequency over the query terms they contain, newest first for equal
+  scores. All of the postings are read with one batch get.
+
+  Args:
+    user: User object.
+    query: Search string.
+    limit: Number of snippets to return.
+    cursor: Cursor returned by a previous search with the same query.
+
+  Returns:
+    List of Snippet entities and the cursor of the next page, or None.
+
+  Raises:
+    ValueError: The cursor is not valid.
+  """
+  after = cursor and _DecodeSearchCursor(cursor)
+  terms = list(set(Tokenize(query)))[:MAX_QUERY_TERMS]
+  if not terms:
+    return [], None
+  years = range(SEARCH_FIRST_YEAR, datetime.datetime.utcnow().year + 1)
+  key_names = [SnippetTermKeyName(term, year)
+               for term in terms for year in years]
+  heads = SnippetTerm.get_by_key_name(key_names, parent=SnippetUserKey(user))
+  entities = [(key_name, head) for key_name, head in zip(key_names, heads)
+              if head is not None]
+  # Sealed chunks are only read for the heads that have them.
+  chunk_keys = []
+  for key_name, head in entities:
+    chunk_keys.extend((key_name, key) for key in head.ChunkKeys())
+  if chunk_keys:
+    entities.extend(zip([key_name for key_name, _ in chunk_keys],
+                        db.get([key for _, key in chunk_keys])))
+  # term -> list of (snippet key, count, datestamp)
+  postings = {}
+  posted = set()
+  for key_name, entity in entities:
+    if entity is None:
+      continue
+    term = key_name.rsplit('|', 1)[0]
+    for posting in zip(entity.SnippetKeys, entity.Counts, entity.DateStamps):
+      # A snippet indexed again after its postings were sealed is posted
+      # twice.
+      if (term, posting[0]) not in posted:
+        posted.add((term, posting[0]))
+        postings.setdefault(term, []).append(posting)
+  matched = len(set(key for term_postings in postings.values()
+                    for key, _, _ in term_postings))
+  scores = {}
+  stamps = {}
+  for term_postings in postings.values():
+    idf = math.log(1.0 + float(matched) / len(term_postings))
+    for key, count, stamp in term_postings:
+      scores[key] = scores.get(key, 0.0) + count * idf
+      stamps[key] = stamp
+  # Ranks sort best first, and are rounded so they survive the cursor.
+  ranked = sorted((-round(score, 6), -calendar.timegm(stamps[key].timetuple()),
+                   str(key)) for key, score in scores.items())
+  if after:
+    ranked = [rank for rank in ranked if rank > after]
+  page = ranked[:limit]
+  next_cursor = None
+  if len(ranked) > limit:
+    next_cursor = _EncodeSearchCursor(page[-1])
+  keys = [db.Key(key) for _, _, key in page]
+  snippets = db.get(keys)
+  missing = [(key, stamps[key]) for key, snippet in zip(keys, snippets)
+             if snippet is None]
+  if missing:
+    archived = _GetArchivedSnippets(user, missing)
+    snippets = [snippet or archived.get(key)
+                for key, snippet in zip(keys, snippets)]
+  return [snippet for snippet in snippets if snippet is not None], next_cursor
+
+
+def _GetArchivedSnippets(user, keys_and_stamps):
+  """Return a dict of the snippets with these keys found in SnippetArchives.
+
+  Args:
+    user: User object.
+    keys_and_stamps: List of (snippet key, naive UTC DateStamp) tuples.
+  """
+  found = {}
+  user_key = SnippetUserKey(user)
+  for key, stamp in keys_and_stamps:
+    if key in found:
+      continue
+    query = SnippetArchive.all().ancestor(user_key)
+    query.filter('WeekStart >', stamp - ARCHIVE_MAX_SPAN)
+    for archive in query.filter('WeekStart <=', stamp).fetch(2):
+      for snippet in archive.GetSnippets(user):
+        found[snippet.key()] = snippet
+  return found
+
+
+class SnippetExport(db.Model):
+  """Datastore model for the progress of an export written to the blobstore.
+
+  Exports are children of the user's SnippetUser key. FileName is the
+  writable Files API name until the export is finished, then BlobKey is set.
+  """
+  User = db.UserProperty()
+  Format = db.StringProperty(indexed=False)
+  Status = db.StringProperty(default='running', indexed=False)
+  # Position from models.IterSnippetBatches, Reader is None before the
+  # first batch and after the last one.
+  Reader = db.StringProperty(indexed=False)
+  Cursor = db.TextProperty()
+  Count = db.IntegerProperty(default=0, indexed=False)
+  FileName = db.StringProperty(indexed=False)
+  BlobKey = db.StringProperty(indexed=False)
+  CreatedDateStamp = db.DateTimeProperty(auto_now_add=True)
+  DateStamp = db.DateTimeProperty(auto_now=True)
@@ -0,0 +1,305 @@
+#!/usr/bin/python2.5
+#
+# Copyright 2012 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""Outbound chat replies, sent in batches off the request path.
+
+Reply adds the message to a pull queue and returns. Dispatcher tasks lease
+the queued replies in batches, send replies with the same body to all of
+their JIDs in one call, keep under a rate limit and retry failed JIDs with
+exponential backoff. The queue sources and the dispatcher task naming are
+shared with the mail dispatcher.
+"""
+
+__author__ = 'erichiggins@gmail.com (Eric Higgins)'
+
+import logging
+import pickle
+import random
+import threading
+import time
+from google.appengine.api import taskqueue
+from google.appengine.api import xmpp
+from google.appengine.ext import webapp
+from google.appengine.runtime import apiproxy_errors
+import mailer
+
+
+OUTBOX_QUEUE = 'xmpp-outbox-queue'
+DISPATCH_QUEUE = 'xmpp-dispatch-queue'
+DISPATCH_URL = '/outbox/dispatch'
+BATCH_SIZE = 100
+# Most JIDs in a single send_message call.
+MAX_JIDS = 50
+# Sends per second, and how many may be sent at once after a quiet spell.
+RATE = 10.0
+BURST = 20
+MAX_ATTEMPTS = 5
+BASE_BACKOFF = 5
+MAX_BACKOFF = 10 * 60
+# Seconds covered by one dispatcher task name, so replies queued together
+# share a dispatcher.
+DISPATCH_WINDOW = 2
+
+# Outcomes of sending to one JID.
+SENT = 'sent'
+RETRY = 'retry'
+INVALID = 'invalid'
+
+
+class PendingReply(object):
+  """A reply being added to the outbox. Wait for it before the request ends."""
+
+  def __init__(self, jid, body):
+    self.jid = jid
+    self.body = body
+    task = taskqueue.Task(payload=pickle.dumps({'jid': jid, 'body': body}),
+                          method='PULL')
+    self._outbox_rpc = taskqueue.Queue(OUTBOX_QUEUE).add_async(task)
+
+  def Wait(self):
+    """Wait for the outbox, and send the reply directly if it failed.
+
+    The dispatcher is only started once the reply is queued, so it can not
+    run before the reply is there to lease.
+    """
+    try:
+      self._outbox_rpc.get_result()
+    except taskqueue.Error:
+      logging.exception('Could not queue the reply to %s, sending it now.',
+                        self.jid)
+      XmppTransport().Send([self.jid], self.body)
+      return
+    StartDispatchers()
+
+
+def StartDispatchers(at=None):
+  """Start the dispatcher of the DISPATCH_WINDOW containing at, or now."""
+  mailer.StartDispatchers(1, at=at, url=DISPATCH_URL,
+                          queue_name=DISPATCH_QUEUE, prefix='xmpp-dispatch',
+                          window=DISPATCH_WINDOW)
+
+
+def Reply(jid, body):
+  """Queue a chat message to a JID without waiting for it to be sent.
+
+  Returns:
+    PendingReply, call its Wait method before the request ends.
+  """
+  return PendingReply(jid, body)
+
+
+class XmppTransport(object):
+  """Send chat messages with the App Engine XMPP API."""
+
+  def Send(self, jids, body):
+    """Send body to every JID, returning the outcome for each of them."""
+    try:
+      statuses = xmpp.send_message(jids, body)
+    except (xmpp.Error, apiproxy_errors.DeadlineExceededError,
+            apiproxy_errors.ApplicationError), err:
+      logging.info('Sending to %d JIDs failed: %s', len(jids), err)
+      return [RETRY] * len(jids)
+    if not isinstance(statuses, list):
+      statuses = [statuses]
+    outcomes = {xmpp.NO_ERROR: SENT, xmpp.INVALID_JID: INVALID}
+    return [outcomes.get(status, RETRY) for status in statuses]
+
+
+class LocalTransport(object):
+  """Record chat messages in memory, as a stand-in for tests and load runs.
+
+  Attributes:
+    sent: List of (jids, body) tuples of every call.
+    fail_rate: Share of JIDs, from 0 to 1, that fail with RETRY.
+    invalid: Set of JIDs that always fail with INVALID.
+  """
+
+  def __init__(self, fail_rate=0.0, invalid=(), seed=0):
+    self.sent = []
+    self.fail_rate = fail_rate
+    self.invalid = set(invalid)
+    self._random = random.Random(seed)
+    self._lock = threading.Lock()
+
+  def Send(self, jids, body):
+    self._lock.acquire()
+    try:
+      self.sent.append((list(jids), body))
+      outcomes = []
+      for jid in jids:
+        if jid in self.invalid:
+          outcomes.append(INVALID)
+        elif self._random.random() < self.fail_rate:
+          outcomes.append(RETRY)
+        else:
+          outcomes.append(SENT)
+      return outcomes
+    finally:
+      self._lock.release()
+
+
+class RateLimiter(object):
+  """Token bucket allowing rate calls per second, in bursts of burst.
+
+  The bucket is kept by the dispatcher task that uses it. Only one task of
+  xmpp-dispatch-queue runs at a time, see queue.yaml, so RATE holds for the
+  whole app.
+  """
+
+  def __init__(self, rate=RATE, burst=BURST, clock=time.time,
+               sleep=time.sleep):
+    self.rate = rate
+    self.burst = burst
+    self._clock = clock
+    self._sleep = sleep
+    self._tokens = float(burst)
+    self._updated = clock()
+
+  def Wait(self):
+    """Block until a call is allowed, and take it."""
+    while True:
+      now = self._clock()
+      self._tokens = min(self.burst,
+                         self._tokens + (now - self._updated) * self.rate)
+      self._updated = now
+      if self._tokens >= 1:
+        self._tokens -= 1
+        return
+      self._sleep((1 - self._tokens) / self.rate)
+
+
+class DispatchStats(object):
+  """Counts of what a Dispatcher run did."""
+
+  def __init__(self):
+    self.messages = 0
+    self.sends = 0
+    self.retried = 0
+    self.dropped = 0
+    self.started = time.time()
+    self.finished = None
+
+  def AsDict(self):
+    elapsed = (self.finished or time.time()) - self.started
+    return {'messages': self.messages, 'sends': self.sends,
+            'retried': self.retried, 'dropped': self.dropped,
+            'seconds': round(elapsed, 3),
+            'messages_per_send': self.sends and round(
+                float(self.messages) / self.sends, 2)}
+
+
+class Dispatcher(object):
+  """Lease queued replies in batches and send them grouped by body.
+
+  Attributes:
+    source: Where replies are leased from, e.g. a mailer.PullQueueSource.
+    transport: Object with a Send(jids, body) method returning outcomes.
+    limiter: RateLimiter that every send waits on.
+    batch_size: Number of replies leased at a time.
+    max_attempts: Attempts before a reply is dropped.
+    base_backoff: Seconds before the first retry, doubled for each attempt.
+  """
+
+  def __init__(self, source, transport, limiter=None, batch_size=BATCH_SIZE,
+               max_attempts=MAX_ATTEMPTS, base_backoff=BASE_BACKOFF):
+    self.source = source
+    self.transport = transport
+    self.limiter = limiter or RateLimiter()
+    self.batch_size = batch_size
+    self.max_attempts = max_attempts
+    self.base_backoff = base_backoff
+    self.stats = DispatchStats()
+    # Epoch seconds at which the replies this dispatcher retried are
+    # leasable.
+    self.retry_times = set()
+
+  def Backoff(self, attempts):
+    """Return the seconds to wait before the next attempt."""
+    return min(self.base_backoff * 2 ** (attempts - 1), MAX_BACKOFF)
+
+  def PendingRetries(self):
+    """Return the times of retries that were not leasable before Run ended.
+
+    Nothing else leases those replies, so a dispatcher has to be started for
+    each of these times.
+    """
+    return sorted(when for when in self.retry_times
+                  if when > self.stats.finished)
+
+  def Run(self, deadline=None):
+    """Send replies until the source is empty or the deadline passes.
+
+    Returns:
+      True if the source was drained, False if the deadline was reached.
+    """
+    stop_at = deadline and time.time() + deadline
+    while not stop_at or time.time() < stop_at:
+      jobs = self.source.Lease(self.batch_size)
+      if not jobs:
+        self.stats.finished = time.time()
+        return True
+      self.SendBatch(jobs)
+    self.stats.finished = time.time()
+    return False
+
+  def SendBatch(self, jobs):
+    """Send a batch of leased replies, one call per body and MAX_JIDS."""
+    by_body = {}
+    for job in jobs:
+      by_body.setdefault(job.payload['body'], []).append(job)
+    finished = []
+    for body, body_jobs in by_body.items():
+      for i in xrange(0, len(body_jobs), MAX_JIDS):
+        group = body_jobs[i:i + MAX_JIDS]
+        self.limiter.Wait()
+        outcomes = self.transport.Send([job.payload['jid'] for job in group],
+                                       body)
+        self.stats.sends += 1
+        for job, outcome in zip(group, outcomes):
+          if outcome == SENT:
+            self.stats.messages += 1
+            finished.append(job)
+          elif outcome == RETRY and job.attempts < self.max_attempts:
+            self.stats.retried += 1
+            delay = self.Backoff(job.attempts)
+            self.source.Retry(job, delay)
+            self.retry_times.add(time.time() + delay)
+          else:
+            logging.warning('Dropping the reply to %s after %d attempts: %s',
+                            job.payload['jid'], job.attempts, outcome)
+            self.stats.dropped += 1
+            finished.append(job)
+    self.source.Done(finished)
+
+
+class OutboxWorker(webapp.RequestHandler):
+  """Task that sends queued replies until the outbox is empty."""
+
+  # Stop leasing new batches with time left to finish the current one.
+  DEADLINE = 8 * 60
+
+  def post(self):  # pylint: disable-msg=C6409
+    dispatcher = Dispatcher(mailer.PullQueueSource(OUTBOX_QUEUE),
+                            XmppTransport())
+    drained = dispatcher.Run(deadline=self.DEADLINE)
+    logging.info('Outbox dispatcher finished: %s', dispatcher.stats.AsDict())
+    if not drained:
+      taskqueue.Task(url=DISPATCH_URL).add(queue_name=DISPATCH_QUEUE)
+    # Retried replies are leased by a dispatcher started for their window.
+    mailer.StartRetryDispatchers(dispatcher, url=DISPATCH_URL,
+                                 queue_name=DISPATCH_QUEUE,
+                                 prefix='xmpp-dispatch',
+                                 window=DISPATCH_WINDOW)
@@ -18,21 +18,19 @@
 
 __author__ = 'erichiggins@gmail.com (Eric Higgins)'
 
+import calendar
 import datetime
 import logging
 import os
 os.environ['DJANGO_SETTINGS_MODULE'] = 'appengine_config'
 from google.appengine import dist  # pylint: disable-msg=C6204
 dist.use_library('django', '1.1')
-from google.appengine.api import mail  # pylint: disable-msg=C6204
-from google.appengine.api import memcache
+from google.appengine.api import taskqueue  # pylint: disable-msg=C6204
 from google.appengine.api import users
-from google.appengine.api.labs import taskqueue
-from google.appengine.ext import deferred
+from google.appengine.ext import db
 from google.appengine.ext import ereporter
 from google.appengine.ext import webapp
-from google.appengine.ext.webapp import util as webapputil
-from google.appengine.runtime import DeadlineExceededError
+import mailer
 import models
 import pytz
 import util
@@ -40,13 +38,143 @@ import util
 
 ereporter.register_logger()
 
+# Number of users each fan-out task fetches and builds digests for. The number
+# of pages processed in parallel is set by max_concurrent_requests on the
+# snippet-fanout-queue in queue.yaml.
+REPORT_PAGE_SIZE = 50
+
+
+# Query schedules. DUE finds every user whose next_report_at has passed,
+# LEGACY finds users saved before next_report_at existed by their UTC reset,
+# until /migrate/next-report has given every user a next_report_at.
+DUE = 'due'
+LEGACY = 'legacy'
+
+
+def _DueUsersQuery(schedule, now, keys_only=False):
+  """Return the query for users whose weekly report is due.
+
+  Args:
+    schedule: DUE or LEGACY.
+    now: Naive UTC datetime of the run.
+    keys_only: Whether to return only the keys.
+
+  Returns:
+    db.Query of SnippetUser entities.
+  """
+  user_query = models.SnippetUser.all(keys_only=keys_only)
+  user_query.filter('mail_snippets =', True)
+  if schedule == DUE:
+    # One indexed range scan also picks up users from skipped cron hours.
+    user_query.filter('next_report_at <=', now)
+    return user_query.order('next_report_at')
+  # Users saved before next_report_at existed don't have the property, so
+  # they are in no index on it. FetchPage skips users that do have it.
+  user_query.filter('utc_reset_day =', now.weekday())
+  user_query.filter('utc_reset_hour =', now.hour)
+  return user_query.order('User')
+
+
+def SplitDueUsers(schedule, now, page_size=REPORT_PAGE_SIZE):
+  """Split the due users into (start_cursor, end_cursor) ranges.
+
+  This only walks a keys-only query, which is cheap compared to loading the
+  users, so the expensive work can be spread across parallel tasks.
+
+  Args:
+    schedule: DUE or LEGACY.
+    now: Naive UTC datetime of the run.
+    page_size: Number of users in each range.
+
+  Returns:
+    List of (start_cursor, end_cursor) tuples. The last end_cursor is None.
+  """
+  ranges = []
+  query = _DueUsersQuery(schedule, now, keys_only=True)
+  start_cursor = None
+  while True:
+    keys = query.fetch(page_size)
+    if len(keys) < page_size:
+      if keys:
+        ranges.append((start_cursor, None))
+      return ranges
+    end_cursor = query.cursor()
+    ranges.append((start_cursor, end_cursor))
+    start_cursor = end_cursor
+    query.with_cursor(start_cursor)
+
+
+def BuildDigest(user, snipper_user, snippet_results, since):
+  """Return the mail task params for a user's digest, or None if empty.
+
+  Args:
+    user: User object.
+    snipper_user: SnippetUser of the user.
+    snippet_results: List of Snippet entities to send.
+    since: Timezone-aware datetime the digest starts at.
+
+  Returns:
+    Dict of mail params, or None.
+  """
+  if not snippet_results:
+    logging.info('snippet_results is empty...')
+    return None
+  user_tz = util.GetTimezone(snipper_user.timezone)
+  snippet_format = snipper_user.snippet_format
+  date_format = str(snipper_user.date_format)
+  datestamp = since.astimezone(user_tz).strftime(date_format)
+  # Format each snippet according to the user's preference.
+  try:
+    snippets = [snippet_format % s.Snippet for s in snippet_results]
+  except TypeError:
+    logging.debug('%s has an invalid snippet_format: "%s"',
+                  user, snippet_format)
+    snippets = ['- %s' % s.Snippet for s in snippet_results]
+  if not snippets:
+    logging.info('No snippets to mail...')
+    return None
+  return {
+      'user': user.nickname(),
+      'email': user.email(),
+      'datestamp': datestamp,
+      'snippets': '\n'.join(snippets),
+  }
+
+
+def _StartWeekBefore(user, report_at):
+  """Start reading the snippets a user added in the 7 days before report_at.
+
+  Returns:
+    models.PendingSnippets, whose GetResult returns them oldest first.
+  """
+  start_date = report_at - datetime.timedelta(days=7)
+  # Only the text is mailed, so skip loading the rest of each entity.
+  return models.PendingSnippets(user, [('DateStamp >=', start_date),
+                                       ('DateStamp <', report_at)],
+                                projection=('DateStamp', 'Snippet'))
+
+
+def _AddTasks(queue_name, tasks):
+  """Add tasks to a queue in batches, rather than one RPC per task."""
+  queue = taskqueue.Queue(queue_name)
+  # The task queue API takes at most 100 tasks per call.
+  for i in xrange(0, len(tasks), 100):
+    queue.add(tasks[i:i + 100])
+
+
+def _AddMailTasks(mail_params):
+  """Queue the digests for the mail dispatchers."""
+  if mail_params:
+    logging.info('Queueing %d digests.', len(mail_params))
+    mailer.QueueDigests(mail_params)
+
 
 class SnippetFetchWorker(webapp.RequestHandler):
   """Worker designed to fetch and mail a user their snippets."""
 
   def get(self):  # pylint: disable-msg=C6409
-    """Handle initial request and spawn a fetch worker."""
-    now = datetime.datetime.now(pytz.utc)
+    """Handle initial request and fan out fetch workers."""
+    now = datetime.datetime.utcnow().replace(second=0, microsecond=0)
     use_force = bool(self.request.get('use_force', False))
     is_cron = self.request.headers.get('X-Appengine-Cron') == 'true'
     logging.info('Headers %s', self.request.headers)
@@ -57,177 +185,132 @@ class SnippetFetchWorker(webapp.RequestHandler):
       offset = 0
     params = {
         'offset': offset,
-        'utc_reset_day': now.weekday(),
-        'utc_reset_hour': now.hour,
+        'now': calendar.timegm(now.utctimetuple()),
     }
-    if use_force:
+    if use_force and users.is_current_user_admin():
       params['use_force'] = '1'
+    else:
+      use_force = False
     if is_cron:
       params['is_cron'] = '1'
-    if user:
-      params['email'] = user.email()
-    logging.info('Starting fetch chain with params %s', params)
-    fetch_task = taskqueue.Task(url='/report/fetch', params=params)
-    fetch_task.add(queue_name='snippet-fetch-queue')
+
+    if is_cron or use_force:  # Fan out over all users that are due.
+      try:
+        page_size = int(self.request.get('page_size', REPORT_PAGE_SIZE))
+      except ValueError:
+        page_size = REPORT_PAGE_SIZE
+      params['page_size'] = page_size
+      tasks = []
+      for schedule in (DUE, LEGACY):
+        ranges = SplitDueUsers(schedule, now, page_size)
+        logging.info('Fanning out %d %s fetch tasks with params %s',
+                     len(ranges), schedule, params)
+        for start_cursor, end_cursor in ranges:
+          page_params = dict(params, schedule=schedule,
+                             start_cursor=start_cursor or '',
+                             end_cursor=end_cursor or '')
+          tasks.append(taskqueue.Task(url='/report/fetch', params=page_params))
+      _AddTasks('snippet-fanout-queue', tasks)
+    else:
+      if user:
+        params['email'] = user.email()
+      logging.info('Starting fetch with params %s', params)
+      fetch_task = taskqueue.Task(url='/report/fetch', params=params)
+      fetch_task.add(queue_name='snippet-fetch-queue')
 
     if not is_cron:
       return self.redirect('/?msg=Snippets+sent.')
 
   def post(self):  # pylint: disable-msg=C6409
-    """Fetch the snippets for this user and create a mail-worker if needed."""
-    is_cron = bool(self.request.get('is_cron'))
-    last_cursor = self.request.get('cursor')
-    cursor = None
-    utc_reset_day = int(self.request.get('utc_reset_day'))
-    utc_reset_hour = int(self.request.get('utc_reset_hour'))
-    offset = int(self.request.get('offset', 0))
+    """Fetch the snippets for a page of users, or a single user."""
+    if self.request.get('now'):
+      now = datetime.datetime.utcfromtimestamp(int(self.request.get('now')))
+    else:
+      # Tasks added before the fan-out passed its time along.
+      now = datetime.datetime.utcnow().replace(second=0, microsecond=0)
+    if self.request.get('page_size'):
+      return self.FetchPage(now)
+
     user = users.get_current_user()
     email = self.request.get('email')
     if email and not user:
       logging.info(email)
       user = users.User(email)
-    use_force = False
-    logging.info('fetch worker called. is_cron: %s, user: %s, cursor: %s',
-                 is_cron, user, last_cursor)
-    if user and users.is_current_user_admin():  # Only admins may use force.
-      use_force = bool(self.request.get('use_force'))
-      logging.info('admin %s requests use of force %s!', user.email(),
-                   use_force)
-    if last_cursor:  # If last_cursor exists, it must persist and continue.
-      logging.info('last_cursor exists, setting is_cron and use_force to True.')
-      is_cron = True
-      use_force = True
-
-    if is_cron or use_force:  # Fetch all users.
-      logging.info('fetching next user...')
-      offset = 1
-      user_query = models.SnippetUser.all()
-      user_query.filter('mail_snippets =', True)
-      user_query.filter('utc_reset_day =', utc_reset_day)
-      user_query.filter('utc_reset_hour =', utc_reset_hour)
-      if last_cursor:
-        user_query.with_cursor(last_cursor)
-      snipper_user = user_query.order('User').get()
-      if not snipper_user:  # No more users, time to quit.
-        logging.info('No more users, delete the cursor and quit.')
-        return
-      user = snipper_user.User
-      cursor = user_query.cursor()
-      logging.info('Found user %s and stored cursor %s.', user, cursor)
-    else:
-      logging.info('fetching single user...')
-      offset = int(self.request.get('offset', default_value=0))
-      snipper_user = models.GetSnippetUser(user)
-
-    logging.info('User is %s', user)
+    logging.info('fetch worker called for a single user: %s', user)
     if user is None:
       return
-    # Get snippets.
-    if is_cron or use_force:
-      # TODO(erichiggins): Clean this up. Consider verifying the dates from
-      # GetLastWeekday and use that to determine the proper offset value.
-      # Just get snippets from 7 days ago until now.
-      start_date = (datetime.datetime.utcnow().replace(second=0, microsecond=0)
-                    - datetime.timedelta(days=7))
-      query = models.Snippet.all().filter('User =', user)
-      query.filter('DateStamp >=', start_date)
-      query.order('DateStamp')
-      snippet_results = query.fetch(limit=1000)
-    else:
-      # Clear out memcache, the reset messes up results.
-      memcache.delete_multi(['snippets_%s_%d' % (str(user), x) for x in (0, 1)])
-      snippet_results = models.FetchSnippets(user=user, offset=offset)
+    offset = int(self.request.get('offset', default_value=0))
+    snipper_user = models.GetSnippetUser(user)
+    snippet_results = models.FetchSnippets(user=user, offset=offset)
     logging.debug('%s has %s snippets.', user.nickname(), len(snippet_results))
+    since = models.GetWeekWindow(snipper_user, offset).start
+    digest = BuildDigest(user, snipper_user, snippet_results, since)
+    _AddMailTasks(filter(None, [digest]))
 
-    if snippet_results:
-      user_tz = pytz.timezone(snipper_user.timezone)
-      datestamp = util.GetLastWeekDay(utc_reset_day,
-                                      offset=offset,
-                                      hour=utc_reset_hour,
-                                      tz=pytz.utc)
-      snippet_format = snipper_user.snippet_format
-      date_format = str(snipper_user.date_format)
-      datestamp = datestamp.astimezone(user_tz).strftime(date_format),
-      # Format each snippet according to the user's preference.
-      try:
-        snippets = [snippet_format % s.Snippet for s in snippet_results]
-      except TypeError:
-        logging.debug('%s has an invalid snippet_format: "%s"',
-                      user, snippet_format)
-        snippets = ['- %s' % s.Snippet for s in snippet_results]
-      if snippets:
-        # Add a task to the queue to send an email to each snipper user.
-        mail_params = {
-            'user': user.nickname(),
-            'email': user.email(),
-            'datestamp': datestamp,
-            'snippets': '\n'.join(snippets),
-        }
-        logging.info('Creating mail task with params: %s', mail_params)
-        mail_task = taskqueue.Task(url='/report/mail', params=mail_params)
-        mail_task.add(queue_name='snippet-mail-queue')
-      else:
-        logging.info('No snippets to mail...')
-    else:
-      logging.info('snippet_results is empty...')
-
-    if is_cron:  # Run the next fetch worker.
-      params = {
-          'is_cron': is_cron,
-          'offset': offset,
-          'use_force': int(use_force),
-          'utc_reset_day': utc_reset_day,
-          'utc_reset_hour': utc_reset_hour,
-          'cursor': cursor,
-      }
-      logging.info('params for next run: %s', params)
-      fetch_task = taskqueue.Task(url='/report/fetch', params=params)
-      fetch_task.add(queue_name='snippet-fetch-queue')
+  def FetchPage(self, now):
+    """Build digests for every user in one fan-out cursor range."""
+    page_size = int(self.request.get('page_size'))
+    schedule = self.request.get('schedule', DUE)
+    start_cursor = self.request.get('start_cursor') or None
+    end_cursor = self.request.get('end_cursor') or None
+    logging.info('fetch worker called for a page of %d %s users from %s to %s',
+                 page_size, schedule, start_cursor, end_cursor)
+    user_query = _DueUsersQuery(schedule, now)
+    user_query.with_cursor(start_cursor, end_cursor)
+    mail_params = []
+    # Move users still saved under numeric ids to their key names first, so
+    # the put below never writes back a user the migration just deleted.
+    snipper_users = models.MigrateSnippetUsers(user_query.fetch(page_size))
+    if schedule == LEGACY:
+      # Scheduled users are mailed by the DUE query instead.
+      snipper_users = [snipper_user for snipper_user in snipper_users
+                       if snipper_user.next_report_at is None]
+    # Report on the week that ended at the reset that was due, even when the
+    # cron hour for that reset was missed. Legacy users reset on the hour of
+    # this run.
+    report_times = [snipper_user.next_report_at or now.replace(minute=0)
+                    for snipper_user in snipper_users]
+    # Start every user's queries before waiting on any of them, so the page
+    # takes about one query round trip rather than one per user.
+    pending = [_StartWeekBefore(snipper_user.User, report_at)
+               for snipper_user, report_at in zip(snipper_users, report_times)]
+    for snipper_user, report_at, snippets in zip(snipper_users, report_times,
+                                                 pending):
+      user = snipper_user.User
+      snippet_results = snippets.GetResult()
+      logging.debug('%s has %s snippets.', user.nickname(),
+                    len(snippet_results))
+      since = pytz.utc.localize(report_at - datetime.timedelta(days=7))
+      digest = BuildDigest(user, snipper_user, snippet_results, since)
+      if digest:
+        # A retried task or an overlapping run queues the same digest
+        # again, with the same task name, which the queue rejects.
+        digest['name'] = mailer.DigestTaskName(user, report_at)
+        mail_params.append(digest)
+    _AddMailTasks(mail_params)
+    # Move everyone in the page on to their next reset after this run.
+    models.ScheduleNextReports(snipper_users, after=now)
 
 
 class SnippetMailWorker(webapp.RequestHandler):
-  """Worker designed to mail a user their snippets."""
+  """Worker that dispatches the queued digest emails."""
+
+  # Stop leasing new batches with time left to finish the current one.
+  DEADLINE = 8 * 60
 
   # pylint: disable-msg=C6409
   def post(self):
-    """Email this user their snippets."""
-    email = self.request.get('email')
-    user = self.request.get('user')
-    datestamp = self.request.get('datestamp')
-    snippets = self.request.get('snippets')
-    if not email:
-      logging.info('Missing email, quitting.'
-                   'email: %s, user: %s, datestamp: %s, snippets: %s',
-                   email, user, datestamp, snippets)
+    """Send queued digests until the queue is empty or time runs out."""
+    if self.request.get('email'):
+      # A mail task added before digests were queued for the dispatchers.
+      mailer.QueueDigests([dict((name, self.request.get(name)) for name in
+                                ('user', 'email', 'datestamp', 'snippets'))])
       return
-    logging.info('Mailing snippets to %s...', email)
-
-    # Email each user their snippets.
-    subject = "%s's snippets since %s" % (user, datestamp)
-    sender = 'snipper@google.com'
-    body = 'Last week (%s)\n%s\n\n' % (datestamp, snippets)
-    try:
-      deferred.defer(mail.send_mail, sender=sender, to=email, subject=subject,
-                     body=body)
-    except DeadlineExceededError:
-      logging.info('Deferred call to mail.send_mail timed out. Trying again.')
-      # Create another deferred call, since mail.send tends to timeout.
-      try:
-        deferred.defer(mail.send_mail, sender=sender, to=email, subject=subject,
-                       body=body)
-      except DeadlineExceededError:
-        logging.error('Deferred call to mail.send_mail timed out on 2nd try.')
-
-
-application = webapp.WSGIApplication(
-    [('/report/weekly', SnippetFetchWorker),
-     ('/report/mail', SnippetMailWorker),
-     ('/report/fetch', SnippetFetchWorker),
-    ], debug=True)
-
-
-def main():
-  webapputil.run_wsgi_app(application)
-
-if __name__ == '__main__':
-  main()
+    dispatcher = mailer.Dispatcher(mailer.PullQueueSource(),
+                                   mailer.AppEngineTransport())
+    drained = dispatcher.Run(deadline=self.DEADLINE)
+    logging.info('Mail dispatcher finished: %s', dispatcher.stats.AsDict())
+    if not drained:
+      taskqueue.Task(url='/report/mail').add(queue_name=mailer.DISPATCH_QUEUE)
+    # Retried digests are hidden until their backoff ends.
+    mailer.StartRetryDispatchers(dispatcher)
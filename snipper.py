@@ -1,5 +1,4 @@
-#!/usr/bin/python2.4
-# coding=UTF-8
+#!/usr/bin/python2.5
 #
 # Copyright 2012 Google Inc. All Rights Reserved.
 #
@@ -15,44 +14,84 @@
 #    See the License for the specific language governing permissions and
 #    limitations under the License.
 
-"""Snipper URL mapping."""
+"""Snipper URL mapping.
+
+Every dynamic request is served by this one WSGI application. Handlers are
+named by string and their modules are only imported when one of their
+routes is first requested, so a cold instance serving chat messages never
+loads the web views or the report workers.
+"""
 
 __author__ = 'erichiggins@gmail.com (Eric Higgins)'
 
-import sys
-import appengine_config
-from google.appengine.ext import webapp
+import os
+os.environ['DJANGO_SETTINGS_MODULE'] = 'appengine_config'
+from google.appengine.ext import webapp  # pylint: disable-msg=C6204
 from google.appengine.ext.webapp import util
-import chat
-import report
-import settings
-import views
-import models
-# Hack that prevents memcache from blowing up after the path change of models.
-# TODO(erichiggins): Flush memcache on the server to fix this and remove hack.
-sys.modules['models'] = models
+import metrics
+
+
+class LazyHandler(object):
+  """Stands in for a handler class until one of its routes is requested.
+
+  WSGIApplication creates a handler for each request by calling the class
+  it was given, so calling this imports the real class the first time and
+  returns an instance of it.
+  """
+
+  def __init__(self, name):
+    self.module_name, self.class_name = name.rsplit('.', 1)
+    self._handler_class = None
+
+  def __call__(self):
+    if self._handler_class is None:
+      module = __import__(self.module_name, {}, {}, [self.class_name])
+      self._handler_class = getattr(module, self.class_name)
+    metrics.SetHandler(self.class_name)
+    return self._handler_class()
+
+
+def _Routes(routes):
+  return [(regexp, LazyHandler(name)) for regexp, name in routes]
 
 
-url_mapping = [
+url_mapping = _Routes([
     # views.py
-    ('/', views.MainHandler),
-    ('/index.html', views.MainHandler),
-    ('/faq.html', views.FaqRedirect),
-    ('/view', views.ViewSnippets),
-    ('/json', views.JsonHandler),
-    ('/add', views.AddSnippet),
-    (r'^/([a-zA-Z\d][\w\-]+\.html)$', views.StaticHandler),
-    ('/_wave/.*', views.ErrorHandler),
-    ('/settings', views.PreferencesHandler),
+    ('/', 'views.MainHandler'),
+    ('/index.html', 'views.MainHandler'),
+    ('/view', 'views.ViewSnippets'),
+    ('/json', 'views.JsonHandler'),
+    ('/add', 'views.AddSnippet'),
+    ('/add/batch', 'views.AddSnippetBatch'),
+    (r'^/([a-zA-Z\d][\w\-]+\.html)$', 'views.StaticHandler'),
+    ('/_wave/.*', 'views.ErrorHandler'),
+    ('/settings', 'views.PreferencesHandler'),
+    ('/cachestats', 'views.CacheStatsHandler'),
+    ('/metrics', 'metrics.MetricsHandler'),
+    ('/search', 'views.SearchHandler'),
+    ('/buffer/flush', 'views.FlushSnippetBuffer'),
+    # export.py
+    ('/export', 'export.ExportHandler'),
+    ('/export/status', 'export.ExportStatusHandler'),
+    ('/export/download', 'export.ExportDownloadHandler'),
+    ('/export/worker', 'export.ExportWorker'),
     # chat.py
-    ('/_ah/xmpp/message/', chat.XmppHandler),
-    ('/_ah/xmpp/message/chat/', chat.XmppHandler),
+    ('/_ah/xmpp/message/', 'chat.XmppHandler'),
+    ('/_ah/xmpp/message/chat/', 'chat.XmppHandler'),
+    # outbox.py
+    ('/outbox/dispatch', 'outbox.OutboxWorker'),
     # report.py
-    ('/report/weekly', report.SnippetFetchWorker),
-    ('/report/mail', report.SnippetMailWorker),
-    ('/report/fetch', report.SnippetFetchWorker),
-]
-application = webapp.WSGIApplication(url_mapping, debug=settings.DEBUG)
+    ('/report/weekly', 'report.SnippetFetchWorker'),
+    ('/report/mail', 'report.SnippetMailWorker'),
+    ('/report/fetch', 'report.SnippetFetchWorker'),
+    # migrate.py
+    ('/migrate/users', 'migrate.SnippetUserMigration'),
+    ('/migrate/snippets', 'migrate.SnippetMigration'),
+    ('/migrate/search', 'migrate.SearchIndexMigration'),
+    ('/migrate/compact', 'migrate.SnippetCompaction'),
+    ('/migrate/next-report', 'migrate.NextReportMigration'),
+])
+application = webapp.WSGIApplication(url_mapping, debug=True)
 
 
 def main():
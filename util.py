@@ -20,22 +20,223 @@ __author__ = 'erichiggins@gmail.com (Eric Higgins)'
 
 import datetime
 import logging
+import time
 from google.appengine.api import memcache
 from google.appengine.api import urlfetch
 from google.appengine.api import users
 from google.appengine.ext import ereporter
-import pytz
 
 
 ereporter.register_logger()
 DEFAULT_TZ = 'America/Los_Angeles'
-PACIFIC_TZINFO = pytz.timezone(DEFAULT_TZ)
+
+
+class StatCounter(object):
+  """Counts events on this instance and periodically adds them to memcache.
+
+  Incrementing a memcache counter on every event would add an RPC to the
+  code being measured, so counts are kept in process and flushed in one
+  offset_multi call at most once per flush_interval seconds.
+  """
+
+  def __init__(self, prefix, names, flush_interval=60):
+    self.prefix = prefix
+    self.names = tuple(names)
+    self.flush_interval = flush_interval
+    self._pending = dict((name, 0) for name in self.names)
+    self._last_flush = time.time()
+
+  def Incr(self, name, delta=1):
+    """Count an event, flushing to memcache if the interval has passed."""
+    self._pending[name] += delta
+    if time.time() - self._last_flush >= self.flush_interval:
+      self.Flush()
+
+  def Flush(self):
+    """Add the pending counts to the shared memcache counters."""
+    pending = dict((k, v) for k, v in self._pending.iteritems() if v)
+    self._last_flush = time.time()
+    if not pending:
+      return
+    if memcache.offset_multi(pending, key_prefix=self.prefix, initial_value=0):
+      self._pending = dict((name, 0) for name in self.names)
+
+  def Get(self):
+    """Return the totals from all instances, including unflushed counts."""
+    stored = memcache.get_multi(self.names, key_prefix=self.prefix)
+    return dict((name, int(stored.get(name) or 0) + self._pending[name])
+                for name in self.names)
+
+
+class LruCache(object):
+  """A bounded mapping that evicts the least recently used entry."""
+
+  def __init__(self, max_size=256):
+    self.max_size = max_size
+    self._entries = {}
+    self._tick = 0
+
+  def __len__(self):
+    return len(self._entries)
+
+  def Get(self, key, default=None):
+    """Return the value for key, marking it as recently used."""
+    entry = self._entries.get(key)
+    if entry is None:
+      return default
+    self._tick += 1
+    entry[0] = self._tick
+    return entry[1]
+
+  def Set(self, key, value):
+    """Store a value, evicting the least recently used entry if full."""
+    if key not in self._entries and len(self._entries) >= self.max_size:
+      oldest = min(self._entries.iteritems(), key=lambda item: item[1][0])[0]
+      del self._entries[oldest]
+    self._tick += 1
+    self._entries[key] = [self._tick, value]
+
+  def Delete(self, key):
+    self._entries.pop(key, None)
+
+  def Clear(self):
+    self._entries.clear()
+
+
+_TZINFO_CACHE = LruCache(max_size=64)
+_WEEK_WINDOW_CACHE = LruCache(max_size=256)
+
+
+def GetTimezone(tzname):
+  """Returns the pytz tzinfo for a timezone name, cached per instance.
+
+  pytz is imported on first use rather than with this module, so requests
+  that never deal with timezones don't pay for loading it.
+
+  Raises:
+    pytz.UnknownTimeZoneError: The timezone name is not valid.
+  """
+  tz = _TZINFO_CACHE.Get(tzname)
+  if tz is None:
+    import pytz  # pylint: disable-msg=C6204
+    tz = pytz.timezone(tzname)
+    _TZINFO_CACHE.Set(tzname, tz)
+  return tz
+
+
+class WeekWindow(object):
+  """The start and end datetimes of a single reset week.
+
+  Attributes:
+    start: Datetime of the reset that opens the week.
+    end: Datetime of the reset that closes the week.
+    offset: Number of weeks before the current week (0=current, 1=last week).
+  """
+
+  def __init__(self, start, end, offset=0):
+    self.start = start
+    self.end = end
+    self.offset = offset
+
+  def __repr__(self):
+    return 'WeekWindow(%r, %r, offset=%d)' % (self.start, self.end,
+                                              self.offset)
+
+  def __eq__(self, other):
+    return (isinstance(other, WeekWindow) and
+            (self.start, self.end) == (other.start, other.end))
+
+  def __ne__(self, other):
+    return not self == other
+
+  def Older(self, weeks=1):
+    """Returns the window the given number of weeks before this one."""
+    delta = datetime.timedelta(days=7 * weeks)
+    return WeekWindow(self.start - delta, self.end - delta,
+                      self.offset + weeks)
+
+
+def GetWeekWindow(reset_day, reset_hour, tz, offset=0):
+  """Returns the WeekWindow for a reset day and hour, offset weeks ago.
+
+  The current window only changes at a reset, so it is computed once with
+  GetLastWeekDay/GetNextWeekDay and reused until it closes. Older windows
+  are shifted from it the same way those functions apply an offset.
+
+  Args:
+    reset_day: Day of the week as an integer.
+    reset_hour: Hour in a 24-hour format integer.
+    tz: Timezone name or tzinfo of the user.
+    offset: Number of weeks to offset the window (0=current, 1=last week).
+
+  Returns:
+    WeekWindow instance.
+  """
+  return GetWeekWindows(reset_day, reset_hour, tz, offset, count=1)[0]
+
+
+def GetWeekWindows(reset_day, reset_hour, tz, offset=0, count=1):
+  """Returns count consecutive WeekWindows, newest first, from offset back.
+
+  Args:
+    reset_day: Day of the week as an integer.
+    reset_hour: Hour in a 24-hour format integer.
+    tz: Timezone name or tzinfo of the user.
+    offset: Number of weeks to offset the newest window.
+    count: Number of windows to return.
+
+  Returns:
+    List of WeekWindow instances.
+  """
+  if isinstance(tz, basestring):
+    tz = GetTimezone(tz)
+  now = datetime.datetime.now(tz)
+  # The boundaries keep the UTC offset in effect now, so it is part of the key.
+  cache_key = (reset_day, reset_hour, tz.zone, now.utcoffset())
+  current = _WEEK_WINDOW_CACHE.Get(cache_key)
+  if current is None or not current.start <= now < current.end:
+    current = WeekWindow(GetLastWeekDay(reset_day, 0, reset_hour, tz),
+                         GetNextWeekDay(reset_day, 0, reset_hour, tz))
+    _WEEK_WINDOW_CACHE.Set(cache_key, current)
+  offset = max(offset, 0)
+  return [current.Older(offset + i) for i in xrange(count)]
+
+
+def GetNextResetUtc(reset_day, reset_hour, tzname, after=None):
+  """Returns the first reset after a UTC datetime, as a naive UTC datetime.
+
+  Each candidate reset is localized on its own date, so the reset stays at
+  the same local hour across daylight saving time changes.
+
+  Args:
+    reset_day: Day of the week as an integer.
+    reset_hour: Hour in a 24-hour format integer.
+    tzname: Timezone name of the user.
+    after: Naive UTC datetime to start from. Current time used if None.
+
+  Returns:
+    Naive UTC datetime of the next reset.
+  """
+  tz = GetTimezone(tzname)
+  utc = GetTimezone('UTC')
+  if after is None:
+    after = datetime.datetime.utcnow()
+  local = utc.localize(after).astimezone(tz)
+  day = local.date() + datetime.timedelta(
+      days=(reset_day - local.weekday()) % 7)
+  while True:
+    reset = tz.localize(datetime.datetime.combine(day,
+                                                  datetime.time(reset_hour)))
+    reset = reset.astimezone(utc).replace(tzinfo=None)
+    if reset > after:
+      return reset
+    day += datetime.timedelta(days=7)
 
 
 def ResetDatetimeToUtc(reset_day, reset_hour, tzname):
   """Returns the user's reset day and hour in UTC time."""
-  tz = pytz.timezone(tzname)
-  return GetLastWeekDay(reset_day, 0, reset_hour, tz).astimezone(pytz.utc)
+  window = GetWeekWindow(reset_day, reset_hour, tzname)
+  return window.start.astimezone(GetTimezone('UTC'))
 
 
 def GetUserTimezone(username):
@@ -48,7 +249,7 @@ def GetUserTimezone(username):
 
 def GetExpiryHeader(days=0, hours=0, minutes=10):
   """Returns a date string formatted for the Expires HTTP header."""
-  tz = pytz.timezone('GMT')
+  tz = GetTimezone('GMT')
   now = datetime.datetime.now(tz).replace(second=0, microsecond=0)
   expire = now + datetime.timedelta(days=days, hours=hours, minutes=minutes)
   return expire.strftime('%a, %d %b %Y %H:%M:%S %Z')
@@ -75,18 +276,21 @@ def GetGaiaData(user):
           'right_links': ' <span>|</span>\n'.join(right)}
 
 
-def GetResetDate(weekday, hour=15, tz=PACIFIC_TZINFO, start=None):
+def GetResetDate(weekday, hour=15, tz=None, start=None):
   """Returns the datetime for the reset during the current week.
 
   Args:
     weekday: Day of the week as an integer (0=Sunday, 6=Saturday).
     hour: Hour in a 24-hour format integer.
-    tz: Timezone of the user to use when creating the datetime object.
+    tz: Timezone of the user to use when creating the datetime object,
+      DEFAULT_TZ if None.
     start: Datetime to use as the starting point. Current date used if None.
 
   Returns:
     Datetime of the current weekly reset.
   """
+  if tz is None:
+    tz = GetTimezone(DEFAULT_TZ)
   if not start:
     start = datetime.datetime.now(tz)
   reset = start.replace(hour=hour,
@@ -96,7 +300,7 @@ def GetResetDate(weekday, hour=15, tz=PACIFIC_TZINFO, start=None):
   return reset + datetime.timedelta(days=(weekday - reset.weekday()))
 
 
-def GetLastWeekDay(weekday, offset=0, hour=15, tz=PACIFIC_TZINFO, start=None):
+def GetLastWeekDay(weekday, offset=0, hour=15, tz=None, start=None):
   """Return the datetime for the previous weekday, such as last Monday.
 
   This is used to define the boundary for fetching a user's snippets within
@@ -106,7 +310,8 @@ def GetLastWeekDay(weekday, offset=0, hour=15, tz=PACIFIC_TZINFO, start=None):
     weekday: Day of the week as an integer (0=Sunday, 6=Saturday).
     offset: Number of weeks to offset the datetime (0=current, 1=last week).
     hour: Hour in a 24-hour format integer.
-    tz: Timezone of the user to use when creating the datetime object.
+    tz: Timezone of the user to use when creating the datetime object,
+      DEFAULT_TZ if None.
     start: Datetime to use as the starting point. Current date used if None.
 
   Returns:
@@ -115,6 +320,8 @@ def GetLastWeekDay(weekday, offset=0, hour=15, tz=PACIFIC_TZINFO, start=None):
   if offset < 0:
     offset = 0
   weeks = offset * 7
+  if tz is None:
+    tz = GetTimezone(DEFAULT_TZ)
   if not start:
     start = datetime.datetime.now(tz)
   reset = GetResetDate(weekday=weekday, hour=hour, tz=tz)
@@ -125,7 +332,7 @@ def GetLastWeekDay(weekday, offset=0, hour=15, tz=PACIFIC_TZINFO, start=None):
   return reset - datetime.timedelta(days=weeks)
 
 
-def GetNextWeekDay(weekday, offset=0, hour=15, tz=PACIFIC_TZINFO, start=None):
+def GetNextWeekDay(weekday, offset=0, hour=15, tz=None, start=None):
   """Return the datetime for the next weekday, such as next Monday.
 
   This is used to define the boundary for fetching a user's snippets within
@@ -135,7 +342,8 @@ def GetNextWeekDay(weekday, offset=0, hour=15, tz=PACIFIC_TZINFO, start=None):
     weekday: Day of the week as an integer (0=Sunday, 6=Saturday).
     offset: Number of weeks to offset the datetime (0=current, 1=last week).
     hour: Hour in a 24-hour format integer.
-    tz: Timezone of the user to use when creating the datetime object.
+    tz: Timezone of the user to use when creating the datetime object,
+      DEFAULT_TZ if None.
     start: Datetime to use as the starting point. Current date used if None.
 
   Returns:
@@ -144,6 +352,8 @@ def GetNextWeekDay(weekday, offset=0, hour=15, tz=PACIFIC_TZINFO, start=None):
   if offset < 0:
     offset = 0
   weeks = offset * 7
+  if tz is None:
+    tz = GetTimezone(DEFAULT_TZ)
   if not start:
     start = datetime.datetime.now(tz)
   reset = GetResetDate(weekday=weekday, hour=hour, tz=tz)
@@ -18,10 +18,14 @@
 
 __author__ = 'erichiggins@gmail.com (Eric Higgins)'
 
+import base64
 import calendar
 import datetime
+import email.utils
+import hashlib
 import logging
 import os
+import time
 import urllib
 import json  # pylint: disable-msg=C6204
 os.environ['DJANGO_SETTINGS_MODULE'] = 'appengine_config'
@@ -33,15 +37,39 @@ from google.appengine.api import users
 from google.appengine.ext import db
 from google.appengine.ext import ereporter
 from google.appengine.ext import webapp
-from google.appengine.ext.webapp import template
 from google.appengine.ext.webapp import util as webapp_util
 import models
-import pytz
 import util
 
 
 ereporter.register_logger()
 
+# Rendered static pages are only cached for an hour, since the layout prints
+# the current year.
+PAGE_CACHE_TIME = 60 * 60
+# Stand-ins for the GAIA bar links in cached pages, replaced per request.
+_GAIA_LEFT = '<!--gaia:left_links-->'
+_GAIA_RIGHT = '<!--gaia:right_links-->'
+
+
+def RenderTemplate(filename, template_values):
+  """Render a template from the templates directory.
+
+  webapp.template keeps compiled templates for the life of the instance.
+  It is only imported on first use, since the JSON and /add handlers never
+  render a template.
+
+  Args:
+    filename: Name of the template, relative to the templates directory.
+    template_values: Dict of values to render the template with.
+
+  Returns:
+    The rendered template string.
+  """
+  from google.appengine.ext.webapp import template  # pylint: disable-msg=C6204
+  path = os.path.join(os.path.dirname(__file__), 'templates', filename)
+  return template.render(path, template_values)
+
 
 class PreferencesHandler(webapp.RequestHandler):
   """Handle the user preferences page."""
@@ -68,8 +96,7 @@ class PreferencesHandler(webapp.RequestHandler):
                         [(12, '12 pm')] +
                         [(x, '%s pm' % (x - 12)) for x in xrange(13, 24)]),
     }
-    path = os.path.join(os.path.dirname(__file__), 'templates/preferences.html')
-    rendered_page = template.render(path, template_values)
+    rendered_page = RenderTemplate('preferences.html', template_values)
     self.response.headers['Expires'] = util.GetExpiryHeader(minutes=0)
     self.response.headers['Cache-Control'] = 'private, max-age=0'
     self.response.out.write(rendered_page)
@@ -81,6 +108,8 @@ class PreferencesHandler(webapp.RequestHandler):
     snipper_user = models.GetSnippetUser(user)
     logging.debug('Saving settings for %s', user)
     errors = []
+    old_reset = (snipper_user.reset_day, snipper_user.reset_hour,
+                 snipper_user.timezone)
     date_format = str(self.request.get('date_format', snipper_user.date_format))
     snippet_format = self.request.get('snippet_format',
                                       snipper_user.snippet_format)
@@ -91,8 +120,9 @@ class PreferencesHandler(webapp.RequestHandler):
     snipper_user.reset_hour = int(self.request.get('reset_hour',
                                                    snipper_user.reset_hour))
     timezone = self.request.get('timezone')
+    import pytz  # pylint: disable-msg=C6204
     try:
-      assert pytz.timezone(timezone)
+      assert util.GetTimezone(timezone)
     except pytz.UnknownTimeZoneError:
       logging.exception('Invalid timezone: %s', timezone)
       errors.append('Invalid timezone: %s.' % timezone)
@@ -104,6 +134,7 @@ class PreferencesHandler(webapp.RequestHandler):
                                           snipper_user.timezone)
       snipper_user.utc_reset_day = utc_reset.weekday()
       snipper_user.utc_reset_hour = utc_reset.hour
+    snipper_user.ScheduleNextReport()
     try:
       assert datetime.datetime.now().strftime(date_format)
     except (ValueError, TypeError):
@@ -134,14 +165,21 @@ class PreferencesHandler(webapp.RequestHandler):
     except (db.Timeout, db.InternalError):
       logging.exception('Could not save settings.')
       errors.append('Could not save settings.')
+      # Don't keep the unsaved changes in the caches.
+      models.InvalidateSnippetUsers([snipper_user])
     else:
-      memcache_key = 'SnippetUser-' + str(user)
-      memcache.set(memcache_key, snipper_user)
+      models.CacheSnippetUser(snipper_user)
+      # The valid fields were saved even if others were rejected, so
+      # invalidate every cached week, the settings change how they render.
+      models.BumpSnippetGeneration(user)
+      if old_reset != (snipper_user.reset_day, snipper_user.reset_hour,
+                       snipper_user.timezone):
+        # The week boundaries moved, so the weekly buckets are no longer
+        # valid.
+        models.RebuildSnippetWeeks(user)
     if errors:
       errors = urllib.quote_plus(','.join(errors))
       return self.redirect('/settings?errors=' + errors)
-    # Drop the last two weeks from memcache.
-    memcache.delete_multi(['snippets_%s_%d' % (str(user), x) for x in (0, 1)])
     self.redirect('/?msg=Settings+saved.')
 
 
@@ -166,16 +204,136 @@ class AddSnippet(webapp.RequestHandler):
       self.response.out.write('0')
       return
 
-    result = models.SaveSnippet(user, version, snip)
+    result = models.SaveSnippets(user, version, [snip])[0]
     self.response.out.write(int(result[0]))
 
 
+class AddSnippetBatch(webapp.RequestHandler):
+  """Add a batch of snippets, e.g. the offline queue of the extension.
+
+  The snippets are posted as a JSON array in the b parameter, each one an
+  object with the snippet text s, its client timestamp t in seconds since
+  the epoch and an optional client id. All of them are saved with a single
+  batched put, and a JSON array with the status of each is returned.
+  """
+
+  MAX_SNIPPETS = 100
+  # Client clocks are not trusted further than this from the server's.
+  MAX_CLOCK_SKEW = datetime.timedelta(minutes=5)
+  MAX_AGE = datetime.timedelta(days=30)
+
+  def post(self):  # pylint: disable-msg=C6409
+    self.response.headers['Content-Type'] = 'application/json'
+    user = users.get_current_user()
+    version = self.request.get('v', '')
+    if not user:
+      return self.error(403)
+    try:
+      items = simplejson.loads(self.request.get('b', '[]'))
+      if not isinstance(items, list) or len(items) > self.MAX_SNIPPETS:
+        raise ValueError('Expected a list of at most %d snippets.' %
+                         self.MAX_SNIPPETS)
+    except ValueError, err:
+      logging.debug('Bad snippet batch: %s', err)
+      return self.error(400)
+    # Make sure the user has been added.
+    assert models.GetSnippetUser(user)
+
+    statuses = [None] * len(items)
+    snippets = []
+    datestamps = []
+    positions = []
+    now = datetime.datetime.utcnow()
+    for i, item in enumerate(items):
+      text = isinstance(item, dict) and item.get('s')
+      if not text or not isinstance(text, basestring):
+        statuses[i] = (False, 'Empty snippet.')
+        continue
+      snippets.append(text)
+      datestamps.append(self.ClientDatestamp(item.get('t'), now))
+      positions.append(i)
+    if snippets:
+      results = models.SaveSnippets(user, version, snippets, datestamps)
+      for i, result in zip(positions, results):
+        statuses[i] = result
+
+    response = []
+    for item, (ok, message) in zip(items, statuses):
+      status = {'ok': int(ok)}
+      if isinstance(item, dict) and 'id' in item:
+        status['id'] = item['id']
+      if not ok:
+        status['error'] = unicode(message)
+      response.append(status)
+    self.response.out.write(simplejson.dumps(response))
+
+  def ClientDatestamp(self, timestamp, now):
+    """Return a client timestamp as a naive UTC datetime, bounded by now."""
+    try:
+      datestamp = datetime.datetime.utcfromtimestamp(float(timestamp))
+    except (TypeError, ValueError, OverflowError):
+      return now
+    if datestamp > now + self.MAX_CLOCK_SKEW:
+      return now
+    return max(datestamp, now - self.MAX_AGE)
+
+
+def _EpochSeconds(date):
+  return calendar.timegm(date.utctimetuple())
+
+
+def _NotModified(handler, user, snipper_user):
+  """Set the validators for a user's data, and send a 304 if they match.
+
+  The ETag covers the handler, the request, the user's data version (which
+  changes with their snippets and settings), the current week and the app
+  version, so it can be checked without touching the datastore.
+
+  Args:
+    handler: webapp.RequestHandler serving the request.
+    user: User object.
+    snipper_user: SnippetUser of the user.
+
+  Returns:
+    True if a 304 Not Modified response was sent.
+  """
+  generation, modified = models.GetSnippetVersion(user)
+  current_start = _EpochSeconds(models.GetWeekWindow(snipper_user).start)
+  # The current week changes at every reset without any data changing.
+  modified = max(modified, current_start)
+  etag = '"%s"' % hashlib.md5('|'.join([
+      handler.__class__.__name__, user.email(), str(generation),
+      str(current_start), handler.request.query_string,
+      os.environ.get('CURRENT_VERSION_ID', '')])).hexdigest()
+  handler.response.headers['ETag'] = etag
+  handler.response.headers['Last-Modified'] = email.utils.formatdate(
+      modified, usegmt=True)
+
+  if_none_match = handler.request.headers.get('If-None-Match')
+  if if_none_match:
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    fresh = etag in tags or '*' in tags
+  else:
+    since = email.utils.parsedate_tz(
+        handler.request.headers.get('If-Modified-Since', ''))
+    # HTTP dates are in whole seconds, so only trust them for earlier seconds.
+    fresh = bool(since and modified < int(time.time()) and
+                 modified <= email.utils.mktime_tz(since))
+  if fresh:
+    handler.response.set_status(304)
+  return fresh
+
+
 class ViewSnippets(webapp.RequestHandler):
   """Return a users snippets."""
 
   @webapp_util.login_required
   def get(self):  # pylint: disable-msg=C6409
     """Print a users snippets."""
+    user = users.get_current_user()
+    self.response.headers['Cache-Control'] = 'private, no-cache'
+    if _NotModified(self, user, models.GetSnippetUser(user)):
+      return
     try:
       offset = int(self.request.get('offset', default_value=0))
     except ValueError:
@@ -186,36 +344,141 @@ class ViewSnippets(webapp.RequestHandler):
     self.response.out.write(snip + '\n')
 
 
+def _EncodeWeekCursor(next_window, last_window):
+  """Return an opaque cursor for the weeks from next_window to last_window.
+
+  The cursor holds the week start times rather than offsets, so paging stays
+  on the same weeks even if a reset happens between requests.
+  """
+  return base64.urlsafe_b64encode('%d:%d' % (_EpochSeconds(next_window.start),
+                                             _EpochSeconds(last_window.start)))
+
+
+def _DecodeWeekCursor(cursor, current):
+  """Return the (first, last) week offsets of a cursor from _EncodeWeekCursor.
+
+  Raises:
+    ValueError: The cursor is not valid.
+  """
+  try:
+    next_start, last_start = base64.urlsafe_b64decode(str(cursor)).split(':')
+  except (TypeError, ValueError):
+    raise ValueError('Invalid cursor %r' % cursor)
+  current_start = _EpochSeconds(current.start)
+  # Round, since a DST change moves the boundaries by an hour.
+  return tuple(int(round((current_start - int(start)) / (7 * 24 * 3600.0)))
+               for start in (next_start, last_start))
+
+
+def _WeekJson(window, results):
+  """Return the JSON-ready dict of one week of snippets."""
+  return {
+      'snippets': [{'key': str(s.key()), 'text': s.Snippet} for s in results],
+      'dates': {
+          'from': window.start.strftime('%b %d'),
+          'to': window.end.strftime('%b %d')
+      }
+  }
+
+
 class JsonHandler(webapp.RequestHandler):
-  """Handle JSON requests for the web front end."""
+  """Handle JSON requests for the web front end.
+
+  By default a single week is returned for the offset parameter. Several
+  weeks are returned, newest first, for ?offset=N&weeks=M or ?from=N&to=M
+  (week offsets, inclusive). At most MAX_WEEKS weeks are sent at once, with
+  a cursor parameter to request the rest.
+  """
+
+  MAX_WEEKS = 8
 
   @webapp_util.login_required
   def get(self):  # pylint: disable-msg=C6409
     """Return a users snippets for the requested timeframe in JSON format."""
-    snipper_user = models.GetSnippetUser(users.get_current_user())
-    tz = pytz.timezone(snipper_user.timezone)
+    user = users.get_current_user()
+    snipper_user = models.GetSnippetUser(user)
+    self.response.headers['Cache-Control'] = 'private, no-cache'
+    if _NotModified(self, user, snipper_user):
+      return
+    self.response.headers['Content-Type'] = 'application/json'
     try:
       offset = int(self.request.get('offset', default_value=0))
     except ValueError:
       offset = 0
+    if (self.request.get('cursor') or self.request.get('weeks') or
+        self.request.get('from')):
+      return self.GetRange(user, snipper_user, offset)
+
     results = models.FetchSnippets(offset=offset)
+    window = models.GetWeekWindow(snipper_user, offset)
+    self.response.out.write(simplejson.dumps(_WeekJson(window, results)))
+
+  def GetRange(self, user, snipper_user, offset):
+    """Write a page of weeks, and a cursor if more weeks were requested."""
+    try:
+      if self.request.get('cursor'):
+        first, last = _DecodeWeekCursor(self.request.get('cursor'),
+                                        models.GetWeekWindow(snipper_user))
+      elif self.request.get('from'):
+        bounds = (int(self.request.get('from')),
+                  int(self.request.get('to', self.request.get('from'))))
+        first, last = min(bounds), max(bounds)
+      else:
+        first = offset
+        last = offset + int(self.request.get('weeks')) - 1
+    except ValueError:
+      return self.error(400)
+    first = max(first, 0)
+    if last < first:
+      return self.error(400)
+
+    count = min(last - first + 1, self.MAX_WEEKS)
+    windows = util.GetWeekWindows(snipper_user.reset_day,
+                                  snipper_user.reset_hour,
+                                  snipper_user.timezone, first, count)
+    weeks = []
+    for window, results in zip(windows,
+                               models.FetchSnippetWeeks(user, windows)):
+      week = _WeekJson(window, results)
+      week['offset'] = window.offset
+      weeks.append(week)
+    cursor = None
+    if first + count <= last:
+      cursor = _EncodeWeekCursor(windows[-1].Older(),
+                                 windows[0].Older(last - first))
+    self.response.out.write(simplejson.dumps({'weeks': weeks,
+                                              'cursor': cursor}))
+
+
+class SearchHandler(webapp.RequestHandler):
+  """Search a user's snippets, e.g. /search?q=launch+review.
+
+  Results are ranked best first and returned LIMIT at a time, with a cursor
+  parameter to request the next page.
+  """
+
+  LIMIT = 20
+
+  @webapp_util.login_required
+  def get(self):  # pylint: disable-msg=C6409
+    user = users.get_current_user()
+    self.response.headers['Cache-Control'] = 'private, no-cache'
+    if _NotModified(self, user, models.GetSnippetUser(user)):
+      return
+    query = self.request.get('q')
+    try:
+      results, cursor = models.SearchSnippets(
+          user, query, self.LIMIT, self.request.get('cursor') or None)
+    except ValueError:
+      return self.error(400)
     self.response.headers['Content-Type'] = 'application/json'
-    start_date = util.GetLastWeekDay(snipper_user.reset_day,
-                                     offset,
-                                     snipper_user.reset_hour,
-                                     tz)
-    end_date = util.GetNextWeekDay(snipper_user.reset_day,
-                                   offset,
-                                   snipper_user.reset_hour,
-                                   tz)
-    ret = {
-        'snippets': [{'key': str(s.key()), 'text': s.Snippet} for s in results],
-        'dates': {
-            'from': start_date.strftime('%b %d'),
-            'to': end_date.strftime('%b %d')
-        }
-    }
-    self.response.out.write(simplejson.dumps(ret))
+    self.response.out.write(simplejson.dumps({
+        'query': query,
+        'snippets': [{'key': str(s.key()), 'text': s.Snippet,
+                      'date': s.DateStamp.strftime('%Y-%m-%d')}
+                     for s in results],
+        'cursor': cursor,
+    }))
 
 
 class StaticHandler(webapp.RequestHandler):
@@ -223,14 +486,50 @@ class StaticHandler(webapp.RequestHandler):
 
   def get(self, filename):  # pylint: disable-msg=C6409
     user = users.get_current_user()
-    template_values = {'gaia': util.GetGaiaData(user)}
-    path = os.path.join(os.path.dirname(__file__), 'templates/', filename)
-    rendered_page = template.render(path, template_values)
+    # Pages are cached with stand-ins for the GAIA bar links, which are the
+    # only part that differs between users.
+    cachekey = 'page_%s_%s_%s' % (os.environ.get('CURRENT_VERSION_ID', ''),
+                                  filename, user and 'user' or 'anonymous')
+    page = memcache.get(cachekey)
+    if page is None:
+      template_values = {'gaia': {'left_links': _GAIA_LEFT,
+                                  'right_links': _GAIA_RIGHT}}
+      page = RenderTemplate(filename, template_values)
+      if not memcache.set(cachekey, page, PAGE_CACHE_TIME):
+        logging.debug('Memcache set failed for %s', cachekey)
+    gaia = util.GetGaiaData(user)
+    rendered_page = page.replace(_GAIA_LEFT, gaia['left_links']).replace(
+        _GAIA_RIGHT, gaia['right_links'])
     self.response.headers['Expires'] = util.GetExpiryHeader()
     self.response.headers['Cache-Control'] = 'public, max-age=600'
     self.response.out.write(rendered_page)
 
 
+class CacheStatsHandler(webapp.RequestHandler):
+  """Report the cache hit rates and write-behind buffer counts to admins."""
+
+  def get(self):  # pylint: disable-msg=C6409
+    self.response.headers['Content-Type'] = 'application/json'
+    self.response.out.write(simplejson.dumps({
+        'snippets': models.GetSnippetCacheStats(),
+        'snippet_user': models.GetSnippetUserCacheStats(),
+        'snippet_buffer': models.GetSnippetBufferStats(),
+    }))
+
+
+class FlushSnippetBuffer(webapp.RequestHandler):
+  """Task that writes a user's buffered snippets to the datastore."""
+
+  def post(self):  # pylint: disable-msg=C6409
+    try:
+      buffer_key = db.Key(self.request.get('key'))
+    except db.BadKeyError:
+      logging.error('Bad SnippetBuffer key: %r', self.request.get('key'))
+      return
+    flushed = models.FlushSnippetBuffer(buffer_key)
+    logging.debug('Flushed %d snippets from %s.', flushed, buffer_key)
+
+
 class ErrorHandler(webapp.RequestHandler):
   """Error handler."""
 
@@ -247,23 +546,23 @@ class MainHandler(webapp.RequestHandler):
     """Render the Snipper page."""
     user = users.get_current_user()
     snipper_user = models.GetSnippetUser(user)
-    tz = pytz.timezone(snipper_user.timezone)
+    self.response.headers['Expires'] = util.GetExpiryHeader(minutes=1)
+    self.response.headers['Cache-Control'] = 'private, max-age=60'
+    if _NotModified(self, user, snipper_user):
+      return
     try:
       offset = int(self.request.get('offset', default_value=0))
     except ValueError:
       offset = 0
     results = models.FetchSnippets(offset=offset)
     snippets = [s.Snippet for s in results]
+    window = models.GetWeekWindow(snipper_user, offset)
     template_values = {
         'gaia': util.GetGaiaData(user),
         'user': user,
         'reset_day': calendar.day_name[snipper_user.reset_day],
-        'start': util.GetLastWeekDay(snipper_user.reset_day,
-                                     hour=snipper_user.reset_hour,
-                                     tz=tz),
-        'end': util.GetNextWeekDay(snipper_user.reset_day,
-                                   hour=snipper_user.reset_hour,
-                                   tz=tz),
+        'start': window.start,
+        'end': window.end,
         'snippets': snippets,
         'offset': offset,
         'older': offset + 1,
@@ -274,28 +573,5 @@ class MainHandler(webapp.RequestHandler):
     else:
       template_values['newer'] = 0
 
-    path = os.path.join(os.path.dirname(__file__), 'templates/index.html')
-    rendered_page = template.render(path, template_values)
-    self.response.headers['Expires'] = util.GetExpiryHeader(minutes=1)
-    self.response.headers['Cache-Control'] = 'private, max-age=60'
+    rendered_page = RenderTemplate('index.html', template_values)
     self.response.out.write(rendered_page)
-
-
-application = webapp.WSGIApplication(
-    [('/', MainHandler),
-     ('/index.html', MainHandler),
-     ('/view', ViewSnippets),
-     ('/json', JsonHandler),
-     ('/add', AddSnippet),
-     (r'^/([a-zA-Z\d][\w\-]+\.html)$', StaticHandler),
-     ('/_wave/.*', ErrorHandler),
-     ('/settings', PreferencesHandler),
-    ],
-    debug=True)
-
-
-def main():
-  webapp_util.run_wsgi_app(application)
-
-if __name__ == '__main__':
-  main()